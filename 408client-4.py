@@ -1,26 +1,41 @@
-import socket
+import sys
+from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtWidgets import ( #GUI components
     QApplication, QMainWindow, QPushButton, QVBoxLayout, QLabel,
-    QListWidget, QFileDialog, QLineEdit, QWidget, QInputDialog
+    QListWidget, QListWidgetItem, QFileDialog, QLineEdit, QWidget, QInputDialog, QSpinBox
 )
 import os
-import traceback
+
+from client_worker import (#background jobs, so the window never waits on the network
+    DEFAULT_CONCURRENCY, MAX_CONCURRENCY, TransferEngine, format_progress
+)
+from fileclient import FileClient, FileClientError, folder_items#the protocol, shared with scripts and the CLI
+from logview import LogView#queued, batched log pane, transfer threads log through it
 
 
 class ClientApp(QMainWindow):
-    def __init__(self): #client window
+    connection_lost = pyqtSignal()#from the client's listener thread, handled on the GUI thread
+
+    def __init__(self, log_file=None): #client window
         super().__init__()
 
+        self.log_file = log_file#optional rotating file that keeps the whole log
         self.initUI()
-        self.client_socket = None
-        self.server_ip = ""
-        self.port = 0
-        self.name = ""
+        self.client = None#FileClient of the current connection, does all the talking to the server
         self.download_dir = ""
+        self.connection_lost.connect(self.connection_closed)
+
+        #uploads, downloads, listings and deletes run on background workers, each call on its own connection
+        self.engine = TransferEngine(self.concurrency_input.value())
+        self.engine.job_queued.connect(self.job_queued)
+        self.engine.job_started.connect(self.job_started)
+        self.engine.job_progress.connect(self.job_progress)
+        self.engine.job_finished.connect(self.job_finished)
+        self.transfer_items = {}#job id -> (label, QListWidgetItem) in the transfers list
 
     def initUI(self): #UI components and their places
         self.setWindowTitle("Client Application")
-        self.setGeometry(100, 100, 600, 600)
+        self.setGeometry(100, 100, 600, 750)
 
         central_widget = QWidget(self)
         self.setCentralWidget(central_widget)
@@ -49,17 +64,22 @@ class ClientApp(QMainWindow):
         layout.addWidget(self.connect_button)
 
         #for default disabled button operations
-        self.upload_button = QPushButton("Upload File", self)
+        self.upload_button = QPushButton("Upload Files", self)
         self.upload_button.clicked.connect(self.upload_file)
         self.upload_button.setEnabled(False)
         layout.addWidget(self.upload_button)
 
+        self.upload_folder_button = QPushButton("Upload Folder", self)
+        self.upload_folder_button.clicked.connect(self.upload_folder)
+        self.upload_folder_button.setEnabled(False)
+        layout.addWidget(self.upload_folder_button)
+
         self.list_button = QPushButton("List Files", self)
         self.list_button.clicked.connect(self.list_files)
         self.list_button.setEnabled(False)
         layout.addWidget(self.list_button)
 
-        self.download_button = QPushButton("Download File", self)
+        self.download_button = QPushButton("Download Files", self)
         self.download_button.clicked.connect(self.download_file)
         self.download_button.setEnabled(False)
         layout.addWidget(self.download_button)
@@ -78,11 +98,26 @@ class ClientApp(QMainWindow):
         self.selected_dir = QLabel("No directory selected", self)
         layout.addWidget(self.selected_dir)
 
+        #transfers in progress
+        self.concurrency_label = QLabel("Parallel transfers:", self)
+        layout.addWidget(self.concurrency_label)
+        self.concurrency_input = QSpinBox(self)
+        self.concurrency_input.setRange(1, MAX_CONCURRENCY)
+        self.concurrency_input.setValue(DEFAULT_CONCURRENCY)
+        self.concurrency_input.valueChanged.connect(self.set_concurrency)
+        layout.addWidget(self.concurrency_input)
+        self.transfer_label = QLabel("Transfers:", self)
+        layout.addWidget(self.transfer_label)
+        self.transfer_box = QListWidget(self)
+        layout.addWidget(self.transfer_box)
+
         #output log
         self.log_label = QLabel("Client Logs:", self)
         layout.addWidget(self.log_label)
         self.log_box = QListWidget(self)
+        self.log_box.setUniformItemSizes(True)#lets the view skip measuring every line
         layout.addWidget(self.log_box)
+        self.log_view = LogView(self.log_box, self.log_file)
 
     def select_directory(self):#choosing directory for downloads
         directory = QFileDialog.getExistingDirectory(self, "Select Directory")
@@ -92,81 +127,101 @@ class ClientApp(QMainWindow):
 
     def connect_to_server(self):#connecting the server
         try:
-            self.server_ip = self.ip_input.text()#getting ip,port and the username
-            self.port = int(self.port_input.text())
-            self.name = self.name_input.text()
-
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)#creating TCP socket
-            self.client_socket.connect((self.server_ip, self.port))
-
-            #sending username to the server
-            self.client_socket.send(self.name.encode())
-            response = self.client_socket.recv(1024).decode()
-            if response.startswith("Error"):#connection error message
-                self.log_message(response)
-                self.client_socket.close()
-                self.client_socket = None
-            else:
-                self.log_message("Connected to server.")#connection success message
-                self.enable_buttons()#file operations are enabled
+            server_ip = self.ip_input.text()#getting ip,port and the username
+            port = int(self.port_input.text())
+            name = self.name_input.text()
+            if self.client:#leave the previous server first
+                self.client.close()
+                self.client = None
+
+            client = FileClient(server_ip, port, name, log=self.log_message, on_disconnect=self.connection_lost.emit)
+            client.connect()#from now on the main connection only brings notifications, read in the background
+            self.client = client
+            self.log_message("Connected to server.")#connection success message
+            self.enable_buttons()#file operations are enabled
+        except FileClientError as e:#server refused, e.g. the name is taken
+            self.log_message(f"Error: {e}")
         except Exception as e:
             self.log_message(f"Error connecting to server: {e}")
 
-    def upload_file(self):#uploading file to server
-        if not self.client_socket:#checking connection
+    def connection_closed(self):#the main connection ended, the server is gone
+        if self.client is None or self.client.connected:#we reconnected meanwhile
+            return
+        self.client.close()
+        self.client = None
+        self.disable_buttons()
+        self.log_message("Disconnected from server.")
+
+    def connected(self):#checking connection
+        if self.client is None:
             self.log_message("Error: Not connected to the server.")
+            return False
+        return True
+
+    def set_concurrency(self, count):
+        self.engine.set_concurrency(count)
+
+    #transfer list, updated from the engine's signals on the GUI thread
+
+    def job_queued(self, job_id, label):
+        item = QListWidgetItem(f"{label}: queued")
+        self.transfer_box.addItem(item)
+        self.transfer_items[job_id] = (label, item)
+
+    def job_started(self, job_id):
+        if job_id in self.transfer_items:
+            label, item = self.transfer_items[job_id]
+            item.setText(f"{label}: starting")
+
+    def job_progress(self, job_id, done, total, rate, eta):
+        if job_id in self.transfer_items:
+            label, item = self.transfer_items[job_id]
+            item.setText(f"{label}: {format_progress(done, total, rate, eta)}")
+
+    def job_finished(self, job_id, message, success, rate):
+        label, item = self.transfer_items.pop(job_id, (None, None))
+        if item is not None:
+            self.transfer_box.takeItem(self.transfer_box.row(item))
+        if not success:
+            self.log_message(f"Error: {label} failed: {message}")
+        elif message:
+            self.log_message(message)
+
+    def upload_file(self):#uploading files to server
+        if not self.connected():
+            return
+        file_paths, _ = QFileDialog.getOpenFileNames(self, "Select Files to Upload")
+        for file_path in file_paths:
+            self.queue_upload(file_path, os.path.basename(file_path))
+
+    def upload_folder(self):#every file under a directory, named by its path from the directory on
+        if not self.connected():
             return
-        file_path, _ = QFileDialog.getOpenFileName(self, "Select File to Upload")
-        if file_path:
-            filename = os.path.basename(file_path)
-            filesize = os.path.getsize(file_path)
-            command = f"UPLOAD|{filename}|{filesize}"#creating uopload command
-
-            try:
-                self.client_socket.send(command.encode())#upload command to server
-                with open(file_path, 'rb') as f:
-                    chunk = f.read(4096)
-                    while chunk:
-                        self.client_socket.send(chunk)
-                        chunk = f.read(4096)
-                response = self.client_socket.recv(1024).decode()#response of server
-                self.log_message(response)#response of server on the log
-            except Exception as e:
-                self.log_message(f"Error during file upload: {e}")
+        directory = QFileDialog.getExistingDirectory(self, "Select Folder to Upload")
+        if directory:
+            for file_path, filename in folder_items(directory):
+                self.queue_upload(file_path, filename)
+
+    def queue_upload(self, file_path, filename):
+        client = self.client
+
+        def run(progress):
+            return client.upload(file_path, filename, progress)
+        self.engine.submit(f"Upload {filename}", run, os.path.getsize(file_path))
 
     def list_files(self):#listing files that are in the server
-        if not self.client_socket:#checking connection
-            self.log_message("Error: Not connected to the server.")
+        if not self.connected():
             return
-        try:
-            self.client_socket.send("LIST".encode())#list command sent to server
-            response = self.client_socket.recv(1024).decode()#response of server
-            self.log_message(f"Raw server response: {response}")
-
-            if response.startswith("LIST"):#check if response contains file list
-                _, size = response.split('|')
-                size = int(size)
-                self.client_socket.send("READY".encode())#ready to receive list
-
-                received_data = b""
-                while len(received_data) < size:
-                    chunk = self.client_socket.recv(4096)
-                    if not chunk:
-                        self.log_message("Connection closed prematurely.")
-                        break
-                    received_data += chunk
-
-                file_list_str = received_data.decode()#decoding received data
-                self.log_message("Available Files:")
-                self.log_message(file_list_str)#display file list
-            else:
-                self.log_message(f"Unexpected response: {response}")
-        except Exception as e:
-            self.log_message(f"Error in list_files: {traceback.format_exc()}")
+        client = self.client
+
+        def run(progress):
+            files = client.list_files()
+            self.log_message("Available Files:")
+            self.log_message("\n".join(f"{filename} (Owner: {owner})" for owner, filename, _ in files))#display file list
+        self.engine.submit("List files", run)
 
     def download_file(self):#downloading from the server
-        if not self.client_socket:#check if connected
-            self.log_message("Error: Not connected to the server.")
+        if not self.connected():
             return
 
         if not self.download_dir:#checking if there is a download directory
@@ -174,78 +229,81 @@ class ClientApp(QMainWindow):
             return
 
         owner_name, ok1 = QInputDialog.getText(self, "File Owner", "Enter owner's username:")#getting the data of the file
-        filename, ok2 = QInputDialog.getText(self, "Filename", "Enter filename to download:")
-        if not (ok1 and ok2 and owner_name and filename):
+        names, ok2 = QInputDialog.getText(self, "Filenames", "Enter filenames to download, separated by commas "
+                                                              "(end a name with / for a whole folder):")
+        filenames = [name.strip() for name in names.split(",") if name.strip()]
+        if not (ok1 and ok2 and owner_name and filenames):
             self.log_message("File download canceled.")
             return
-
-        try:
-            command = f"DOWNLOAD|{owner_name}|{filename}"#download command
-            self.client_socket.send(command.encode())#command send to server
-
-            response = self.client_socket.recv(1024).decode()#server response
-            if response.startswith("DOWNLOAD"):#checking the response
-                _, filesize = response.split('|')
-                filesize = int(filesize)
-
-                self.client_socket.send("READY".encode())#ready to receive file
-                filepath = os.path.join(self.download_dir, filename)#setting local file path
-
-                with open(filepath, 'wb') as f:
-                    bytes_received = 0
-                    while bytes_received < filesize:#receiving file
-                        chunk = self.client_socket.recv(4096)
-                        if not chunk:
-                            self.log_message("Error: Connection closed prematurely.")#error send to log if there is
-                            break
-                        f.write(chunk)
-                        bytes_received += len(chunk)
-
-                if bytes_received == filesize:#checking if file received correctly
-                    self.log_message(f"Downloaded file '{filename}' to '{self.download_dir}'.")#success
-                else:
-                    self.log_message("Error: File download incomplete.")#errors
+        for filename in filenames:
+            if filename.endswith("/"):
+                self.queue_folder_download(owner_name, filename)
             else:
-                self.log_message(f"Server error: {response}")
-        except Exception as e:
-            self.log_message(f"Error during file download: {e}")
+                self.queue_download(owner_name, filename)
+
+    def queue_download(self, owner_name, filename, size=0):#safe to call from worker threads too
+        client, directory = self.client, self.download_dir
+
+        def run(progress):
+            client.download(owner_name, filename, directory, progress)
+            return f"Downloaded file '{filename}' to '{directory}'."#success
+        self.engine.submit(f"Download {filename} from {owner_name}", run, size)
+
+    def queue_folder_download(self, owner_name, folder):#a fresh listing decides which files are in the folder
+        client = self.client
+
+        def run(progress):
+            files = client.list_files(owner_name, folder)
+            for _, filename, size in files:
+                self.queue_download(owner_name, filename, size)
+            return f"{len(files)} files of {owner_name} under '{folder}' queued for download."
+        self.engine.submit(f"List {folder} of {owner_name}", run)
 
     def delete_file(self):#delete an existing file from a server
-        if not self.client_socket:#check connection
-            self.log_message("Error: Not connected to the server.")
+        if not self.connected():
             return
         filename, ok = QInputDialog.getText(self, "Filename", "Enter filename to delete:")#filename to delete
         if ok and filename:
-            command = f"DELETE|{filename}"#delete command
-            try:
-                self.client_socket.send(command.encode())#command sent
-                response = self.client_socket.recv(1024).decode()#command received
-                self.log_message(response)
-            except Exception as e:#errors
-                self.log_message(f"Error during file deletion: {e}")
+            client = self.client
+
+            def run(progress):
+                return client.delete(filename)
+            self.engine.submit(f"Delete {filename}", run)
         else:
             self.log_message("File deletion canceled.")
 
     def enable_buttons(self):#enabling file operation buttons
         self.upload_button.setEnabled(True)
+        self.upload_folder_button.setEnabled(True)
         self.list_button.setEnabled(True)
         self.download_button.setEnabled(True)
         self.delete_button.setEnabled(True)
 
     def disable_buttons(self):#disabling file operation buttons
         self.upload_button.setEnabled(False)
+        self.upload_folder_button.setEnabled(False)
         self.list_button.setEnabled(False)
         self.download_button.setEnabled(False)
         self.delete_button.setEnabled(False)
 
-    def log_message(self, message):#displaying in log
-        self.log_box.addItem(message)
-        self.log_box.scrollToBottom()#scroll to the bottom of the log
+    def log_message(self, message):#displaying in log, safe from any thread
+        self.log_view.log(message)
+
+    def closeEvent(self, event):#stop the workers and write out what is still queued before the window goes
+        if self.client:#interrupts running transfers
+            self.client.close()
+            self.client = None
+        self.engine.stop()
+        self.log_view.close()
+        super().closeEvent(event)
 
 
 if __name__ == "__main__":#application entry
-    import sys
-    app = QApplication(sys.argv)
-    client_app = ClientApp()#client app window
+    import argparse
+    parser = argparse.ArgumentParser(description="CS408 file client window.")
+    parser.add_argument("--log-file", help="also write the log to this file, rotated by size")
+    args, qt_args = parser.parse_known_args()
+    app = QApplication(sys.argv[:1] + qt_args)
+    client_app = ClientApp(args.log_file)#client app window
     client_app.show()#show the app
     sys.exit(app.exec_())
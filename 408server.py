@@ -1,29 +1,27 @@
-import socket
-import threading#threading to handle multiple clients
-import os
-import json
 from PyQt5.QtWidgets import (#needed for GUI components
-    QApplication, QMainWindow, QPushButton, QVBoxLayout, QLabel,
+    QApplication, QMainWindow, QPushButton, QVBoxLayout, QHBoxLayout, QLabel,
     QListWidget, QFileDialog, QLineEdit, QWidget
 )
 from PyQt5.QtCore import Qt
 
+from bandwidth import NO_LIMITS, BandwidthLimits#caps the window can change while the server runs
+from logview import LogView#queued, batched log pane, safe to feed from the server thread
+from server_core import FileServer#headless asyncio server, this window is only a front end
+from statsview import StatsPanel#live counters and latencies of the running server
+
 
 class ServerApp(QMainWindow):
-    def __init__(self):#server application start
+    def __init__(self, log_file=None, metrics_port=None):#server application start
         super().__init__()
 
+        self.log_file = log_file#optional rotating file that keeps the whole log
+        self.metrics_port = metrics_port#optional local Prometheus endpoint
+        self.limits = NO_LIMITS#bandwidth caps, applied at start and whenever they are changed
         self.initUI()#user interface
-        self.server_socket = None
-        self.client_threads = []#list to track the active client threads
-        self.files = {}  # {filename: owner}
-        self.connected_clients = {}  # {client_name: client_socket}
+        self.server = None#FileServer once started
         self.directory = ""#stroing uploaded files
         self.port = 0#port num
 
-        #load previous existing files
-        self.load_files()
-
     def initUI(self):
         self.setWindowTitle("Server Application")#window title
         self.setGeometry(100, 100, 600, 500)#window properties
@@ -53,11 +51,37 @@ class ServerApp(QMainWindow):
         self.start_button.clicked.connect(self.start_server)
         layout.addWidget(self.start_button)
 
+        #statistics
+        self.stats_label = QLabel(self)
+        layout.addWidget(self.stats_label)
+        self.stats_panel = StatsPanel(self.stats_label)
+        self.profile_button = QPushButton("Start Profiler", self)
+        self.profile_button.setEnabled(False)
+        self.profile_button.clicked.connect(self.toggle_profiler)
+        layout.addWidget(self.profile_button)
+
+        #bandwidth limits
+        self.limits_label = QLabel("Bandwidth limits in MiB/s, empty for none (server in, out / per client in, out):", self)
+        layout.addWidget(self.limits_label)
+        limits_row = QHBoxLayout()
+        self.limit_inputs = []
+        for placeholder in ("server in", "server out", "client in", "client out"):
+            limit_input = QLineEdit(self)
+            limit_input.setPlaceholderText(placeholder)
+            limits_row.addWidget(limit_input)
+            self.limit_inputs.append(limit_input)
+        self.limits_button = QPushButton("Apply Limits", self)
+        self.limits_button.clicked.connect(self.apply_limits)
+        limits_row.addWidget(self.limits_button)
+        layout.addLayout(limits_row)
+
         #log
         self.log_label = QLabel("Server Logs:", self)
         layout.addWidget(self.log_label)
         self.log_box = QListWidget(self)
+        self.log_box.setUniformItemSizes(True)#lets the view skip measuring every line
         layout.addWidget(self.log_box)
+        self.log_view = LogView(self.log_box, self.log_file)
 
     def select_directory(self):#directory selection
         directory = QFileDialog.getExistingDirectory(self, "Select Directory")
@@ -71,231 +95,68 @@ class ServerApp(QMainWindow):
             return
         try:
             self.port = int(self.port_input.text())#port number
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)#TCP socket
-            self.server_socket.bind(("0.0.0.0", self.port))
-            self.server_socket.listen(5)#listens for connections
-            self.log_message(f"Server started on port {self.port}...")
-
-            #validate files in the storage directory
-            self.validate_files()
+            #the headless core owns the sockets and the file records, we only show its logs
+            self.server = FileServer(self.directory, self.port, log=self.log_message, metrics_port=self.metrics_port,
+                                     bandwidth_limits=self.limits)
+            self.server.start_in_thread()
+            self.stats_panel.watch(self.server.metrics)
+            self.profile_button.setEnabled(True)
 
             #disable inputs
             self.dir_button.setEnabled(False)
             self.port_input.setEnabled(False)
             self.start_button.setEnabled(False)
-
-            #start accepting clients
-            threading.Thread(target=self.accept_clients, daemon=True).start()
         except Exception as e:
+            self.server = None
             self.log_message(f"Error: {e}")
 
-    def validate_files(self):
-        """Synchronize the files dictionary with the actual directory contents."""
-        if not os.path.exists(self.directory):#check if directory exists
-            self.log_message("Warning: Storage directory does not exist.")
-            return
-
-        #list of files in the directory
-        actual_files = set(os.listdir(self.directory))
-        missing_files = []
-
-        #identify missing files
-        for unique_filename in list(self.files.keys()):
-            if unique_filename not in actual_files:
-                missing_files.append(unique_filename)
-
-        #remove missing files
-        for missing_file in missing_files:
-            self.log_message(f"File {missing_file} not found in directory. Removing from records.")
-            del self.files[missing_file]
-
-        #save the updated file list
-        self.save_files()
-        self.log_message("File records synchronized with the directory.")
-
-    def accept_clients(self):#accept incoming clients
-        while True:
-            client_socket, client_address = self.server_socket.accept()
-            threading.Thread(#starting a new thread for the client
-                target=self.handle_client, args=(client_socket,), daemon=True
-            ).start()
-
-    def handle_client(self, client_socket):#handle each client individually
-        try:
-            # Receive client name
-            name = client_socket.recv(1024).decode()
-            if name in self.connected_clients:#check if there is an existing name
-                client_socket.send("Error: Name already in use".encode())
-                client_socket.close()#close if there is an existing name
-                return
-
-            #add client to the connected clients list
-            self.connected_clients[name] = client_socket
-            self.log_message(f"{name} connected.")
-
-            #acknowledge connection
-            client_socket.send("Connected successfully.".encode())
-
-            #processing client commands
-            while True:
-                try:
-                    data = client_socket.recv(1024).decode()
-                    if not data:
-                        break
-
-                    #understand the command type
-                    self.log_message(f"Command from {name}: {data}")
-                    command = data.split('|')[0]
-                    if command == "UPLOAD":
-                        self.handle_upload(client_socket, name, data)
-                    elif command == "DOWNLOAD":
-                        self.handle_download(client_socket, name, data)
-                    elif command == "DELETE":
-                        self.handle_delete(client_socket, name, data)
-                    elif command == "LIST":
-                        self.handle_list(client_socket)
-                    else:
-                        client_socket.send("Error: Unknown command.".encode())
-                except Exception as inner_e:
-                    self.log_message(f"Error while processing command from {name}: {inner_e}")
-        except Exception as outer_e:
-            self.log_message(f"Error with client {name}: {outer_e}")
-        finally:
-            #cleanup on disconnection
-            if name in self.connected_clients:
-                del self.connected_clients[name]
-            client_socket.close()#close the client socket
-            self.log_message(f"{name} disconnected.")
-
-    def handle_upload(self, client_socket, client_name, data):#handling file upload
+    def apply_limits(self):#takes effect at once, transfers in progress included
         try:
-            _, filename, filesize = data.split('|')
-            filesize = int(filesize)
-            unique_filename = f"{client_name}_{filename}"#create uniwue filename for this
-            filepath = os.path.join(self.directory, unique_filename)
-
-            # Receive file data
-            with open(filepath, 'wb') as f:
-                bytes_received = 0
-                while bytes_received < filesize:#receive data
-                    chunk = client_socket.recv(4096)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    bytes_received += len(chunk)
-
-            #update file list
-            self.files[unique_filename] = client_name
-            self.save_files()#save updated file
-            self.log_message(f"{client_name} uploaded {filename}.")
-            client_socket.send("Upload successful.".encode())
-        except Exception as e:
-            client_socket.send(f"Error: {e}".encode())
-
-    def handle_download(self, client_socket, client_name, data):#handle file downloads
-        try:
-            _, owner_name, filename = data.split('|')
-            unique_filename = f"{owner_name}_{filename}"
-            if unique_filename not in self.files:#check if file exist if not error
-                client_socket.send("Error: File not found.".encode())
-                return
-            filepath = os.path.join(self.directory, unique_filename)#file path
-            filesize = os.path.getsize(filepath)
-            client_socket.send(f"DOWNLOAD|{filesize}".encode())#notfying client with the file size
-
-            #wait for ACK
-            ack = client_socket.recv(1024).decode()
-            if ack != "READY":
-                return
-
-            #send file
-            with open(filepath, 'rb') as f:
-                chunk = f.read(4096)
-                while chunk:
-                    client_socket.send(chunk)
-                    chunk = f.read(4096)
-            self.log_message(f"{client_name} downloaded {filename} from {owner_name}.")
-
-            #let owner know if connected
-            if owner_name in self.connected_clients:
-                owner_socket = self.connected_clients[owner_name]
-                owner_socket.send(f"NOTIFY|{client_name} downloaded your file {filename}.".encode())
-        except Exception as e:
-            client_socket.send(f"Error: {e}".encode())
-
-    def handle_delete(self, client_socket, client_name, data):#handle file deletion
-        try:
-            _, filename = data.split('|')
-            unique_filename = f"{client_name}_{filename}"
-            if unique_filename not in self.files:#check if file exist
-                client_socket.send("Error: File not found.".encode())#error if no file found with that name
-                return
-            filepath = os.path.join(self.directory, unique_filename)
-            os.remove(filepath)#delete file
-            del self.files[unique_filename]#remove from file record
-            self.save_files()#update the new list
-            self.log_message(f"{client_name} deleted {filename}.")
-            client_socket.send("Delete successful.".encode())#log message of success
-        except Exception as e:
-            client_socket.send(f"Error: {e}".encode())
-
-    def handle_list(self, client_socket):
-        try:
-            #construct the file list
-            file_list = []
-            for unique_filename, owner in self.files.items():
-                _, filename = unique_filename.split('_', 1)
-                file_list.append(f"{filename} (Owner: {owner})")
-            file_list_str = "\n".join(file_list)
-
-            #convert to bytes and calculate size
-            file_list_bytes = file_list_str.encode()
-            file_list_size = len(file_list_bytes)
-
-            #log the size of the file list
-            self.log_message(f"Sending file list of size: {file_list_size} bytes.")
-
-            #send the size of the file list
-            client_socket.send(f"LIST|{file_list_size}".encode())
-            self.log_message("File list size sent to client.")
-
-            #wait for ACK
-            try:
-                ack = client_socket.recv(1024).decode()
-                self.log_message(f"Received acknowledgment from client: {ack}")
-                if ack != "READY":
-                    self.log_message("Client failed to acknowledge list request.")
-                    return
-            except Exception as e:
-                self.log_message(f"Error receiving acknowledgment from client: {e}")
-                return
-
-            #send the file list data
-            try:
-                client_socket.sendall(file_list_bytes)
-                self.log_message("File list sent to client successfully.")
-            except Exception as e:
-                self.log_message(f"Error while sending file list data: {e}")
-        except Exception as e:
-            self.log_message(f"Error in handle_list: {e}")
-
-    def log_message(self, message):#messages in log
-        self.log_box.addItem(message)
-        self.log_box.scrollToBottom()#go to the last message automatically
+            rates = [float(limit_input.text() or 0) for limit_input in self.limit_inputs]
+            if min(rates) < 0:
+                raise ValueError
+        except ValueError:
+            self.log_message("Error: Bandwidth limits must be numbers, 0 or empty for none.")
+            return
+        self.limits = BandwidthLimits.from_mib(*rates)
+        if self.server is not None:
+            self.server.set_limits(self.limits)
+        described = [f"{rate:g} MiB/s" if rate else "none" for rate in rates]
+        self.log_message(f"Bandwidth limits: server in {described[0]}, out {described[1]};"
+                         f" per client in {described[2]}, out {described[3]}.")
+
+    def toggle_profiler(self):#sample the server thread, the hottest functions go to the log when stopped
+        if not self.server.profiler.running:
+            self.server.start_profiler()
+            self.profile_button.setText("Stop Profiler")
+            self.log_message("Profiler started.")
+            return
+        for line in self.server.stop_profiler().splitlines():
+            self.log_message(line)
+        self.profile_button.setText("Start Profiler")
 
-    def load_files(self):#loading files from JSON
-        if os.path.exists("files.json"):#check if file exists
-            with open("files.json", "r") as f:
-                self.files = json.load(f)#load JSON data
+    def log_message(self, message):#messages in log, called from the server thread too
+        self.log_view.log(message)
 
-    def save_files(self):#save file records to JSON
-        with open("files.json", "w") as f:
-            json.dump(self.files, f)#save JSON data
+    def closeEvent(self, event):#stop the server and write out what is still queued before the window goes
+        if self.server is not None:#cancels the client handlers and closes the loop, then the catalog
+            self.stats_panel.watch(None)#its gauges read the catalog
+            self.server.stop()
+            self.server.save_files()
+            self.server.files.close()
+            self.server = None
+        self.log_view.close()
+        super().closeEvent(event)
 
 
 if __name__ == "__main__":#starting page of app
+    import argparse
     import sys
-    app = QApplication(sys.argv)
-    server_app = ServerApp()#create server app window
+    parser = argparse.ArgumentParser(description="CS408 file server window.")
+    parser.add_argument("--log-file", help="also write the log to this file, rotated by size")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this local port")
+    args, qt_args = parser.parse_known_args()
+    app = QApplication(sys.argv[:1] + qt_args)
+    server_app = ServerApp(args.log_file, args.metrics_port)#create server app window
     server_app.show()#showing window of the app
     sys.exit(app.exec_())
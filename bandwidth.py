@@ -0,0 +1,218 @@
+"""Bandwidth scheduling of the server: rate limits and fair sharing of the bytes it moves.
+
+Bulk data (the bodies of uploads and downloads) passes token buckets: one per
+direction for the whole server and one per direction for each client name,
+shared by the client's data connections. Every connection is a Flow. When the
+server-wide cap is what holds transfers back, waiting flows are served by
+weighted fair queuing (start-time fair queuing over the bytes they ask for):
+a client moving a 10 GB file gets its weighted share and no more, and a small
+transfer next to it waits for at most one quantum of every other flow.
+
+Control traffic (LIST, DELETE, replies, notifications) never waits. Its bytes
+are taken from the buckets at once, into debt if need be, and the bulk flows
+make up for them. Bulk flows work the same way: a flow may move a quantum as
+soon as its buckets are out of debt, so a cap holds on average and is
+overshot by at most one quantum per flow.
+
+Everything here runs on the event loop; FileServer.set_limits brings limits
+set from another thread over.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import namedtuple
+
+RECEIVE = "in"
+SEND = "out"
+DIRECTIONS = (RECEIVE, SEND)
+QUANTUM = 256 << 10#bytes a limited flow moves per grant
+BURST = 0.25#seconds of its rate an idle bucket saves up, at least one quantum
+MIB = 1 << 20
+
+
+class BandwidthLimits(namedtuple("BandwidthLimits", "rate_in rate_out client_in client_out")):
+    """Caps in bytes per second, None for none: the server's and each client's, in and out."""
+    __slots__ = ()
+
+    @classmethod
+    def from_mib(cls, *rates):#MiB/s as the command line and the server window take them, 0 for none
+        return cls(*(int(rate * MIB) if rate else None for rate in rates))
+
+    def mib(self):#back to MiB/s, 0 for none
+        return [rate / MIB if rate else 0 for rate in self]
+
+
+NO_LIMITS = BandwidthLimits(None, None, None, None)
+
+
+class TokenBucket:
+    def __init__(self, rate=None):
+        self.rate = None
+        self.tokens = 0.0#bytes that may go now, negative while in debt
+        self.stamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):#bytes per second, None for no limit
+        self.refill()
+        self.rate = rate or None
+        self.tokens = min(self.tokens, self.capacity) if self.rate is not None else 0.0
+
+    @property
+    def capacity(self):
+        return max(self.rate * BURST, QUANTUM)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.tokens + (now - self.stamp) * self.rate, self.capacity)
+        self.stamp = now
+
+    def delay(self):#seconds until the bucket is out of debt
+        if self.rate is None:
+            return 0.0
+        self.refill()
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def take(self, count):
+        if self.rate is not None:
+            self.refill()
+            self.tokens -= count
+
+
+class FairQueue:
+    """Grants of one server-wide bucket, handed out by virtual start time of the waiting flows."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.waiting = []#heap of (start tag, sequence, future, bytes)
+        self.virtual = 0.0#start tag of the last grant
+        self.sequence = itertools.count()
+        self.timer = None
+
+    async def acquire(self, flow, direction, count):
+        start = max(self.virtual, flow.finish[direction])
+        flow.finish[direction] = start + count / flow.weight
+        if not self.waiting and not self.bucket.delay():
+            self.grant(start, count)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (start, next(self.sequence), future, count))
+        self.dispatch()
+        await future
+
+    def grant(self, start, count):
+        self.virtual = start
+        self.bucket.take(count)
+
+    def dispatch(self):#serve the queue head while the bucket allows, then sleep until it does again
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.waiting:
+            start, _, future, count = self.waiting[0]
+            if future.done():#cancelled, its connection went away
+                heapq.heappop(self.waiting)
+                continue
+            delay = self.bucket.delay()
+            if delay:
+                self.timer = asyncio.get_running_loop().call_later(delay, self.dispatch)
+                return
+            heapq.heappop(self.waiting)
+            self.grant(start, count)
+            future.set_result(None)
+
+
+class _Client:#buckets shared by the connections of one client name
+    __slots__ = ("buckets", "flows")
+
+    def __init__(self, rates):
+        self.buckets = {direction: TokenBucket(rates[direction]) for direction in DIRECTIONS}
+        self.flows = 0
+
+
+class Flow:
+    """One connection's way through the scheduler. bulk is set while it serves a bulk request."""
+
+    def __init__(self, scheduler, name, client):
+        self.scheduler = scheduler
+        self.name = name
+        self.client = client
+        self.finish = dict.fromkeys(DIRECTIONS, 0.0)#virtual finish tag of its last grant, per direction
+        self.bulk = False
+
+    @property
+    def weight(self):
+        return self.scheduler.weights.get(self.name, 1)
+
+    def limited(self, direction):
+        return self.scheduler.buckets[direction].rate is not None or self.client.buckets[direction].rate is not None
+
+    async def take(self, direction, count):#returns once count bytes may move, at once for control traffic
+        if not self.limited(direction):
+            return
+        bucket = self.client.buckets[direction]
+        if not self.bulk:
+            bucket.take(count)
+            self.scheduler.buckets[direction].take(count)
+            return
+        started = time.monotonic()
+        delay = bucket.delay()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = bucket.delay()
+        bucket.take(count)
+        await self.scheduler.queues[direction].acquire(self, direction, count)
+        self.scheduler.waited += time.monotonic() - started
+
+    def close(self):#the connection is gone
+        self.scheduler.release(self.name, self.client)
+
+
+class BandwidthScheduler:
+    """Token buckets and fair queues of one server; flow(name) for every connection once its client is known."""
+
+    def __init__(self, limits=NO_LIMITS):
+        self.buckets = {direction: TokenBucket() for direction in DIRECTIONS}
+        self.queues = {direction: FairQueue(self.buckets[direction]) for direction in DIRECTIONS}
+        self.client_rates = dict.fromkeys(DIRECTIONS)
+        self.weights = {}#client name -> weight in the fair queues, 1 for the others
+        self.clients = {}#client name -> _Client, while it has connections
+        self.waited = 0.0#seconds bulk requests spent waiting for bandwidth, all flows together
+        self.set_limits(limits)
+
+    @property
+    def limits(self):
+        return BandwidthLimits(self.buckets[RECEIVE].rate, self.buckets[SEND].rate,
+                               self.client_rates[RECEIVE], self.client_rates[SEND])
+
+    def set_limits(self, limits):#takes effect at once, for transfers in progress too
+        limits = BandwidthLimits(*limits)
+        self.buckets[RECEIVE].set_rate(limits.rate_in)
+        self.buckets[SEND].set_rate(limits.rate_out)
+        self.client_rates = {RECEIVE: limits.client_in or None, SEND: limits.client_out or None}
+        for client in self.clients.values():
+            for direction in DIRECTIONS:
+                client.buckets[direction].set_rate(self.client_rates[direction])
+        for queue in self.queues.values():
+            queue.dispatch()
+
+    def set_weight(self, name, weight):#share of the client when the server cap is the bottleneck
+        if weight <= 0:
+            raise ValueError("Weight must be positive.")
+        self.weights[name] = weight
+
+    def flow(self, name):
+        client = self.clients.get(name)
+        if client is None:
+            client = self.clients[name] = _Client(self.client_rates)
+        client.flows += 1
+        return Flow(self, name, client)
+
+    def release(self, name, client):
+        client.flows -= 1
+        if not client.flows and self.clients.get(name) is client:
+            del self.clients[name]
+
+    def waiting(self):#bulk grants queued behind the server cap
+        return sum(len(queue.waiting) for queue in self.queues.values())
@@ -0,0 +1,178 @@
+"""The original server loop, kept as a benchmark baseline: one thread per client, 4 KiB copies.
+
+This is the request handling of the first ServerApp without the window: the
+text protocol read with recv(1024), uploads received and downloads sent 4096
+bytes at a time, files stored whole and files.json rewritten after every
+change. Its shortcomings (listen backlog of 5, unsynchronized client table,
+notifications written from other threads) are kept on purpose, they are part
+of what is being measured. Two changes: log lines are discarded (the window
+used to show them), and a reset connection ends its thread instead of
+spinning on the error forever. Example:
+
+    python benchmarks/baseline_server.py /tmp/store 5000
+"""
+import argparse
+import json
+import os
+import socket
+import threading
+
+
+class BaselineServer:
+    def __init__(self, directory, port, host="127.0.0.1"):
+        self.directory = directory
+        self.port = port
+        self.host = host
+        self.files = {}#unique_filename -> owner
+        self.connected_clients = {}#client name -> socket
+        self.json_path = os.path.join(directory, "files.json")
+        self.server_socket = None
+
+    def serve_forever(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)#TCP socket
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(5)#listens for connections
+        while True:
+            client_socket, client_address = self.server_socket.accept()
+            threading.Thread(#starting a new thread for the client
+                target=self.handle_client, args=(client_socket,), daemon=True
+            ).start()
+
+    def handle_client(self, client_socket):#handle each client individually
+        name = None
+        try:
+            name = client_socket.recv(1024).decode()
+            if name in self.connected_clients:#check if there is an existing name
+                client_socket.send("Error: Name already in use".encode())
+                client_socket.close()
+                return
+            self.connected_clients[name] = client_socket
+            self.log_message(f"{name} connected.")
+            client_socket.send("Connected successfully.".encode())
+
+            while True:
+                try:
+                    data = client_socket.recv(1024).decode()
+                    if not data:
+                        break
+                    self.log_message(f"Command from {name}: {data}")
+                    command = data.split('|')[0]
+                    if command == "UPLOAD":
+                        self.handle_upload(client_socket, name, data)
+                    elif command == "DOWNLOAD":
+                        self.handle_download(client_socket, name, data)
+                    elif command == "DELETE":
+                        self.handle_delete(client_socket, name, data)
+                    elif command == "LIST":
+                        self.handle_list(client_socket)
+                    else:
+                        client_socket.send("Error: Unknown command.".encode())
+                except ConnectionError:
+                    break
+                except Exception as inner_e:
+                    self.log_message(f"Error while processing command from {name}: {inner_e}")
+        except Exception as outer_e:
+            self.log_message(f"Error with client {name}: {outer_e}")
+        finally:
+            if self.connected_clients.get(name) is client_socket:
+                del self.connected_clients[name]
+            client_socket.close()
+            self.log_message(f"{name} disconnected.")
+
+    def handle_upload(self, client_socket, client_name, data):
+        try:
+            _, filename, filesize = data.split('|')
+            filesize = int(filesize)
+            unique_filename = f"{client_name}_{filename}"
+            filepath = os.path.join(self.directory, unique_filename)
+            with open(filepath, 'wb') as f:
+                bytes_received = 0
+                while bytes_received < filesize:
+                    chunk = client_socket.recv(4096)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    bytes_received += len(chunk)
+            self.files[unique_filename] = client_name
+            self.save_files()
+            self.log_message(f"{client_name} uploaded {filename}.")
+            client_socket.send("Upload successful.".encode())
+        except Exception as e:
+            client_socket.send(f"Error: {e}".encode())
+
+    def handle_download(self, client_socket, client_name, data):
+        try:
+            _, owner_name, filename = data.split('|')
+            unique_filename = f"{owner_name}_{filename}"
+            if unique_filename not in self.files:
+                client_socket.send("Error: File not found.".encode())
+                return
+            filepath = os.path.join(self.directory, unique_filename)
+            filesize = os.path.getsize(filepath)
+            client_socket.send(f"DOWNLOAD|{filesize}".encode())
+            ack = client_socket.recv(1024).decode()
+            if ack != "READY":
+                return
+            with open(filepath, 'rb') as f:
+                chunk = f.read(4096)
+                while chunk:
+                    client_socket.send(chunk)
+                    chunk = f.read(4096)
+            self.log_message(f"{client_name} downloaded {filename} from {owner_name}.")
+            if owner_name in self.connected_clients:
+                owner_socket = self.connected_clients[owner_name]
+                owner_socket.send(f"NOTIFY|{client_name} downloaded your file {filename}.".encode())
+        except Exception as e:
+            client_socket.send(f"Error: {e}".encode())
+
+    def handle_delete(self, client_socket, client_name, data):
+        try:
+            _, filename = data.split('|')
+            unique_filename = f"{client_name}_{filename}"
+            if unique_filename not in self.files:
+                client_socket.send("Error: File not found.".encode())
+                return
+            os.remove(os.path.join(self.directory, unique_filename))
+            del self.files[unique_filename]
+            self.save_files()
+            self.log_message(f"{client_name} deleted {filename}.")
+            client_socket.send("Delete successful.".encode())
+        except Exception as e:
+            client_socket.send(f"Error: {e}".encode())
+
+    def handle_list(self, client_socket):
+        try:
+            file_list = []
+            for unique_filename, owner in list(self.files.items()):
+                _, filename = unique_filename.split('_', 1)
+                file_list.append(f"{filename} (Owner: {owner})")
+            file_list_bytes = "\n".join(file_list).encode()
+            self.log_message(f"Sending file list of size: {len(file_list_bytes)} bytes.")
+            client_socket.send(f"LIST|{len(file_list_bytes)}".encode())
+            ack = client_socket.recv(1024).decode()
+            if ack != "READY":
+                return
+            client_socket.sendall(file_list_bytes)
+        except Exception as e:
+            self.log_message(f"Error in handle_list: {e}")
+
+    def log_message(self, message):
+        pass
+
+    def save_files(self):
+        with open(self.json_path, "w") as f:
+            json.dump(self.files, f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("port", type=int)
+    parser.add_argument("-b", "--bind", default="127.0.0.1")
+    args = parser.parse_args(argv)
+    BaselineServer(args.directory, args.port, args.bind).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
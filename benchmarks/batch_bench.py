@@ -0,0 +1,158 @@
+"""Many small files over a link with latency: one request per file vs pipelined requests vs BATCH.
+
+Starts a FileServer on a temporary directory and puts a proxy in front of it
+that delays every packet by half of --rtt in each direction. Then --files
+files of --size bytes are uploaded, downloaded and deleted with FileClient
+three ways:
+
+  * single     one call per file, each waits for its reply (what the window does per file)
+  * pipelined  *_many against a server without BATCH, BATCH_WINDOW requests in flight
+  * batch      *_many with BATCH requests, one round trip per batch
+
+Example:
+
+    python benchmarks/batch_bench.py --files 2000 --size 4K --rtt 20 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchutil import free_port, parse_size  # noqa: E402
+from fileclient import FileClient  # noqa: E402
+from server_core import FileServer  # noqa: E402
+
+MODES = ("single", "pipelined", "batch")
+
+
+class DelayProxy:
+    """TCP proxy that holds every piece of data for delay seconds before passing it on, in order."""
+
+    def __init__(self, port, target_port, delay):
+        self.port = port
+        self.target_port = target_port
+        self.delay = delay
+        self.loop = asyncio.new_event_loop()
+
+    def start(self):
+        ready = threading.Event()
+
+        def runner():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(asyncio.start_server(self.serve, "127.0.0.1", self.port))
+            ready.set()
+            self.loop.run_forever()
+        threading.Thread(target=runner, daemon=True).start()
+        ready.wait()
+
+    async def serve(self, reader, writer):
+        target_reader, target_writer = await asyncio.open_connection("127.0.0.1", self.target_port)
+        await asyncio.gather(self.pipe(reader, target_writer), self.pipe(target_reader, writer))
+
+    async def pipe(self, reader, writer):
+        while True:
+            data = await reader.read(1 << 20)
+            if not data:
+                break
+            self.loop.call_later(self.delay, writer.write, data)#same delay for every piece keeps them in order
+        await asyncio.sleep(self.delay)
+        writer.close()
+
+
+def run_mode(mode, host, port, paths, directory):#seconds per phase
+    name = f"bench_{mode}"
+    with FileClient(host, port, name) as client:
+        if mode == "pipelined":
+            client.batch_limit = 0#as if the server had no BATCH
+        names = [os.path.basename(path) for path in paths]
+        timings = {}
+        start = time.perf_counter()
+        if mode == "single":
+            for path in paths:
+                client.upload(path)
+        else:
+            check(client.upload_many(paths))
+        timings["upload"] = time.perf_counter() - start
+
+        client.list_files()#sizes for the downloads, outside the timing
+        start = time.perf_counter()
+        if mode == "single":
+            for filename in names:
+                client.download(name, filename, directory)
+        else:
+            check(client.download_many([(name, filename) for filename in names], directory))
+        timings["download"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if mode == "single":
+            for filename in names:
+                client.delete(filename)
+        else:
+            check(client.delete_many(names))
+        timings["delete"] = time.perf_counter() - start
+    return timings
+
+
+def check(results):
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(f"{len(failed)} items failed, first: {failed[0]}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size", default="4K", help="bytes per file, K and M suffixes work")
+    parser.add_argument("--rtt", type=float, default=20.0, help="round trip time the proxy adds, in ms")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"comma separated, from {', '.join(MODES)}")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args(argv)
+    size = parse_size(args.size)
+
+    result = {"files": args.files, "size": size, "rtt_ms": args.rtt, "seconds": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        store, source, target = (os.path.join(tmp, part) for part in ("store", "source", "target"))
+        for directory in (store, source, target):
+            os.makedirs(directory)
+        paths = []
+        for i in range(args.files):
+            path = os.path.join(source, f"file_{i:06d}.bin")
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+            paths.append(path)
+
+        port, proxy_port = free_port(), free_port()
+        server = FileServer(store, port, "127.0.0.1", log=lambda message: None,
+                            catalog_path=os.path.join(tmp, "files.db"))
+        server.start_in_thread()
+        DelayProxy(proxy_port, port, args.rtt / 2000).start()
+        for mode in args.modes.split(","):
+            result["seconds"][mode] = run_mode(mode, "127.0.0.1", proxy_port, paths, target)
+            shutil.rmtree(target)
+            os.makedirs(target)
+        server.stop()
+
+    baseline = result["seconds"].get("single")
+    if baseline:
+        result["speedup"] = {mode: {phase: round(baseline[phase] / seconds, 1) for phase, seconds in timings.items()}
+                             for mode, timings in result["seconds"].items() if mode != "single"}
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"{args.files} files of {size} bytes, {args.rtt:g} ms round trip")
+        for mode, timings in result["seconds"].items():
+            line = "  ".join(f"{phase} {seconds:7.2f}s" for phase, seconds in timings.items())
+            speedup = result.get("speedup", {}).get(mode)
+            extra = "  (" + ", ".join(f"{phase} x{factor}" for phase, factor in speedup.items()) + ")" if speedup else ""
+            print(f"{mode:<10} {line}{extra}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
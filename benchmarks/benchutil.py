@@ -0,0 +1,17 @@
+"""Helpers shared by the benchmark scripts in this directory."""
+import socket
+
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):#"64K", "1.5M", "2G" or a plain byte count
+    text = str(text).strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def free_port():#a local TCP port nothing listens on right now
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
@@ -0,0 +1,86 @@
+"""Many clients, one file: downloads with the hot-file cache off and on.
+
+For each --sizes file size a server process is started twice, with
+--hot-cache 0 and with the default cache. A seed client uploads one file, then
+--clients clients each download it --count times over the framed protocol, all
+at once. Reported per run: downloads/s, MB/s, latency p50/p99 and the server's
+CPU time per download, plus the speedup the cache gives. Example:
+
+    python benchmarks/hot_file_bench.py --clients 50 --count 40 --sizes 64K,1M,8M --json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchutil import parse_size  # noqa: E402
+from load_suite import ServerProcess, run_clients, summarize  # noqa: E402
+
+MODES = {"uncached": ["--hot-cache", "0"], "cached": []}
+
+
+def run_mode(mode, size, clients, count):
+    ops = [{"client": "seed", "op": "upload", "filename": "hot.bin", "size": size}]
+    downloads = [{"client": f"client{i:04d}", "op": "download", "owner": "seed", "filename": "hot.bin"}
+                 for i in range(clients) for _ in range(count)]
+    with tempfile.TemporaryDirectory() as directory:
+        server = ServerProcess("framed", directory, MODES[mode])
+        try:
+            run_clients("framed", server.port, ops)
+            cpu_before = server.cpu_seconds()
+            samples, wall = run_clients("framed", server.port, downloads)
+            cpu_after = server.cpu_seconds()
+        finally:
+            server.stop()
+    commands, errors = summarize(samples, wall)
+    numbers = commands["download"]
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return {
+        "downloads": numbers["count"],
+        "errors": len(errors),
+        "wall_s": round(wall, 3),
+        "downloads_per_s": numbers["ops_per_s"],
+        "mb_per_s": numbers["mb_per_s"],
+        "p50_ms": numbers["p50_ms"],
+        "p99_ms": numbers["p99_ms"],
+        "server_cpu_ms_per_download": round(1000 * cpu / numbers["count"], 3) if cpu is not None else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--count", type=int, default=40, help="downloads per client")
+    parser.add_argument("--sizes", default="64K,1M,8M", help="comma separated file sizes, K and M suffixes work")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args(argv)
+
+    result = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "clients": args.clients, "count": args.count, "runs": []}
+    for text in args.sizes.split(","):
+        size = parse_size(text)
+        run = {"size": size}
+        for mode in MODES:
+            run[mode] = run_mode(mode, size, args.clients, args.count)
+        base, cached = run["uncached"], run["cached"]
+        if base["downloads_per_s"] and cached["downloads_per_s"]:
+            run["speedup"] = round(cached["downloads_per_s"] / base["downloads_per_s"], 2)
+        result["runs"].append(run)
+        if not args.json:
+            print(f"{size} bytes, {args.clients} clients x {args.count} downloads")
+            for mode in MODES:
+                numbers = run[mode]
+                print(f"  {mode:<9} {numbers['downloads_per_s']:>9} downloads/s {numbers['mb_per_s']:>9} MB/s"
+                      f"  p50 {numbers['p50_ms']} ms  p99 {numbers['p99_ms']} ms"
+                      f"  server cpu {numbers['server_cpu_ms_per_download']} ms/download  errors {numbers['errors']}")
+            if "speedup" in run:
+                print(f"  cache speedup x{run['speedup']}")
+    if args.json:
+        print(json.dumps(result))
+    return 1 if any(run[mode]["errors"] for run in result["runs"] for mode in MODES) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,500 @@
+"""Load generator and benchmark harness: replays workloads against a headless server and reports per-command numbers.
+
+A workload is JSON lines, one operation each (the same shape as
+benchmarks/workloads/example.jsonl):
+
+    {"client": "alice", "op": "upload", "filename": "a.txt", "size": 4096}
+    {"client": "bob", "op": "download", "owner": "alice", "filename": "a.txt", "at": 0.5}
+    {"client": "bob", "op": "list"}
+    {"client": "alice", "op": "delete", "filename": "a.txt"}
+
+Every client gets its own connection and runs its operations in order, all
+clients at once; "at" (seconds from the start) holds an operation back until
+then. Operations with "phase": "setup" run first and are not measured. Built-in
+synthetic mixes (--mix) generate workloads of the same form:
+
+    small-uploads    --clients clients upload --count files of --small-size each
+    large-downloads  a seed client uploads --large-count files of --large-size, --clients clients download all of them
+    list-storm       --files files in the catalog, --clients clients send --count LIST each
+    concurrent       --clients clients, each --count random uploads, downloads, lists and deletes
+
+Each target is started as its own process on a fresh directory:
+
+    framed    server_core.py, framed protocol
+    text      server_core.py, original text protocol
+    baseline  benchmarks/baseline_server.py, the original thread-per-client server with 4 KiB copies
+
+--workers runs the server_core targets once per worker count (--workers N
+on the server command line), to see how throughput scales with processes.
+
+Reported per target and workload: throughput (operations/s, MB/s), latency
+p50/p99/max per command, errors, and the server's CPU time and resident memory
+(from /proc, summed over its worker processes, so Linux only; null elsewhere). --output writes the JSON result,
+to compare runs over time. The text protocol has no framing, so an upload
+command the server reads together with its first data bytes is never
+answered; the suite waits a moment before sending upload data, but the odd
+"timed out" error on the text and baseline targets is that, not a hang.
+Example:
+
+    python benchmarks/load_suite.py --mix small-uploads,list-storm --targets framed,baseline --clients 50
+"""
+import argparse
+import json
+import os
+import random
+import re
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from benchutil import free_port, parse_size  # noqa: E402
+import protocol  # noqa: E402
+
+TARGETS = ("framed", "text", "baseline")
+MIXES = ("small-uploads", "large-downloads", "list-storm", "concurrent")
+OP_TIMEOUT = 30#seconds, a stalled operation counts as an error instead of hanging the run
+START_TIMEOUT = 15#seconds for a server process to accept connections
+SEND_BLOCK = 1 << 20#upload data is sent from one random block, repeated
+TEXT_PAUSE = 0.02#seconds between a text command and its data: unframed, a server that reads late would see both as one command (not timed)
+RESPONSE = re.compile(r"(Connected successfully\.|Upload successful\.|Delete successful\.|Error: .*|"
+                      r"DOWNLOAD\|\d+|LIST\|\d+)$")
+
+
+def percentile(sorted_values, share):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(share * len(sorted_values)))]
+
+
+#workloads
+
+def load_workload(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def mix_workload(mix, args, rng):
+    ops = []
+    clients = [f"client{i:04d}" for i in range(args.clients)]
+    if mix == "small-uploads":
+        for name in clients:
+            ops += [{"client": name, "op": "upload", "filename": f"small{i}.bin", "size": args.small_size}
+                    for i in range(args.count)]
+    elif mix == "large-downloads":
+        names = [f"large{i}.bin" for i in range(args.large_count)]
+        ops += [{"client": "seed", "op": "upload", "filename": filename, "size": args.large_size, "phase": "setup"}
+                for filename in names]
+        for name in clients:
+            ops += [{"client": name, "op": "download", "owner": "seed", "filename": filename}
+                    for filename in rng.sample(names, len(names))]
+    elif mix == "list-storm":
+        ops += [{"client": "seed", "op": "upload", "filename": f"listed{i}.txt", "size": 64, "phase": "setup"}
+                for i in range(args.files)]
+        for name in clients:
+            ops += [{"client": name, "op": "list"} for _ in range(args.count)]
+    elif mix == "concurrent":
+        shared = [f"shared{i}.bin" for i in range(20)]
+        ops += [{"client": "seed", "op": "upload", "filename": filename, "size": args.small_size, "phase": "setup"}
+                for filename in shared]
+        for name in clients:
+            mine = []
+            for i in range(args.count):
+                choice = rng.random()
+                if choice < 0.35 or not mine:
+                    mine.append(f"own{i}.bin")
+                    ops.append({"client": name, "op": "upload", "filename": mine[-1], "size": args.small_size})
+                elif choice < 0.7:#files of the seed, whose owner is gone: no notifications to race with
+                    ops.append({"client": name, "op": "download", "owner": "seed", "filename": rng.choice(shared)})
+                elif choice < 0.85:
+                    ops.append({"client": name, "op": "list"})
+                else:
+                    ops.append({"client": name, "op": "delete", "filename": mine.pop(rng.randrange(len(mine)))})
+    else:
+        raise ValueError(f"unknown mix {mix}")
+    return ops
+
+
+#clients, one blocking connection each
+
+class TextConnection:
+    """The original text protocol: commands and replies are single recv(1024) messages."""
+
+    def __init__(self, host, port, name):
+        self.sock = socket.create_connection((host, port), OP_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(name.encode())
+        reply = self.response()
+        if reply != "Connected successfully.":
+            raise ConnectionError(reply)
+
+    def response(self):#next reply, notifications in front of it skipped
+        while True:
+            data = self.sock.recv(1024).decode(errors="replace")
+            if not data:
+                raise ConnectionError("Connection closed by server")
+            match = RESPONSE.search(data)
+            if match:
+                return match.group(1)
+            if not data.startswith("NOTIFY|"):
+                raise ConnectionError(f"Unexpected reply {data[:80]!r}")
+
+    def upload(self, filename, size, paused):
+        self.sock.sendall(f"UPLOAD|{filename}|{size}".encode())
+        paused(TEXT_PAUSE)
+        send_payload(self.sock, size)
+        reply = self.response()
+        if reply.startswith("Error"):
+            raise RuntimeError(reply)
+        return size
+
+    def download(self, owner, filename):
+        self.sock.sendall(f"DOWNLOAD|{owner}|{filename}".encode())
+        return self.payload(self.response())
+
+    def list(self):
+        self.sock.sendall(b"LIST")
+        return self.payload(self.response())
+
+    def delete(self, filename):
+        self.sock.sendall(f"DELETE|{filename}".encode())
+        reply = self.response()
+        if reply.startswith("Error"):
+            raise RuntimeError(reply)
+        return 0
+
+    def payload(self, reply):#after COMMAND|size: READY, then exactly size bytes
+        if reply.startswith("Error"):
+            raise RuntimeError(reply)
+        size = int(reply.split("|")[1])
+        self.sock.sendall(b"READY")
+        return recv_discard(self.sock, size)
+
+    def close(self):
+        self.sock.close()
+
+
+class FramedConnection:
+    """The framed protocol, one request in flight; NOTIFY frames are skipped."""
+
+    def __init__(self, host, port, name):
+        self.sock = socket.create_connection((host, port), OP_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(protocol.PREFACE)
+        protocol.recv_exact(self.sock, len(protocol.PREFACE))
+        self.request_id = 0
+        reply = self.request(protocol.HELLO, {"name": name})
+        if reply.type != protocol.OK:
+            raise ConnectionError(reply.meta.get("message"))
+
+    def request(self, frame_type, meta, body_len=0, body=None):
+        self.request_id += 1
+        self.sock.sendall(protocol.encode_header(frame_type, self.request_id, meta, body_len))
+        if body is not None:
+            body()
+        while True:
+            frame = protocol.recv_frame(self.sock)
+            if frame.request_id == self.request_id and frame.type != protocol.NOTIFY:
+                return frame
+            recv_discard(self.sock, frame.body_len)
+
+    def checked(self, frame):
+        if frame.type != protocol.OK:
+            recv_discard(self.sock, frame.body_len)
+            raise RuntimeError(frame.meta.get("message"))
+        return recv_discard(self.sock, frame.body_len)
+
+    def upload(self, filename, size, paused):
+        self.checked(self.request(protocol.UPLOAD, {"filename": filename}, size, lambda: send_payload(self.sock, size)))
+        return size
+
+    def download(self, owner, filename):
+        return self.checked(self.request(protocol.DOWNLOAD, {"owner": owner, "filename": filename}))
+
+    def list(self):
+        return self.checked(self.request(protocol.LIST, {}))
+
+    def delete(self, filename):
+        self.checked(self.request(protocol.DELETE, {"filename": filename}))
+        return 0
+
+    def close(self):
+        self.sock.close()
+
+
+PAYLOAD = os.urandom(SEND_BLOCK)
+
+
+def send_payload(sock, size):
+    view = memoryview(PAYLOAD)
+    while size:
+        n = min(size, len(view))
+        sock.sendall(view[:n])
+        size -= n
+
+
+def recv_discard(sock, size):
+    buf = bytearray(min(size, 1 << 20) or 1)
+    left = size
+    while left:
+        n = sock.recv_into(buf, min(left, len(buf)))
+        if not n:
+            raise ConnectionError("Connection closed by server")
+        left -= n
+    return size
+
+
+#one run: a server process, the clients, the measurements
+
+class ServerProcess:
+    def __init__(self, target, directory, extra_args=()):#extra_args go to server_core.py
+        self.port = free_port()
+        if target == "baseline":
+            command = [sys.executable, os.path.join(ROOT, "benchmarks", "baseline_server.py"), directory, str(self.port)]
+        else:
+            command = [sys.executable, os.path.join(ROOT, "server_core.py"), directory, "-p", str(self.port),
+                       "-b", "127.0.0.1", "--catalog", os.path.join(directory, "files.db"), *extra_args]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=directory)
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"{target} server did not start")
+                time.sleep(0.05)
+
+    def cpu_seconds(self):#user + system time so far of the server and its workers, None where /proc is missing
+        try:
+            total = 0
+            for pid in process_tree(self.process.pid):
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            return total / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def memory(self):#(resident bytes now, peak resident bytes) summed over the processes, None where /proc is missing
+        values = {}
+        for pid in process_tree(self.process.pid):
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        key, _, value = line.partition(":")
+                        if key in ("VmRSS", "VmHWM"):
+                            values[key] = values.get(key, 0) + int(value.split()[0]) * 1024
+            except OSError:
+                pass
+        return values.get("VmRSS"), values.get("VmHWM")
+
+    def stop(self):
+        for pid in process_tree(self.process.pid)[1:]:#workers first, they would outlive the coordinator for a moment
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.kill()
+        self.process.wait()
+
+
+def process_tree(pid):#pid and its descendants; only pid where /proc is missing
+    children = {}
+    try:
+        entries = [entry for entry in os.listdir("/proc") if entry.isdigit()]
+    except OSError:
+        return [pid]
+    for entry in entries:
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree = [pid]
+    for member in tree:#grows while it is walked
+        tree += children.get(member, [])
+    return tree
+
+
+def run_clients(target, port, ops):#[(op, seconds, bytes, error)] of every operation, plus the wall time
+    connection_class = TextConnection if target in ("text", "baseline") else FramedConnection
+    by_client = {}
+    for op in ops:
+        by_client.setdefault(op["client"], []).append(op)
+    samples = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def client(name, client_ops):
+        paused_total = [0.0]
+
+        def paused(seconds):#time the client waits on purpose, taken out of the latency
+            time.sleep(seconds)
+            paused_total[0] += seconds
+        own = []
+        connection = None
+        for op in client_ops:
+            if "at" in op:
+                time.sleep(max(0.0, start + float(op["at"]) - time.perf_counter()))
+            paused_total[0] = 0.0
+            began = time.perf_counter()
+            error, count = None, 0
+            try:
+                if connection is None:
+                    connection = connection_class("127.0.0.1", port, name)
+                kind = op["op"]
+                if kind == "upload":
+                    count = connection.upload(op["filename"], parse_size(op.get("size", 0)), paused)
+                elif kind == "download":
+                    count = connection.download(op.get("owner", name), op["filename"])
+                elif kind == "list":
+                    count = connection.list()
+                elif kind == "delete":
+                    count = connection.delete(op["filename"])
+                else:
+                    raise ValueError(f"unknown operation {kind}")
+            except (OSError, RuntimeError, ValueError, KeyError, protocol.ProtocolError) as e:
+                error = str(e) or type(e).__name__
+                if isinstance(e, (OSError, protocol.ProtocolError)) and connection is not None:
+                    connection.close()#out of step now, the next operation reconnects
+                    connection = None
+            own.append((op["op"], time.perf_counter() - began - paused_total[0], count, error))
+        if connection is not None:
+            connection.close()
+        with lock:
+            samples.extend(own)
+
+    threads = [threading.Thread(target=client, args=item, daemon=True) for item in by_client.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+
+def summarize(samples, wall):
+    commands = {}
+    for kind in sorted({sample[0] for sample in samples}):
+        mine = [sample for sample in samples if sample[0] == kind]
+        latencies = sorted(seconds * 1000 for _, seconds, _, error in mine if error is None)
+        commands[kind] = {
+            "count": len(mine),
+            "errors": sum(error is not None for *_, error in mine),
+            "ops_per_s": round(len(latencies) / wall, 1) if wall else None,
+            "mb_per_s": round(sum(count for _, _, count, error in mine if error is None) / wall / 1e6, 2) if wall else None,
+            "p50_ms": round(percentile(latencies, 0.50), 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99), 2) if latencies else None,
+            "mean_ms": round(statistics.fmean(latencies), 2) if latencies else None,
+            "max_ms": round(latencies[-1], 2) if latencies else None,
+        }
+    errors = [error for *_, error in samples if error is not None]
+    return commands, errors
+
+
+def run_one(target, name, ops, workers=1):
+    with tempfile.TemporaryDirectory() as directory:
+        server = ServerProcess(target, directory, ["--workers", str(workers)] if workers > 1 else ())
+        try:
+            setup = [op for op in ops if op.get("phase") == "setup"]
+            measured = [op for op in ops if op.get("phase") != "setup"]
+            if setup:
+                run_clients(target, server.port, setup)
+            cpu_before = server.cpu_seconds()
+            samples, wall = run_clients(target, server.port, measured)
+            cpu_after = server.cpu_seconds()
+            rss, peak_rss = server.memory()
+        finally:
+            server.stop()
+    commands, errors = summarize(samples, wall)
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    ok = len(samples) - len(errors)
+    return {
+        "target": target,
+        "workers": workers,
+        "workload": name,
+        "clients": len({op["client"] for op in measured}),
+        "operations": len(samples),
+        "errors": len(errors),
+        "first_errors": sorted(set(errors))[:5],
+        "wall_s": round(wall, 3),
+        "ops_per_s": round(ok / wall, 1) if wall else None,
+        "mb_per_s": round(sum(c["mb_per_s"] or 0 for c in commands.values()), 2),
+        "server_cpu_s": round(cpu, 3) if cpu is not None else None,
+        "server_cpu_percent": round(100 * cpu / wall, 1) if cpu is not None and wall else None,
+        "server_rss_mb": round(rss / 1e6, 1) if rss else None,
+        "server_peak_rss_mb": round(peak_rss / 1e6, 1) if peak_rss else None,
+        "commands": commands,
+    }
+
+
+def print_result(result):
+    workers = f" x{result['workers']}" if result["workers"] > 1 else ""
+    print(f"{result['workload']} on {result['target']}{workers}: {result['operations']} ops by {result['clients']} clients"
+          f" in {result['wall_s']:.2f}s, {result['ops_per_s']} ops/s, {result['mb_per_s']} MB/s,"
+          f" {result['errors']} errors; server cpu {result['server_cpu_s']}s ({result['server_cpu_percent']}%),"
+          f" rss {result['server_rss_mb']} MB (peak {result['server_peak_rss_mb']} MB)")
+    for kind, numbers in result["commands"].items():
+        print(f"    {kind:<9} n={numbers['count']:<6} ops/s={numbers['ops_per_s']:<8} MB/s={numbers['mb_per_s']:<8}"
+              f" p50={numbers['p50_ms']}ms p99={numbers['p99_ms']}ms max={numbers['max_ms']}ms errors={numbers['errors']}")
+    for error in result["first_errors"]:
+        print(f"    error: {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", action="append", default=[], help="JSON lines workload file (repeatable)")
+    parser.add_argument("--mix", default="", help=f"comma separated synthetic mixes: {', '.join(MIXES)}")
+    parser.add_argument("--targets", default="framed,baseline", help=f"comma separated, from {', '.join(TARGETS)}")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--count", type=int, default=20, help="operations per client in the mixes")
+    parser.add_argument("--files", type=int, default=1000, help="catalog size for list-storm")
+    parser.add_argument("--small-size", default="4K")
+    parser.add_argument("--large-size", default="64M")
+    parser.add_argument("--large-count", type=int, default=3)
+    parser.add_argument("--workers", default="1", help="comma separated worker process counts for framed and text, e.g. 1,2,4")
+    parser.add_argument("--seed", type=int, default=408)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args(argv)
+    args.small_size = parse_size(args.small_size)
+    args.large_size = parse_size(args.large_size)
+
+    workloads = [(os.path.basename(path), load_workload(path)) for path in args.workload]
+    rng = random.Random(args.seed)
+    workloads += [(mix, mix_workload(mix, args, rng)) for mix in args.mix.split(",") if mix]
+    if not workloads:
+        parser.error("give --workload and/or --mix")
+    targets = [target for target in args.targets.split(",") if target]
+    for target in targets:
+        if target not in TARGETS:
+            parser.error(f"unknown target {target}")
+    worker_counts = [int(count) for count in args.workers.split(",") if count]
+
+    results = []
+    for name, ops in workloads:
+        for target in targets:
+            for workers in worker_counts if target != "baseline" else [1]:
+                result = run_one(target, name, ops, workers)
+                results.append(result)
+                if not args.json:
+                    print_result(result)
+    report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+              "cpus": os.cpu_count(), "results": results}
+    if args.json:
+        print(json.dumps(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    return 1 if any(result["errors"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""Many concurrent clients on one server: name claims, uploads, downloads and notifications.
+
+Starts a FileServer on a temporary directory (or uses --host/--port), connects
+--clients framed clients at once, and --duplicates of their names a second
+time in parallel. Every client uploads a file, then downloads files of random
+other clients while those owners are downloading themselves, so notifications
+race with payloads and sendfile on every connection. Checked:
+
+  * exactly one connection per name is accepted
+  * every frame a client reads parses and belongs to one of its requests
+  * every downloaded file matches what its owner uploaded
+  * every owner gets exactly one NOTIFY per download of its file
+
+Example:
+
+    python benchmarks/stress_clients.py --clients 1000 --downloads 3 --json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchutil import free_port  # noqa: E402
+import compression  # noqa: E402
+import protocol  # noqa: E402
+from server_core import FileServer, raise_fd_limit  # noqa: E402
+
+REQUEST_TIMEOUT = 60#seconds, a stalled stream counts as a problem instead of hanging the run
+TEXT = b"timestamp,client,operation,bytes,status\n"
+
+
+def content(index, min_size, max_size):#deterministic file data of one client, every third one compresses
+    rng = random.Random(index)
+    size = rng.randint(min_size, max_size)
+    if index % 3 == 0:
+        line = TEXT + f"{index},{size}\n".encode()
+        return (line * (size // len(line) + 1))[:size]
+    return rng.randbytes(size)
+
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class StressClient:
+    """One framed connection; a reader task matches replies to requests and counts NOTIFY frames."""
+
+    def __init__(self, name, reader, writer):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 1
+        self.pending = {}#request_id -> future of (frame type, meta, body)
+        self.notices = 0
+        self.errors = []
+        self.task = None
+
+    @classmethod
+    async def connect(cls, host, port, name):#the client, or None when the name was refused
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(protocol.PREFACE)
+        await writer.drain()
+        await reader.readexactly(len(protocol.PREFACE))
+        writer.write(protocol.encode_header(protocol.HELLO, 0, {"name": name}))
+        await writer.drain()
+        frame = await protocol.read_frame(reader)
+        if frame is None or frame.type != protocol.OK:
+            writer.close()
+            return None
+        client = cls(name, reader, writer)
+        client.task = asyncio.create_task(client.read_loop())
+        return client
+
+    async def read_loop(self):
+        parts = {}#request_id -> (first meta, [bodies]) of a segmented reply
+        try:
+            while True:
+                frame = await protocol.read_frame(self.reader)
+                if frame is None:
+                    break
+                body = await self.reader.readexactly(frame.body_len) if frame.body_len else b""
+                if frame.type == protocol.NOTIFY:
+                    self.notices += 1
+                    continue
+                if frame.request_id not in self.pending:
+                    raise protocol.ProtocolError(f"Frame for unknown request {frame.request_id}")
+                meta, bodies = parts.setdefault(frame.request_id, (frame.meta, []))
+                if frame.meta.get("encoding"):
+                    body = compression.decode(frame.meta["encoding"], body, meta.get("chunk_size"))
+                bodies.append(body)
+                if not frame.flags & protocol.FLAG_MORE:
+                    del parts[frame.request_id]
+                    self.pending.pop(frame.request_id).set_result((frame.type, meta, b"".join(bodies)))
+        except Exception as e:
+            self.errors.append(f"{self.name}: {e!r}")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"{self.name}: connection lost"))
+
+    async def request(self, frame_type, meta, body=b""):
+        request_id = self.next_id
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(protocol.encode_header(frame_type, request_id, meta, len(body)))
+        if body:
+            self.writer.write(body)
+        await self.writer.drain()
+        try:
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"{self.name}: no reply to request {request_id}") from None
+
+    async def close(self):
+        self.writer.close()
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+async def claim(host, port, name, attempts):#several connections race for one name
+    clients = await asyncio.gather(*(StressClient.connect(host, port, name) for _ in range(attempts)))
+    accepted = [client for client in clients if client is not None]
+    for extra in accepted[1:]:
+        await extra.close()
+    return accepted
+
+
+async def run(args, host, port):
+    problems = []
+    started = time.perf_counter()
+    names = [f"stress{i}" for i in range(args.clients)]
+    claims = await asyncio.gather(*(claim(host, port, name, 2 if i < args.duplicates else 1)
+                                    for i, name in enumerate(names)))
+    for name, accepted in zip(names, claims):
+        if len(accepted) != 1:
+            problems.append(f"{name}: {len(accepted)} connections accepted")
+    clients = {name: accepted[0] for name, accepted in zip(names, claims) if accepted}
+    connected = time.perf_counter()
+
+    expected = {}#name -> digest of its file
+    uploaded = 0
+
+    async def upload(index, client):
+        nonlocal uploaded
+        data = content(index, args.min_size, args.max_size)
+        try:
+            kind, meta, _ = await client.request(protocol.UPLOAD, {"filename": f"file{index}.bin", "size": len(data)}, data)
+        except ConnectionError as e:
+            problems.append(str(e))
+            return
+        if kind != protocol.OK:
+            problems.append(f"{client.name}: upload failed: {meta.get('message')}")
+            return
+        expected[client.name] = digest(data)
+        uploaded += len(data)
+
+    await asyncio.gather(*(upload(names.index(name), client) for name, client in clients.items()))
+    uploads_done = time.perf_counter()
+
+    notices = dict.fromkeys(clients, 0)#owner -> downloads of its file, the notifications it should get
+    downloaded = 0
+
+    async def download(client, rng):
+        nonlocal downloaded
+        owners = [name for name in expected if name != client.name]
+        for owner in rng.sample(owners, min(args.downloads, len(owners))):
+            meta = {"owner": owner, "filename": f"file{names.index(owner)}.bin", "checksums": True,
+                    "accept_encoding": list(compression.CODECS)}
+            try:
+                kind, reply, body = await client.request(protocol.DOWNLOAD, meta)
+            except ConnectionError as e:
+                problems.append(str(e))
+                return
+            if kind != protocol.OK:
+                problems.append(f"{client.name}: download of {owner} failed: {reply.get('message')}")
+            elif digest(body) != expected[owner]:
+                problems.append(f"{client.name}: download of {owner} does not match the upload")
+            else:
+                notices[owner] += 1
+                downloaded += len(body)
+
+    rng = random.Random(args.seed)
+    await asyncio.gather(*(download(client, random.Random(rng.random())) for client in clients.values()))
+    downloads_done = time.perf_counter()
+
+    #one more request each releases notifications held back during a reply, then wait for them to arrive
+    await asyncio.gather(*(client.request(protocol.LIST, {"limit": 1}) for client in clients.values()),
+                         return_exceptions=True)
+    deadline = time.monotonic() + args.settle
+    while time.monotonic() < deadline and any(clients[name].notices < count for name, count in notices.items()):
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)#anything extra would show up now
+    for name, count in notices.items():
+        if clients[name].notices != count:
+            problems.append(f"{name}: {clients[name].notices} notifications for {count} downloads")
+
+    for client in clients.values():
+        await client.close()
+        problems.extend(client.errors)
+    return {
+        "clients": len(clients),
+        "duplicates": args.duplicates,
+        "connect_s": connected - started,
+        "upload_s": uploads_done - connected,
+        "download_s": downloads_done - uploads_done,
+        "uploaded_bytes": uploaded,
+        "downloaded_bytes": downloaded,
+        "notifications": sum(notices.values()),
+        "problems": problems,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--duplicates", type=int, default=100, help="names that two connections race for")
+    parser.add_argument("--downloads", type=int, default=3, help="files each client downloads")
+    parser.add_argument("--min-size", type=int, default=16 << 10)
+    parser.add_argument("--max-size", type=int, default=512 << 10)
+    parser.add_argument("--settle", type=float, default=10.0, help="seconds to wait for late notifications")
+    parser.add_argument("--seed", type=int, default=408)
+    parser.add_argument("--host", default=None, help="use a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args(argv)
+    raise_fd_limit()
+
+    server_log = []
+    with tempfile.TemporaryDirectory() as tmp:
+        host, port = args.host, args.port
+        if host is None:
+            host, port = "127.0.0.1", free_port()
+            server = FileServer(tmp, port, host, log=server_log.append, catalog_path=os.path.join(tmp, "files.db"))
+            server.start_in_thread()
+        result = asyncio.run(run(args, host, port))
+        if args.host is None:
+            server.stop()
+    result["problems"] += [line for line in server_log if line.startswith("Error")]
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key, value in result.items():
+            if key != "problems":
+                print(f"{key:<18} {value:.3f}" if isinstance(value, float) else f"{key:<18} {value}")
+        for problem in result["problems"][:50]:
+            print(f"PROBLEM: {problem}")
+        print("OK" if not result["problems"] else f"FAILED ({len(result['problems'])} problems)")
+    return 1 if result["problems"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""Send-path throughput: original 4 KiB read/send loop vs large-buffer sendall vs sendfile.
+
+Each method pushes the same file over a loopback TCP connection to a reader
+thread that discards the bytes. Example:
+
+    python benchmarks/transfer_bench.py --sizes 1M,100M,2G --repeat 3
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchutil import parse_size  # noqa: E402
+import transfer  # noqa: E402
+
+
+def make_file(directory, size):#random block repeated, so the file is not trivially compressible
+    path = os.path.join(directory, f"bench_{size}.bin")
+    block = os.urandom(min(size, 16 << 20))
+    with open(path, "wb") as f:
+        left = size
+        while left:
+            n = min(left, len(block))
+            f.write(block[:n])
+            left -= n
+    return path
+
+
+def send_loop_4k(sock, f, size):#what handle_download and upload_file did before
+    chunk = f.read(4096)
+    while chunk:
+        sock.send(chunk)
+        chunk = f.read(4096)
+
+
+def send_copy(sock, f, size):
+    transfer.send_file_copy_blocking(sock, f, 0, size)
+
+
+def send_zero_copy(sock, f, size):
+    transfer.send_file_blocking(sock, f, 0, size)
+
+
+METHODS = {"loop-4k": send_loop_4k, "sendall-1m": send_copy, "sendfile": send_zero_copy}
+
+
+def drain(conn, size, done):#reader side: discard exactly size bytes
+    buf = bytearray(1 << 20)
+    left = size
+    while left:
+        n = conn.recv_into(buf, min(len(buf), left))
+        if not n:
+            break
+        left -= n
+    done.set()
+
+
+def run_once(path, size, method):
+    listener = socket.create_server(("127.0.0.1", 0))
+    sender = socket.create_connection(listener.getsockname())
+    conn, _ = listener.accept()
+    done = threading.Event()
+    reader = threading.Thread(target=drain, args=(conn, size, done), daemon=True)
+    reader.start()
+    with open(path, "rb") as f:
+        start = time.perf_counter()
+        method(sender, f, size)
+        done.wait()
+        elapsed = time.perf_counter() - start
+    for s in (sender, conn, listener):
+        s.close()
+    return elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1M,100M,2G", help="comma separated file sizes")
+    parser.add_argument("--methods", default=",".join(METHODS), help="comma separated methods")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, best one is reported")
+    parser.add_argument("--dir", default=None, help="where to create the test files")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for size in map(parse_size, args.sizes.split(",")):
+            path = make_file(tmp, size)
+            for name in args.methods.split(","):
+                best = min(run_once(path, size, METHODS[name]) for _ in range(args.repeat))
+                mb_s = size / best / 1e6
+                if args.json:
+                    print(json.dumps({"size": size, "method": name, "seconds": best, "mb_per_s": mb_s}))
+                else:
+                    print(f"{size:>12} B  {name:<11} {best * 1000:10.1f} ms  {mb_s:10.1f} MB/s")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,482 @@
+"""File records of the server, kept in SQLite (WAL mode).
+
+Every upload or delete is one small committed transaction instead of a
+rewrite of the whole files.json, so the cost no longer grows with the
+catalog and a crash in the middle of a write cannot corrupt it. Opening the
+store does not read the records, so startup time does not depend on how
+many files are stored.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SCHEMA_VERSION = 6
+CHANGES_KEEP = 100000#change log entries kept for LIST deltas, older clients get a full snapshot
+BUSY_TIMEOUT = 0.5#seconds a write waits for another process's transaction, the event loop waits with it
+SCHEMA = [#schema version -> statements that bring the previous version up to it
+    None,
+    [
+        "CREATE TABLE files ("
+        " unique_name TEXT PRIMARY KEY,"
+        " owner TEXT NOT NULL,"
+        " filename TEXT NOT NULL,"
+        " size INTEGER NOT NULL DEFAULT 0)",
+        "CREATE INDEX files_owner ON files (owner, filename)",
+        "CREATE INDEX files_filename ON files (filename)",
+    ],
+    [#every add/remove bumps the catalog version, LIST deltas replay this log
+        "CREATE TABLE changes ("
+        " version INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " op TEXT NOT NULL,"
+        " owner TEXT NOT NULL,"
+        " filename TEXT NOT NULL,"
+        " size INTEGER NOT NULL DEFAULT 0)",
+    ],
+    [#per-chunk checksums of stored files and state of resumable uploads
+        "ALTER TABLE files ADD COLUMN chunk_size INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE files ADD COLUMN checksums TEXT",
+        "CREATE TABLE uploads ("
+        " upload_id TEXT PRIMARY KEY,"
+        " owner TEXT NOT NULL,"
+        " filename TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " chunk_size INTEGER NOT NULL,"
+        " committed INTEGER NOT NULL DEFAULT 0,"
+        " checksums TEXT NOT NULL DEFAULT '[]',"
+        " updated REAL NOT NULL)",
+    ],
+    [#content-addressed storage: a file is a manifest of chunk hashes, chunks are shared and refcounted
+        "ALTER TABLE files ADD COLUMN manifest TEXT",
+        "CREATE TABLE chunks ("
+        " hash TEXT PRIMARY KEY,"
+        " size INTEGER NOT NULL,"
+        " crc INTEGER NOT NULL,"
+        " refs INTEGER NOT NULL DEFAULT 0)",
+        "CREATE INDEX chunks_unreferenced ON chunks (hash) WHERE refs <= 0",
+        "DELETE FROM uploads",#staged in .part files until now, those uploads start over as chunks
+        "ALTER TABLE uploads ADD COLUMN hashes TEXT NOT NULL DEFAULT '[]'",
+    ],
+    [#startup reconciliation (reconcile.py): fingerprints of whole files, scan checkpoints and what scans found
+        "ALTER TABLE files ADD COLUMN mtime_ns INTEGER",
+        "CREATE TABLE scan_dirs ("
+        " path TEXT PRIMARY KEY,"
+        " mtime_ns INTEGER NOT NULL)",
+        "CREATE TABLE findings ("
+        " path TEXT PRIMARY KEY,"
+        " directory TEXT NOT NULL,"
+        " kind TEXT NOT NULL,"
+        " size INTEGER NOT NULL)",
+        "CREATE INDEX findings_directory ON findings (directory)",
+    ],
+    [#whole-file checksum (transfer.file_checksum) of every file, DOWNLOAD and LIST report it to clients
+        "ALTER TABLE files ADD COLUMN checksum TEXT",
+        "ALTER TABLE changes ADD COLUMN checksum TEXT",
+        #crc32 lists cached for whole files are computed again on the next download, with the checksum
+        "UPDATE files SET checksums=NULL WHERE manifest IS NULL",
+    ],
+]
+
+
+class Catalog:
+    """unique_name ({owner}_{filename}) -> owner, filename, size, checksum and content of a stored file.
+
+    The content is a manifest of chunk hashes (chunkstore.py), or NULL for files
+    stored whole in the storage directory before the chunk store existed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()#one connection shared by the event loop and the GUI thread
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")#WAL stays consistent after a crash without fsync per commit
+        self.created = self.migrate() == 0
+
+    def migrate(self):#returns the schema version found on disk
+        with self.lock:
+            found = self.db.execute("PRAGMA user_version").fetchone()[0]
+            for version in range(found + 1, SCHEMA_VERSION + 1):
+                with self.transaction():
+                    for statement in SCHEMA[version]:
+                        self.db.execute(statement)
+                    self.db.execute(f"PRAGMA user_version={version}")
+            return found
+
+    @contextmanager
+    def transaction(self):#group several changes into one atomic commit
+        with self.lock:
+            if self.db.in_transaction:#nested use joins the outer transaction
+                yield self.db
+                return
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def add(self, unique_name, owner, filename, size=0, chunk_size=0, checksums=None, manifest=None, checksum=None):
+        """manifest is the list of chunk hashes; the caller already holds one reference per entry
+        (ref_chunks or an upload) and it moves to the file. A replaced file drops its own.
+        checksums are the crc32 of every chunk, checksum is the hex whole-file checksum."""
+        checksums = json.dumps(checksums) if checksums is not None else None
+        manifest = json.dumps(manifest) if manifest is not None else None
+        with self.transaction() as db:
+            self.release_manifest(unique_name)
+            db.execute(
+                "INSERT INTO files (unique_name, owner, filename, size, chunk_size, checksums, manifest, checksum)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (unique_name) DO UPDATE SET owner=excluded.owner, filename=excluded.filename,"
+                " size=excluded.size, chunk_size=excluded.chunk_size, checksums=excluded.checksums,"
+                " manifest=excluded.manifest, checksum=excluded.checksum",
+                (unique_name, owner, filename, size, chunk_size, checksums, manifest, checksum),
+            )
+            self.log_change("+", owner, filename, size, checksum)
+
+    def remove(self, unique_name):#returns True if a record was deleted
+        with self.transaction() as db:
+            row = db.execute("SELECT owner, filename FROM files WHERE unique_name=?", (unique_name,)).fetchone()
+            if row is None:
+                return False
+            self.release_manifest(unique_name)
+            db.execute("DELETE FROM files WHERE unique_name=?", (unique_name,))
+            self.log_change("-", row[0], row[1])
+            return True
+
+    def remove_missing(self, unique_names, exists):
+        """Drop the records of files stored whole that exists(unique_name) no longer finds; returns their names.
+
+        Every name is checked again against the current row inside the transaction: a file that a
+        client replaced, or deleted and uploaded again, since the caller looked keeps its new record."""
+        removed = []
+        with self.transaction() as db:
+            for name in unique_names:
+                row = db.execute("SELECT owner, filename FROM files WHERE unique_name=? AND manifest IS NULL",
+                                 (name,)).fetchone()
+                if row is None or exists(name):
+                    continue
+                db.execute("DELETE FROM files WHERE unique_name=? AND manifest IS NULL", (name,))
+                self.log_change("-", row[0], row[1])
+                removed.append(name)
+        return removed
+
+    def log_change(self, op, owner, filename, size=0, checksum=None):#called inside the transaction of the change
+        version = self.db.execute(
+            "INSERT INTO changes (op, owner, filename, size, checksum) VALUES (?, ?, ?, ?, ?)",
+            (op, owner, filename, size, checksum),
+        ).lastrowid
+        if version % 1000 == 0:#trim the log now and then, not on every write
+            self.db.execute("DELETE FROM changes WHERE version <= ?", (version - CHANGES_KEEP,))
+
+    def version(self):#grows by one with every change a listing shows: upload, delete, new size or checksum
+        with self.lock:
+            row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name='changes'").fetchone()
+        return row[0] if row else 0
+
+    def changes_since(self, version):
+        """Returns (current_version, [(op, owner, filename, size, checksum)]), or None for the list when the
+        log no longer reaches back to version and the caller has to start from a full snapshot."""
+        with self.lock:
+            current = self.version()
+            if version == current and version:#0 always gets a snapshot, records older than the log are not in it
+                return current, []
+            oldest = self.db.execute("SELECT MIN(version) FROM changes").fetchone()[0]
+            if not 0 < version < current or oldest is None or oldest > version + 1:#unknown or trimmed away
+                return current, None
+            rows = self.db.execute(
+                "SELECT op, owner, filename, size, checksum FROM changes WHERE version > ? AND version <= ?"
+                " ORDER BY version",
+                (version, current),
+            ).fetchall()
+            return current, rows
+
+    def page(self, owner=None, prefix=None, after=0, limit=None):
+        """[(rowid, owner, filename, size, checksum)] in upload order, optionally filtered; rowid is the cursor."""
+        query = "SELECT rowid, owner, filename, size, checksum FROM files WHERE rowid > ?"
+        params = [after]
+        if owner is not None:
+            query += " AND owner = ?"
+            params.append(owner)
+        if prefix:#range on the filename index instead of LIKE, which would scan
+            query += " AND filename >= ? AND filename < ?"
+            params += [prefix, prefix + "\U0010ffff"]
+        query += " ORDER BY rowid"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            return self.db.execute(query, params).fetchall()
+
+    def content(self, unique_name):
+        """(size, chunk_size, manifest, checksum) or None; manifest is None for a whole file, checksum
+        is None for files stored before checksums were kept (whole files get one in set_chunk_checksums)."""
+        with self.lock:
+            row = self.db.execute("SELECT size, chunk_size, manifest, checksum FROM files WHERE unique_name=?",
+                                  (unique_name,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]) if row[2] is not None else None, row[3]
+
+    def owner_of(self, unique_name):
+        with self.lock:
+            row = self.db.execute("SELECT owner FROM files WHERE unique_name=?", (unique_name,)).fetchone()
+        return row[0] if row else None
+
+    def __contains__(self, unique_name):
+        return self.owner_of(unique_name) is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def records(self):#[(unique_name, owner, filename, size)] in upload order
+        with self.lock:
+            return self.db.execute("SELECT unique_name, owner, filename, size FROM files ORDER BY rowid").fetchall()
+
+    def unique_names(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT unique_name FROM files")]
+
+    def whole_files(self):#unique names of files stored whole in the directory instead of as chunks
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT unique_name FROM files WHERE manifest IS NULL")]
+
+    def by_owner(self, owner):
+        with self.lock:
+            return self.db.execute(
+                "SELECT unique_name, owner, filename, size FROM files WHERE owner=? ORDER BY filename", (owner,)
+            ).fetchall()
+
+    def by_filename(self, filename):
+        with self.lock:
+            return self.db.execute(
+                "SELECT unique_name, owner, filename, size FROM files WHERE filename=? ORDER BY owner", (filename,)
+            ).fetchall()
+
+    def chunk_checksums(self, unique_name):#(chunk_size, [crc32 per chunk], checksum) or None when not computed yet
+        with self.lock:
+            row = self.db.execute("SELECT chunk_size, checksums, checksum FROM files WHERE unique_name=?",
+                                  (unique_name,)).fetchone()
+        if row is None or row[1] is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def set_chunk_checksums(self, unique_name, chunk_size, checksums, checksum):#for a whole file, computed from its data
+        with self.transaction() as db:#a chunked upload that replaced the file meanwhile already has its own
+            row = db.execute("SELECT owner, filename, size, checksum FROM files WHERE unique_name=? AND manifest IS NULL",
+                             (unique_name,)).fetchone()
+            if row is None:
+                return
+            db.execute("UPDATE files SET chunk_size=?, checksums=?, checksum=? WHERE unique_name=?",
+                       (chunk_size, json.dumps(checksums), checksum, unique_name))
+            if checksum != row[3]:#LIST reports the checksum, clients learn it from the change log
+                self.log_change("+", row[0], row[1], row[2], checksum)
+
+    #chunk store: refs counts manifests and open uploads that use a chunk
+
+    def ref_chunks(self, chunks):#[(hash, size, crc)], one more reference each; new chunks start at one
+        with self.transaction() as db:
+            db.executemany("INSERT INTO chunks (hash, size, crc, refs) VALUES (?, ?, ?, 1)"
+                           " ON CONFLICT (hash) DO UPDATE SET refs=refs+1", chunks)
+
+    def unref_chunks(self, hashes):
+        with self.transaction() as db:
+            db.executemany("UPDATE chunks SET refs=refs-1 WHERE hash=?", ((digest,) for digest in hashes))
+
+    def release_manifest(self, unique_name):#called inside the transaction that drops or replaces the file
+        row = self.db.execute("SELECT manifest FROM files WHERE unique_name=?", (unique_name,)).fetchone()
+        if row is not None and row[0] is not None:
+            self.unref_chunks(json.loads(row[0]))
+
+    def known_chunks(self, hashes):#{hash: (size, crc)} of the given chunks that are already stored
+        hashes = list(set(hashes))
+        known = {}
+        with self.lock:
+            for i in range(0, len(hashes), 500):#stay below SQLite's limit on bound parameters
+                batch = hashes[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT hash, size, crc FROM chunks WHERE hash IN ({','.join('?' * len(batch))})", batch)
+                known.update((digest, (size, crc)) for digest, size, crc in rows)
+        return known
+
+    def has_garbage(self):#True if some chunk is referenced by nothing
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM chunks WHERE refs <= 0 LIMIT 1").fetchone() is not None
+
+    def garbage_chunks(self, keep=(), discard=None):
+        """Forget chunks nobody references (except those in keep) and return their hashes.
+
+        discard(hash) takes the chunk's files out of the store inside the same transaction:
+        another server process storing the same chunk meanwhile waits, and then finds it
+        gone and stores it again. It should only rename them, deleting the files is left
+        until after the commit so the write lock is held briefly."""
+        if not self.has_garbage():#the usual case, no write lock is taken then
+            return []
+        with self.transaction() as db:
+            hashes = [row[0] for row in db.execute("SELECT hash FROM chunks WHERE refs <= 0") if row[0] not in keep]
+            db.executemany("DELETE FROM chunks WHERE hash=?", [(digest,) for digest in hashes])
+            if discard is not None:
+                for digest in hashes:
+                    discard(digest)
+        return hashes
+
+    #resumable uploads: one staged upload per owner and filename. checksums and hashes hold the
+    #crc32 and chunk hash of every stored chunk by index (None for chunks not received yet), the
+    #upload holds a reference to each of those chunks until it is committed or dropped. committed
+    #is the length of the prefix that is complete; chunks may arrive out of order over several
+    #connections
+
+    def open_upload(self, upload_id, owner, filename, size, chunk_size):
+        """Returns (committed offset, checksums so far); a different size or chunk size starts over."""
+        with self.transaction() as db:
+            row = db.execute("SELECT size, chunk_size, committed, checksums, hashes FROM uploads WHERE upload_id=?",
+                             (upload_id,)).fetchone()
+            if row is not None and row[0] == size and row[1] == chunk_size:
+                db.execute("UPDATE uploads SET updated=? WHERE upload_id=?", (time.time(), upload_id))
+                return row[2], json.loads(row[3])
+            if row is not None:
+                self.unref_chunks(digest for digest in json.loads(row[4]) if digest is not None)
+            db.execute(
+                "INSERT OR REPLACE INTO uploads (upload_id, owner, filename, size, chunk_size, committed,"
+                " checksums, updated) VALUES (?, ?, ?, ?, ?, 0, '[]', ?)",
+                (upload_id, owner, filename, size, chunk_size, time.time()),
+            )
+            return 0, []
+
+    def get_upload(self, upload_id):#dict of the upload row or None
+        with self.lock:
+            cursor = self.db.execute("SELECT * FROM uploads WHERE upload_id=?", (upload_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        upload = dict(zip((column[0] for column in cursor.description), row))
+        upload["checksums"] = json.loads(upload["checksums"])
+        upload["hashes"] = json.loads(upload["hashes"])
+        return upload
+
+    def store_chunk(self, upload_id, index, crc, digest, chunk_length):
+        """Record a chunk that is in the chunk store and take a reference to it.
+
+        Returns the committed offset, or None if the upload is gone."""
+        with self.transaction() as db:
+            row = db.execute("SELECT size, chunk_size, checksums, hashes FROM uploads WHERE upload_id=?",
+                             (upload_id,)).fetchone()
+            if row is None:
+                return None
+            size, chunk_size = row[0], row[1]
+            checksums, hashes = json.loads(row[2]), json.loads(row[3])
+            checksums += [None] * (index + 1 - len(checksums))
+            hashes += [None] * (index + 1 - len(hashes))
+            if checksums[index] is None:#a chunk sent twice is referenced once
+                checksums[index], hashes[index] = crc, digest
+                self.ref_chunks([(digest, chunk_length, crc)])
+            complete = checksums.index(None) if None in checksums else len(checksums)
+            committed = min(size, complete * chunk_size)
+            db.execute("UPDATE uploads SET committed=?, checksums=?, hashes=?, updated=? WHERE upload_id=?",
+                       (committed, json.dumps(checksums), json.dumps(hashes), time.time(), upload_id))
+            return committed
+
+    def finish_upload(self, upload_id):#committed, its chunk references now belong to the file
+        with self.lock:
+            self.db.execute("DELETE FROM uploads WHERE upload_id=?", (upload_id,))
+
+    def abort_upload(self, upload_id):#dropped, release the chunks it holds
+        with self.transaction() as db:
+            row = db.execute("SELECT hashes FROM uploads WHERE upload_id=?", (upload_id,)).fetchone()
+            if row is not None:
+                self.unref_chunks(digest for digest in json.loads(row[0]) if digest is not None)
+            db.execute("DELETE FROM uploads WHERE upload_id=?", (upload_id,))
+
+    def stale_uploads(self, max_age):#ids of uploads nobody touched for max_age seconds
+        with self.lock:
+            rows = self.db.execute("SELECT upload_id FROM uploads WHERE updated < ?",
+                                   (time.time() - max_age,)).fetchall()
+        return [row[0] for row in rows]
+
+    #startup reconciliation: what the last scan of each directory saw, so unchanged ones are skipped
+
+    def whole_file_fingerprints(self):#{unique_name: (size, mtime_ns)} of files stored whole, mtime_ns None if never scanned
+        with self.lock:
+            return {name: (size, mtime_ns) for name, size, mtime_ns in self.db.execute(
+                "SELECT unique_name, size, mtime_ns FROM files WHERE manifest IS NULL")}
+
+    def update_fingerprint(self, unique_name, size, mtime_ns, changed):#changed drops checksums computed from old data
+        query = "UPDATE files SET size=?, mtime_ns=?"
+        if changed:
+            query += ", chunk_size=0, checksums=NULL, checksum=NULL"
+        with self.transaction() as db:
+            row = db.execute("SELECT owner, filename, size, checksum FROM files WHERE unique_name=? AND manifest IS NULL",
+                             (unique_name,)).fetchone()
+            if row is None:
+                return
+            db.execute(query + " WHERE unique_name=?", (size, mtime_ns, unique_name))
+            checksum = None if changed else row[3]
+            if (size, checksum) != (row[2], row[3]):#a new size or a dropped checksum is a change LIST reports
+                self.log_change("+", row[0], row[1], size, checksum)
+
+    def scan_checkpoint(self, path):#mtime_ns of the directory when it was last scanned completely, or None
+        with self.lock:
+            row = self.db.execute("SELECT mtime_ns FROM scan_dirs WHERE path=?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def save_scan_checkpoint(self, path, mtime_ns):#None forgets it, the directory is scanned next time
+        with self.lock:
+            if mtime_ns is None:
+                self.db.execute("DELETE FROM scan_dirs WHERE path=?", (path,))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO scan_dirs (path, mtime_ns) VALUES (?, ?)", (path, mtime_ns))
+
+    def chunk_sizes(self, prefix):#{hash: size} of the chunks whose hash starts with prefix
+        with self.lock:
+            return dict(self.db.execute("SELECT hash, size FROM chunks WHERE hash >= ? AND hash < ?",
+                                        (prefix, prefix + "\U0010ffff")))
+
+    def files_with_chunk(self, digest, limit=5):#unique names of files whose manifest has the chunk (scans, use rarely)
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT unique_name FROM files WHERE manifest LIKE ? LIMIT ?", (f'%"{digest}"%', limit))]
+
+    def set_findings(self, directory, findings):#[(path, kind, size)] from a scan of directory, replaces its earlier ones
+        with self.transaction() as db:
+            db.execute("DELETE FROM findings WHERE directory=?", (directory,))
+            db.executemany("INSERT OR REPLACE INTO findings (path, directory, kind, size) VALUES (?, ?, ?, ?)",
+                           [(path, directory, kind, size) for path, kind, size in findings])
+
+    def findings(self):#[(path, kind, size)]: orphaned files, missing or damaged chunks (kinds in reconcile.py)
+        with self.lock:
+            return self.db.execute("SELECT path, kind, size FROM findings ORDER BY kind, path").fetchall()
+
+    def finding_counts(self):#{kind: count}
+        with self.lock:
+            return dict(self.db.execute("SELECT kind, COUNT(*) FROM findings GROUP BY kind"))
+
+    def import_json(self, json_path):#one-time migration from the old {unique_name: owner} files.json
+        with open(json_path, "r") as f:
+            records = json.load(f)
+        with self.transaction():
+            for unique_name, owner in records.items():
+                if unique_name.startswith(f"{owner}_"):
+                    filename = unique_name[len(owner) + 1:]
+                else:
+                    filename = unique_name.split('_', 1)[-1]
+                self.add(unique_name, owner, filename)
+        return len(records)
+
+    def checkpoint(self):#fold the write-ahead log back into the main database file
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def is_busy(error):#another process held the write lock past BUSY_TIMEOUT: nothing was written, try again later
+    return isinstance(error, sqlite3.OperationalError) and "database is locked" in str(error)
+
+
+def legacy_json_path(catalog_path):#files.json that sat next to the catalog before it existed
+    return os.path.join(os.path.dirname(catalog_path), "files.json")
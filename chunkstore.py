@@ -0,0 +1,157 @@
+"""Content-addressed storage of file contents.
+
+A stored file is a manifest: the list of hashes (transfer.chunk_hasher) of
+its fixed-size chunks, kept in the catalog. Every distinct chunk is one file
+under .chunks/ in the storage directory, named by its hash, so identical data
+uploaded by several users, or uploaded again, is stored once. The catalog
+counts references to each chunk; chunks nobody references are deleted.
+"""
+import asyncio
+import os
+import tempfile
+import zlib
+
+import compression
+import transfer
+
+CHUNK_DIR = ".chunks"#inside the storage directory
+
+
+class ChunkStore:
+    """hash -> chunk file, fanned out over 256 subdirectories by the first two hex digits."""
+
+    def __init__(self, directory):
+        self.root = os.path.join(directory, CHUNK_DIR)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, temp_path, digest, known=False):#move a finished chunk into place, or drop it if we have it
+        if known:
+            os.remove(temp_path)
+            return
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def encoded_path(self, digest, codec):#compressed copy of a chunk, sent as-is to clients that accept it
+        return f"{self.path(digest)}.{codec}"
+
+    def put_encoded(self, temp_path, digest, codec):
+        path = self.encoded_path(digest, codec)
+        if os.path.exists(path) or not os.path.exists(self.path(digest)):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+
+    def paths(self, digest):#the chunk file and every compressed copy it may have
+        return [self.path(digest)] + [self.encoded_path(digest, codec) for codec in compression.CODECS]
+
+    def retire(self, digest, trash_dir):#rename the chunk's files into trash_dir (same filesystem), returns their new paths
+        retired = []
+        for path in self.paths(digest):
+            target = os.path.join(trash_dir, os.path.basename(path) + ".tmp")
+            try:
+                os.replace(path, target)
+            except FileNotFoundError:
+                continue
+            retired.append(target)
+        return retired
+
+    def ranges(self, chunk_size, hashes, offset, length):#(path, offset, count) of the chunks covering a byte range
+        index, offset = divmod(offset, chunk_size)
+        while length > 0:
+            count = min(chunk_size - offset, length)
+            yield self.path(hashes[index]), offset, count
+            length -= count
+            index += 1
+            offset = 0
+
+
+class _PendingChunk:#one chunk being received into a temp file
+    def __init__(self, staging_dir):
+        fd, self.path = tempfile.mkstemp(dir=staging_dir, suffix=".tmp")
+        self.f = os.fdopen(fd, "wb")
+        self.hasher = transfer.chunk_hasher()
+        self.crc = 0
+        self.size = 0
+
+    @property
+    def digest(self):
+        return self.hasher.hexdigest()
+
+
+class ChunkingWriter:
+    """File-like target for receive_body that cuts the data into chunk_size pieces.
+
+    Each piece goes to its own temp file in the staging directory and is crc32'd
+    and hashed on the way, so an upload never has to be read back to be split,
+    nor hashed again for its whole-file checksum. The data is collected into
+    transfer.HASH_BLOCK blocks that a pool thread hashes (HashQueue) while more
+    of the body arrives; the receiving connection awaits drain() to keep the
+    backlog bounded. Await hashed() before reading digests or the checksum."""
+
+    def __init__(self, staging_dir, chunk_size):
+        self.staging_dir = staging_dir
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.copy = None#the body as it arrived, when it came compressed (see open_copy)
+        self.copy_path = None
+        self.hashes = transfer.HashQueue()
+        self.block = bytearray()#data of the last chunk not handed to the pool yet
+
+    def write(self, data):#runs in the transport callback, so it never waits for the pool
+        view = memoryview(data)
+        while view:
+            if not self.chunks or self.chunks[-1].size == self.chunk_size:
+                self.chunks.append(_PendingChunk(self.staging_dir))
+            chunk = self.chunks[-1]
+            piece = view[:self.chunk_size - chunk.size]
+            chunk.f.write(piece)
+            chunk.crc = zlib.crc32(piece, chunk.crc)
+            chunk.size += len(piece)
+            self.block += piece#the receive buffer is reused once we return
+            if len(self.block) >= transfer.HASH_BLOCK or chunk.size == self.chunk_size:
+                self.submit_block()
+            view = view[len(piece):]
+        return len(data)
+
+    def submit_block(self):
+        if self.block:
+            block, self.block = self.block, bytearray()
+            self.hashes.submit(self.chunks[-1].hasher.update, block, size=len(block), wait=False)
+
+    async def drain(self):#returns once the pool has caught up with the body received so far
+        if self.hashes.backlog > transfer.HASH_BACKLOG:
+            await asyncio.wrap_future(self.hashes.below(transfer.HASH_BACKLOG // 2))
+
+    async def hashed(self):#returns once every chunk hash is computed
+        self.submit_block()
+        await asyncio.wrap_future(self.hashes.flushed())
+
+    @property
+    def checksum(self):#transfer.file_checksum() of the whole body, after hashed()
+        return transfer.file_checksum([chunk.digest for chunk in self.chunks])
+
+    def open_copy(self):#temp file for the encoded body, kept as the compressed form of the chunk
+        fd, self.copy_path = tempfile.mkstemp(dir=self.staging_dir, suffix=".tmp")
+        self.copy = os.fdopen(fd, "wb")
+        return self.copy
+
+    def files(self):
+        return [chunk.f for chunk in self.chunks] + ([self.copy] if self.copy is not None else [])
+
+    def sync(self):#make the temp files durable (blocking, run it in an executor)
+        for f in self.files():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        for f in self.files():
+            f.close()
+
+    def discard(self):#drop temp files that were not moved into the store
+        self.close()
+        for path in [chunk.path for chunk in self.chunks] + [self.copy_path]:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,177 @@
+"""Background transfer engine of the client window.
+
+Jobs go into a queue and a few worker threads (QThread) take them one at a
+time, so the window never waits on the network. A job is a call into the
+window's FileClient, which gives every call its own pooled data connection,
+so concurrent jobs never share a socket. Progress and results reach the GUI
+thread as Qt signals.
+"""
+import itertools
+import queue
+import threading
+import time
+
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+
+import fileclient
+from sizes import format_size
+
+DEFAULT_CONCURRENCY = 3#jobs that run at the same time
+MAX_CONCURRENCY = 16
+PROGRESS_INTERVAL = 0.25#seconds between progress signals of one job
+RATE_SMOOTHING = 0.3#weight of the newest sample in the throughput average
+IDLE_CHECK = 0.5#seconds an idle worker waits for a job before checking whether it should exit
+
+
+class Job:
+    """One unit of work: run(progress) is called on a worker thread and returns a message."""
+    _ids = itertools.count(1)
+
+    def __init__(self, label, run, size=0):
+        self.id = next(self._ids)
+        self.label = label
+        self.run = run
+        self.size = size#expected bytes, the worker may correct it once the server answers
+
+
+class Progress(fileclient.Progress):
+    """Bytes moved by one job, reported as job_progress signals."""
+
+    def __init__(self, engine, job):
+        self.engine = engine
+        self.job = job
+        self.total = job.size
+        self.done = 0
+        self.rate = 0.0#bytes per second, smoothed
+        self.lock = threading.Lock()
+        self.started = self.last = time.monotonic()
+        self.last_done = 0
+
+    def set_total(self, total):
+        self.total = total
+
+    def skip(self, count):#bytes that need no transfer (resumed, deduplicated), not counted in the rate
+        with self.lock:
+            self.done += count
+            self.last_done += count
+
+    def add(self, count):
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self.last < PROGRESS_INTERVAL:
+                return
+            sample = (self.done - self.last_done) / (now - self.last)
+            self.rate = sample if not self.rate else RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self.rate
+            self.last, self.last_done = now, self.done
+            done, total, rate = self.done, self.total, self.rate
+        eta = (total - done) / rate if rate and total > done else 0.0
+        self.engine.job_progress.emit(self.job.id, done, total, rate, eta)
+
+    def average_rate(self):#over the whole job, for the final report
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+
+class TransferWorker(QThread):
+    """Runs jobs from the engine's queue."""
+
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self.retired = False#exits after its current job, concurrency went down
+
+    def run(self):
+        engine = self.engine
+        while not engine.retire(self):
+            try:
+                job = engine.jobs.get(timeout=IDLE_CHECK)
+            except queue.Empty:
+                continue
+            if job is None:#engine stopped
+                break
+            engine.job_started.emit(job.id)
+            progress = Progress(engine, job)
+            try:
+                message = job.run(progress)
+                engine.job_finished.emit(job.id, message or "", True, progress.average_rate())
+            except Exception as e:
+                engine.job_finished.emit(job.id, str(e), False, progress.average_rate())
+            finally:
+                engine.job_done()
+
+
+class TransferEngine(QObject):
+    """Job queue plus a pool of TransferWorkers; concurrency can change at any time."""
+    job_queued = pyqtSignal(int, str)#id, label
+    job_started = pyqtSignal(int)
+    job_progress = pyqtSignal(int, object, object, float, float)#id, bytes done, total, bytes/s, seconds left
+    job_finished = pyqtSignal(int, str, bool, float)#id, message, success, average bytes/s
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        super().__init__()
+        self.concurrency = concurrency
+        self.jobs = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.unfinished = 0
+        self.stopped = False
+
+    def submit(self, label, run, size=0):#returns the job id
+        job = Job(label, run, size)
+        with self.lock:
+            self.unfinished += 1
+            self.start_workers()
+        self.job_queued.emit(job.id, label)
+        self.jobs.put(job)
+        return job.id
+
+    def set_concurrency(self, count):
+        with self.lock:
+            self.concurrency = max(1, min(MAX_CONCURRENCY, count))
+            if self.unfinished:
+                self.start_workers()
+
+    def start_workers(self):#called with the lock held
+        self.workers = [worker for worker in self.workers if not worker.isFinished()]#retired ones stay until they end
+        running = sum(not worker.retired for worker in self.workers)
+        for _ in range(0 if self.stopped else self.concurrency - running):
+            worker = TransferWorker(self)
+            self.workers.append(worker)
+            worker.start()
+
+    def retire(self, worker):#True when worker should exit, because the engine stopped or concurrency went down
+        with self.lock:
+            if self.stopped or worker.retired:
+                return True
+            if sum(not w.retired for w in self.workers) > self.concurrency:
+                worker.retired = True
+            return worker.retired
+
+    def job_done(self):
+        with self.lock:
+            self.unfinished -= 1
+
+    def idle(self):#no job queued or running
+        with self.lock:
+            return self.unfinished == 0
+
+    def stop(self, timeout=5.0):#drop the queue and wait for running jobs (closing their client ends them early)
+        with self.lock:
+            self.stopped = True
+            workers = list(self.workers)
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except queue.Empty:
+            pass
+        for _ in workers:
+            self.jobs.put(None)
+        for worker in workers:
+            worker.wait(int(timeout * 1000))
+
+
+def format_progress(done, total, rate, eta):#"45% of 1.2 GB, 80.3 MB/s, 0:12 left"
+    share = f"{done * 100 // total}% of {format_size(total)}" if total else format_size(done)
+    minutes, seconds = divmod(int(eta), 60)
+    return f"{share}, {format_size(rate)}/s, {minutes}:{seconds:02d} left"
@@ -0,0 +1,328 @@
+"""Multi-process mode of the server: N worker processes accept on one port, a coordinator holds what they share.
+
+One FileServer runs on one event loop, so the GIL keeps parsing, hashing and
+compression to a single core. With --workers N the command line starts a
+coordinator (this process) and N worker processes instead. Every worker is a
+full FileServer whose listening socket has SO_REUSEPORT set, so the kernel
+spreads new connections over them. File records are shared through the
+SQLite catalog (WAL mode, locked across processes). The rest goes through the
+coordinator, one JSON object per line over a Unix socket:
+
+* client names, claimed when a client connects, so a name is in use once
+  across all workers;
+* session tokens, because a client's data connections may land on another
+  worker than its main connection;
+* NOTIFY messages for a client connected to another worker;
+* the chunks downloads are reading (pins), and garbage collection, which only
+  the coordinator runs, so no worker deletes a chunk another one is sending.
+
+The coordinator handles one message completely before the next, which makes
+every claim and pin atomic. It also does the work needed once at startup
+(catalog migration, staging cleanup, reconciliation) before the workers
+start, and restarts a worker that dies. Workers stop when the coordinator
+goes away. Bandwidth caps for the whole server are split evenly over the
+workers; caps per client apply on each worker.
+"""
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+
+from catalog import is_busy
+
+MESSAGE_LIMIT = 16 << 20#longest line on the coordinator socket, a pin carries the whole manifest of a file
+WORKER_CHECK = 1.0#seconds between checks for dead workers
+START_GRACE = 5.0#a worker dying this soon after its start fails the whole server instead of restarting
+COLLECT_RETRY = 0.5#seconds before a garbage collection that found the catalog locked runs again
+
+
+class CoordinatorLink:
+    """A worker's connection to the coordinator. Requests that need the answer are awaited, the rest are sent and forgotten."""
+
+    def __init__(self, reader, writer, server):
+        self.reader = reader
+        self.writer = writer
+        self.server = server#the worker's FileServer, notifications and invalidations go to it
+        self.pending = {}#request id -> future of the reply
+        self.ids = itertools.count(1)
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()#done once the coordinator is gone
+        self.task = loop.create_task(self.listen())
+
+    @classmethod
+    async def connect(cls, path, server):
+        reader, writer = await asyncio.open_unix_connection(path, limit=MESSAGE_LIMIT)
+        return cls(reader, writer, server)
+
+    def send(self, op, **fields):
+        self.writer.write(json.dumps(dict(fields, op=op)).encode() + b"\n")
+
+    async def request(self, op, **fields):
+        request_id = next(self.ids)
+        future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            self.send(op, id=request_id, **fields)
+            return await future
+        finally:
+            del self.pending[request_id]
+
+    async def listen(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message.get("op")
+                if op == "reply":
+                    future = self.pending.get(message["id"])
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                elif op == "notify":#for a client of this worker
+                    session = self.server.connected_clients.get(message["name"])
+                    if session is not None:
+                        session.notify(message["message"])
+                elif op == "invalidate":#chunks the coordinator collected
+                    for digest in message["digests"]:
+                        self.server.invalidate_chunk(digest)
+        except (ConnectionError, ValueError, KeyError) as e:
+            self.server.log_message(f"Coordinator link failed: {e}")
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Coordinator gone"))
+            self.server.log_message("Coordinator gone, worker stopping.")
+            self.closed.set_result(None)
+
+    async def claim(self, name):#True if no worker had the name, it now belongs to this one
+        return (await self.request("claim", name=name))["ok"]
+
+    def release(self, name):
+        self.send("release", name=name)
+
+    async def register(self, token, name):#session token of a client connected here, before the client learns it
+        await self.request("register", token=token, name=name)
+
+    def unregister(self, token):
+        self.send("unregister", token=token)
+
+    async def attach(self, token):#client name of the session, wherever it is connected, None if unknown
+        return (await self.request("attach", token=token))["name"]
+
+    def notify(self, name, message):#delivered by the worker the client is connected to, if any
+        self.send("notify", name=name, message=message)
+
+    async def pin(self, digests):#returns once no collection can take these chunks
+        await self.request("pin", digests=list(digests))
+
+    def unpin(self, digests):
+        self.send("unpin", digests=list(digests))
+
+    def collect(self):
+        self.send("collect")
+
+
+class _Worker:#coordinator side of one worker connection
+    def __init__(self, writer):
+        self.writer = writer
+        self.names = set()
+        self.tokens = set()
+        self.pins = Counter()#chunk hash -> downloads of this worker reading it
+
+    def send(self, op, **fields):
+        self.writer.write(json.dumps(dict(fields, op=op)).encode() + b"\n")
+
+
+class Coordinator:
+    """Shared state of the workers; storage is a FileServer that is never started, it owns the catalog and the chunks."""
+
+    def __init__(self, storage, workers, options, weights, log=print):
+        self.storage = storage
+        self.count = workers
+        self.options = options#FileServer keyword arguments of every worker
+        self.weights = weights#client name -> bandwidth weight
+        self.log_message = log
+        self.path = None#the Unix socket the workers connect to
+        self.processes = []#[(process, start time)] by worker index
+        self.links = set()
+        self.names = {}#client name -> _Worker it is connected to
+        self.tokens = {}#session token -> client name
+        self.collect_pending = False#a garbage collection is scheduled
+        self.handlers = {#op -> function(link, message), returns the reply fields for a request
+            "claim": self.claim,
+            "release": self.release,
+            "register": self.register,
+            "unregister": self.unregister,
+            "attach": self.attach,
+            "notify": self.notify,
+            "pin": self.pin,
+            "unpin": self.unpin,
+            "collect": self.collect,
+        }
+
+    async def serve(self):
+        self.storage.validate_files()#once for all workers, the reconciliation runs in a thread here
+        self.path = os.path.join(tempfile.mkdtemp(prefix="fileserver-"), "coordinator.sock")
+        server = await asyncio.start_unix_server(self.handle_worker, self.path, limit=MESSAGE_LIMIT)
+        async with server:
+            for index in range(self.count):
+                self.start_worker(index)
+            self.log_message(f"Server started on port {self.storage.port} with {self.count} workers...")
+            while True:
+                await asyncio.sleep(WORKER_CHECK)
+                for index, (process, started) in enumerate(self.processes):
+                    if process.is_alive():
+                        continue
+                    if time.monotonic() - started < START_GRACE:
+                        raise RuntimeError(f"Worker {index} exited at startup (code {process.exitcode}).")
+                    self.log_message(f"Worker {index} exited (code {process.exitcode}), restarting it.")
+                    self.start_worker(index)
+
+    def start_worker(self, index):
+        process = multiprocessing.get_context("spawn").Process(
+            target=run_worker, name=f"worker-{index}", daemon=True,
+            args=(index, self.storage.directory, self.storage.port, worker_options(self.options, index, self.count),
+                  self.weights, self.path),
+        )
+        process.start()
+        entry = (process, time.monotonic())
+        if index < len(self.processes):
+            self.processes[index] = entry
+        else:
+            self.processes.append(entry)
+
+    def stop(self):
+        for process, _ in self.processes:
+            process.terminate()
+        for process, _ in self.processes:
+            process.join(5)
+        if self.path is not None:
+            shutil.rmtree(os.path.dirname(self.path), ignore_errors=True)
+
+    async def handle_worker(self, reader, writer):
+        link = _Worker(writer)
+        self.links.add(link)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                reply = self.handlers[message["op"]](link, message)
+                if "id" in message:
+                    link.send("reply", id=message["id"], **(reply or {}))
+        except (ConnectionError, ValueError, KeyError) as e:
+            self.log_message(f"Worker link failed: {e}")
+        finally:#whatever the worker held is free again
+            self.links.discard(link)
+            for name in link.names:
+                del self.names[name]
+            for token in link.tokens:
+                del self.tokens[token]
+            self.broadcast_collected(self.storage.unpin(list(link.pins.elements())))
+            writer.close()
+
+    def claim(self, link, message):
+        name = message["name"]
+        if name in self.names:
+            return {"ok": False}
+        self.names[name] = link
+        link.names.add(name)
+        return {"ok": True}
+
+    def release(self, link, message):
+        if self.names.get(message["name"]) is link:
+            del self.names[message["name"]]
+            link.names.discard(message["name"])
+
+    def register(self, link, message):
+        self.tokens[message["token"]] = message["name"]
+        link.tokens.add(message["token"])
+
+    def unregister(self, link, message):
+        if message["token"] in link.tokens:
+            del self.tokens[message["token"]]
+            link.tokens.discard(message["token"])
+
+    def attach(self, link, message):
+        return {"name": self.tokens.get(message["token"])}
+
+    def notify(self, link, message):
+        target = self.names.get(message["name"])
+        if target is not None:
+            target.send("notify", name=message["name"], message=message["message"])
+
+    def pin(self, link, message):
+        self.storage.pin(message["digests"])
+        link.pins.update(message["digests"])
+
+    def unpin(self, link, message):
+        link.pins -= Counter(message["digests"])
+        self.broadcast_collected(self.storage.unpin(message["digests"]))
+
+    def collect(self, link, message):#once for all the requests that are queued up by then
+        if not self.collect_pending:
+            self.collect_pending = True
+            asyncio.get_running_loop().call_soon(self.collect_now)
+
+    def collect_now(self):
+        self.collect_pending = False
+        try:
+            collected = self.storage.collect_garbage()
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+            self.collect_pending = True#a worker held the catalog, try again shortly
+            asyncio.get_running_loop().call_later(COLLECT_RETRY, self.collect_now)
+            return
+        self.broadcast_collected(collected)
+
+    def broadcast_collected(self, digests):#workers drop the deleted chunks from their hot-file caches
+        if digests:
+            for link in self.links:
+                link.send("invalidate", digests=digests)
+
+
+def worker_options(options, index, workers):#FileServer keyword arguments of worker index
+    options = dict(options)
+    limits = options.get("bandwidth_limits")
+    if limits is not None:#the server-wide caps are shared out
+        options["bandwidth_limits"] = limits._replace(rate_in=limits.rate_in and limits.rate_in // workers,
+                                                      rate_out=limits.rate_out and limits.rate_out // workers)
+    if options.get("metrics_port") is not None:#one endpoint per worker, on consecutive ports
+        options["metrics_port"] += index
+    return options
+
+
+def run_worker(index, directory, port, options, weights, coordinator_path):#entry point of a worker process
+    from server_core import FileServer#imported here, server_core imports this module
+
+    def log(message):
+        print(f"[worker {index}] {message}", flush=True)
+
+    server = FileServer(directory, port, log=log, coordinator_path=coordinator_path, **options)
+    for name, weight in weights.items():
+        server.bandwidth.set_weight(name, weight)
+    server.run()
+
+
+def serve_cluster(directory, port, workers, options, weights=None, log=print):
+    """Blocking: coordinator in this process and worker processes serving port, until interrupted."""
+    from server_core import FileServer
+
+    storage = FileServer(directory, port, log=log, **dict(options, metrics_port=None, hot_cache_size=0))
+    coordinator = Coordinator(storage, workers, options, weights or {}, log)
+    try:
+        asyncio.run(coordinator.serve())
+    except KeyboardInterrupt:
+        log("Server stopped.")
+    finally:
+        coordinator.stop()
+        storage.stop()
+        storage.save_files()
@@ -0,0 +1,127 @@
+"""Optional compression of transfer bodies (zlib and lzma from the standard library).
+
+The server lists the codecs it has in its HELLO reply and requests name the
+ones the client accepts. Bodies are encoded one chunk at a time, so memory
+stays bounded by the chunk size; data that will not shrink (known compressed
+file types, or a byte entropy sample close to random) goes out raw.
+"""
+import lzma
+import math
+import os
+import zlib
+from collections import Counter
+
+ZLIB_LEVEL = 6
+LZMA_PRESET = 2#higher presets cost far more CPU per chunk for little gain
+CODECS = {#name -> (new compressor, new decompressor), first one is preferred
+    "zlib": (lambda: zlib.compressobj(ZLIB_LEVEL), zlib.decompressobj),
+    "lzma": (lambda: lzma.LZMACompressor(preset=LZMA_PRESET), lzma.LZMADecompressor),
+}
+BLOCK_SIZE = 1 << 20#input and output steps of the streaming encoders and decoders
+MIN_SIZE = 1024#smaller bodies are not worth the header overhead
+MAX_RATIO = 0.9#encoded data larger than this share of the raw size is sent raw instead
+SAMPLE_SIZE = 4096
+MAX_ENTROPY = 7.5#bits per byte; random or already compressed data is close to 8
+INCOMPRESSIBLE_SUFFIXES = {
+    ".gz", ".tgz", ".bz2", ".xz", ".lzma", ".zst", ".zip", ".7z", ".rar", ".jar", ".apk",
+    ".docx", ".xlsx", ".pptx", ".odt", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".mp3", ".aac", ".ogg", ".flac", ".mp4", ".m4a", ".mkv", ".mov", ".avi", ".webm", ".pdf",
+}
+
+
+def pick(offered, accepted, filename=None):#codec for one transfer, or None to send it raw
+    if filename is not None and os.path.splitext(filename)[1].lower() in INCOMPRESSIBLE_SUFFIXES:
+        return None
+    return next((name for name in offered if name in (accepted or ())), None)
+
+
+def entropy(sample):#Shannon entropy of the byte values, in bits per byte
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in Counter(bytes(sample)).values())
+
+
+def looks_compressible(read, size):#read(offset, n) -> bytes; samples the start, middle and end of the data
+    if size < MIN_SIZE:
+        return False
+    offsets = (0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE))
+    return min(entropy(read(offset, SAMPLE_SIZE)) for offset in offsets) < MAX_ENTROPY
+
+
+def encode(codec, data):
+    """data compressed with codec, or None when that would not save enough to be worth it."""
+    view = memoryview(data)
+    if not looks_compressible(lambda offset, n: view[offset:offset + n], len(view)):
+        return None
+    compressor = CODECS[codec][0]()
+    parts = [compressor.compress(view[i:i + BLOCK_SIZE]) for i in range(0, len(view), BLOCK_SIZE)]
+    parts.append(compressor.flush())
+    encoded = b"".join(parts)
+    return encoded if len(encoded) <= len(view) * MAX_RATIO else None
+
+
+def decode(codec, data, limit):#whole encoded buffer -> bytes, at most limit of them
+    writer = DecodingWriter(codec, _Collector(), limit)
+    writer.write(data)
+    writer.finish()
+    if writer.error is not None:
+        raise ValueError(writer.error)
+    return b"".join(writer.target.parts)
+
+
+class _Collector:
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+
+
+class DecodingWriter:
+    """File-like target that decodes what is written to it into target, BLOCK_SIZE at a time.
+
+    Bad or oversized input (more than limit decoded bytes) sets error instead of
+    raising, so a body is still consumed to the end. copy, if given, receives
+    the encoded bytes unchanged (to keep the compressed form as it arrived)."""
+
+    def __init__(self, codec, target, limit=None, copy=None):
+        self.decoder = CODECS[codec][1]()
+        self.target = target
+        self.limit = limit
+        self.copy = copy
+        self.written = 0#decoded bytes
+        self.error = None
+
+    def write(self, data):
+        if self.copy is not None:
+            self.copy.write(data)
+        if self.error is None:
+            try:
+                self.decode(data)
+            except (zlib.error, lzma.LZMAError, EOFError) as e:
+                self.error = f"Bad compressed data: {e}"
+        return len(data)
+
+    def decode(self, data):
+        decoder = self.decoder
+        out = decoder.decompress(data, BLOCK_SIZE)
+        while out:
+            self.written += len(out)
+            if self.limit is not None and self.written > self.limit:
+                self.error = "Compressed data expands past the expected size"
+                return
+            self.target.write(out)
+            if isinstance(decoder, lzma.LZMADecompressor):
+                out = b"" if decoder.needs_input or decoder.eof else decoder.decompress(b"", BLOCK_SIZE)
+            else:
+                out = decoder.decompress(decoder.unconsumed_tail, BLOCK_SIZE) if decoder.unconsumed_tail else b""
+
+    async def drain(self):#let the target catch up with what was decoded (see ChunkingWriter.drain)
+        drain = getattr(self.target, "drain", None)
+        if drain is not None:
+            await drain()
+
+    def finish(self):#end of the body, the stream must be complete
+        if self.error is None and not self.decoder.eof:
+            self.error = "Compressed data is truncated"
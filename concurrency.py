@@ -0,0 +1,64 @@
+"""Shared server state that more than one connection (or thread) touches.
+
+Everything in FileServer runs on one event loop, so plain statements never
+interleave; what can interleave is work on the same key that spans an await
+(see KeyLocks), and anything reached from another thread, such as the GUI
+(see ClientRegistry).
+"""
+import asyncio
+import threading
+
+LOCK_STRIPES = 64
+
+
+class ClientRegistry:
+    """Connected clients by name; claim() checks and inserts in one step.
+
+    Two connections asking for the same name cannot both get it, and the
+    mapping can be read from another thread while the event loop changes it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}#client name -> primary session
+
+    def claim(self, name, session):#True if the name was free and now belongs to session
+        with self.lock:
+            if name in self.sessions:
+                return False
+            self.sessions[name] = session
+            return True
+
+    def release(self, name, session):#only the session holding the name can give it up
+        with self.lock:
+            if self.sessions.get(name) is session:
+                del self.sessions[name]
+
+    def get(self, name):
+        with self.lock:
+            return self.sessions.get(name)
+
+    def names(self):
+        with self.lock:
+            return list(self.sessions)
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.sessions
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
+
+
+class KeyLocks:
+    """Lock striping: a fixed set of asyncio locks, a key always maps to the same one.
+
+    Serializes work on one key (a file, an owner) that awaits in the middle,
+    without keeping a lock object per key. Unrelated keys that share a stripe
+    only wait for each other briefly."""
+
+    def __init__(self, stripes=LOCK_STRIPES):
+        self.locks = [asyncio.Lock() for _ in range(stripes)]
+
+    def __getitem__(self, key):
+        return self.locks[hash(key) % len(self.locks)]
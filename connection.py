@@ -0,0 +1,314 @@
+"""Server-side connection I/O built on asyncio.BufferedProtocol.
+
+asyncio streams allocate a new bytes object for every socket read and copy
+it again on the way out of StreamReader. Here the transport recv_into()s
+straight into buffers we own:
+
+* commands and headers land in a small per-connection bytearray that only
+  grows when a single frame needs it, so idle connections stay cheap;
+* request bodies (uploads) are received in "sink" mode into a large buffer
+  borrowed from a server-wide BufferPool and written to the file from a
+  memoryview inside the transport callback, with no task wake-up per chunk.
+
+ConnectionReader/ConnectionWriter mimic the parts of StreamReader and
+StreamWriter the server uses, so sessions and handlers do not change.
+
+Once the server gives a connection a bandwidth Flow, bodies are received and
+sendfile()d in quanta the flow grants while a limit applies, and written
+bytes are paid for at the next drain().
+"""
+import asyncio
+
+from bandwidth import QUANTUM, RECEIVE, SEND
+
+CONTROL_BUFFER_SIZE = 8192#initial per-connection buffer for commands and headers
+RECV_BUFFER_SIZE = 1 << 20#size of the pooled buffers used for bodies
+DRAIN_STEP = 4 << 20#body bytes received between two drain() calls of a target that has one
+
+
+class BufferPool:
+    """Large receive buffers shared by all connections and reused between uploads."""
+
+    def __init__(self, size=RECV_BUFFER_SIZE, keep=32):
+        self.size = size
+        self.keep = keep#idle buffers kept around, the rest are left to the GC
+        self.free = []
+
+    def acquire(self):
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def release(self, buf):
+        if len(self.free) < self.keep:
+            self.free.append(buf)
+
+
+class _Sink:#state of a body being received straight into a file
+    def __init__(self, f, remaining, buffer, future):
+        self.f = f#None discards the bytes
+        self.remaining = remaining
+        self.buffer = buffer
+        self.future = future
+        self.written = 0
+        self.error = None
+
+
+class ServerConnection(asyncio.BufferedProtocol):
+    def __init__(self, client_connected, pool, metrics=None):
+        self.client_connected = client_connected#coroutine(reader, writer) run per connection
+        self.pool = pool
+        self.metrics = metrics#bytes_in/bytes_out are added up there
+        self.flow = None#bandwidth.Flow once the client is known, None moves everything unthrottled
+        self.buf = bytearray(CONTROL_BUFFER_SIZE)
+        self.start = 0#unread data is buf[start:end]
+        self.end = 0
+        self.eof = False
+        self.closed = False
+        self.waiter = None#future the reader sleeps on until data arrives
+        self.sink = None
+        self.reading_paused = False
+        self.writing_paused = False
+        self.drain_waiters = []
+        self.transport = None
+        self.task = None
+
+    #asyncio protocol callbacks
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.task = asyncio.get_running_loop().create_task(
+            self.client_connected(ConnectionReader(self), ConnectionWriter(self))
+        )
+
+    def get_buffer(self, sizehint):
+        if self.sink is not None:#never read past the body, the next frame stays in self.buf
+            return memoryview(self.sink.buffer)[:min(len(self.sink.buffer), self.sink.remaining)]
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):#move unread bytes to the front
+            size = self.end - self.start
+            self.buf[:size] = self.buf[self.start:self.end]
+            self.start, self.end = 0, size
+        return memoryview(self.buf)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        if self.metrics is not None:
+            self.metrics.bytes_in += nbytes
+        if self.sink is not None:
+            self._sink_updated(nbytes)
+            return
+        self.end += nbytes
+        if self.end - self.start == len(self.buf):#full, wait for the handler to consume
+            self._pause_reading()
+        self._wake()
+
+    def eof_received(self):
+        self.eof = True
+        self._finish_sink()
+        self._wake()
+        return False
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.closed = True
+        self._finish_sink()
+        self._wake()
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError("Connection lost"))
+        self.drain_waiters = []
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.drain_waiters = []
+
+    #helpers used by ConnectionReader
+
+    def _sink_updated(self, nbytes):
+        sink = self.sink
+        if sink.f is not None and sink.error is None:
+            try:
+                sink.f.write(memoryview(sink.buffer)[:nbytes])
+            except Exception as e:#keep consuming the body so the stream stays in sync
+                sink.error = e
+        sink.remaining -= nbytes
+        sink.written += nbytes
+        if not sink.remaining:
+            self._finish_sink()
+
+    def _finish_sink(self):
+        sink = self.sink
+        if sink is None:
+            return
+        self.sink = None
+        self.pool.release(sink.buffer)
+        if not sink.future.done():
+            if sink.error is not None:
+                sink.future.set_exception(sink.error)
+            else:
+                sink.future.set_result(sink.written)
+
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def _pause_reading(self):
+        if not self.reading_paused and not self.closed:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def _resume_reading(self):
+        if self.reading_paused and not self.closed:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def _consumed(self, nbytes):
+        self.start += nbytes
+        if self.end - self.start < len(self.buf):
+            self._resume_reading()
+
+    async def _wait(self):
+        self.waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self.waiter
+        finally:
+            self.waiter = None
+
+    def _grow(self, size):#one frame needs more room than the control buffer has
+        data = self.buf[self.start:self.end]
+        self.buf = bytearray(max(size, 2 * len(self.buf)))
+        self.buf[:len(data)] = data
+        self.start, self.end = 0, len(data)
+        self._resume_reading()
+
+
+class ConnectionReader:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def read(self, n):#up to n bytes, b"" at end of stream
+        conn = self.conn
+        while conn.start == conn.end:
+            if conn.eof:
+                return b""
+            await conn._wait()
+        size = min(n, conn.end - conn.start)
+        data = bytes(conn.buf[conn.start:conn.start + size])
+        conn._consumed(size)
+        return data
+
+    async def readexactly(self, n):
+        conn = self.conn
+        if n > len(conn.buf):
+            conn._grow(n)
+        while conn.end - conn.start < n:
+            if conn.eof:
+                partial = bytes(conn.buf[conn.start:conn.end])
+                conn._consumed(len(partial))
+                raise asyncio.IncompleteReadError(partial, n)
+            await conn._wait()
+        data = bytes(conn.buf[conn.start:conn.start + n])
+        conn._consumed(n)
+        return data
+
+    def unread(self, data):#give back bytes the last read() took too many of, the next read returns them first
+        conn = self.conn
+        if conn.start >= len(data) and conn.buf[conn.start - len(data):conn.start] == data:#still in place
+            conn.start -= len(data)
+            return
+        conn.buf[conn.start:conn.start] = data
+        conn.end += len(data)
+
+    async def readinto_file(self, f, count):
+        """Write the next count bytes to f (None discards them); returns fewer only at end of stream.
+
+        A target with a drain() coroutine (work queued off the event loop) is
+        awaited every DRAIN_STEP bytes, the socket waits meanwhile."""
+        flow = self.conn.flow
+        drain = getattr(f, "drain", None)
+        received = 0
+        while received < count:#one pass unless a bandwidth limit or a drain applies
+            size = count - received
+            if drain is not None:
+                size = min(size, DRAIN_STEP)
+            if flow is not None and flow.limited(RECEIVE):
+                size = min(size, QUANTUM)
+                await flow.take(RECEIVE, size)
+            written = await self.receive(f, size)
+            received += written
+            if written < size:
+                break
+            if drain is not None:
+                await drain()
+        return received
+
+    async def receive(self, f, count):
+        conn = self.conn
+        written = min(count, conn.end - conn.start)
+        if written:#bytes that arrived together with the header
+            if f is not None:
+                f.write(memoryview(conn.buf)[conn.start:conn.start + written])
+            conn._consumed(written)
+        if written == count or conn.eof:
+            return written
+        future = asyncio.get_running_loop().create_future()
+        conn.sink = _Sink(f, count - written, conn.pool.acquire(), future)
+        conn._resume_reading()
+        return written + await future
+
+
+class ConnectionWriter:
+    def __init__(self, conn):
+        self.conn = conn
+        self.transport = conn.transport
+        self.unpaid = 0#bytes written since the last drain, taken from the bandwidth flow there
+
+    def write(self, data):
+        if self.conn.metrics is not None:
+            self.conn.metrics.bytes_out += len(data)
+        if self.conn.flow is not None:
+            self.unpaid += len(data)
+        self.transport.write(data)
+
+    async def sendfile(self, f, offset, count):#zero-copy, raises asyncio.SendfileNotAvailableError where it cannot
+        flow = self.conn.flow
+        loop = asyncio.get_running_loop()
+        sent = 0
+        while sent < count:#one call unless a bandwidth limit applies
+            size = count - sent
+            if flow is not None and flow.limited(SEND):
+                size = min(size, QUANTUM)
+                await flow.take(SEND, size)
+            done = await loop.sendfile(self.transport, f, offset + sent, size, fallback=False)
+            if self.conn.metrics is not None:
+                self.conn.metrics.bytes_out += done
+            sent += done
+            if done < size:
+                break
+        return sent
+
+    async def drain(self):
+        conn = self.conn
+        if self.unpaid:
+            unpaid, self.unpaid = self.unpaid, 0
+            await conn.flow.take(SEND, unpaid)
+        if conn.closed:
+            raise ConnectionResetError("Connection lost")
+        if conn.writing_paused:
+            waiter = asyncio.get_running_loop().create_future()
+            conn.drain_waiters.append(waiter)
+            await waiter
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,973 @@
+"""Python client for the file server: the protocol logic behind ClientApp, usable from scripts.
+
+    with FileClient("127.0.0.1", 5000, "alice", log=print) as client:
+        client.upload("report.pdf")
+        for result in client.download_many([("bob", "data.csv"), ("bob", "photos/")], "downloads"):
+            print(result)
+
+FileClient is blocking and thread-safe. Every call borrows a data connection
+(attached to the session of the main connection) from a pool, so calls from
+several threads run side by side; the main connection only receives the
+server's notifications. A call that fails on a broken connection is retried on
+a new one, reconnecting the session if the server lost it, and large uploads
+and downloads continue where they stopped. Uploads carry a whole-file checksum
+the server checks before it stores anything, and downloads are checked against
+it before the file takes its name. The *_many calls pipeline small files,
+several requests in flight per connection. AsyncFileClient offers the same
+calls as coroutines. Run this file for the command line client.
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import os
+import socket
+import sys
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import compression
+import protocol#framed wire format shared with the server
+import transfer
+
+UPLOAD_WINDOW = 4#chunks of a resumable upload allowed on the wire before waiting for replies
+BATCH_WINDOW = 16#requests allowed on one connection before waiting for replies, when the server has no BATCH
+BATCH_BYTES = 32 << 20#file bytes sent or expected in one batch
+COMPRESSION = ("zlib", "lzma")#codecs this client accepts, preferred first; empty turns compression off
+CONNECT_TIMEOUT = 10#seconds
+DEFAULT_CONCURRENCY = 4#connections a batch call uses at the same time
+POOL_SIZE = 8#idle data connections kept for reuse
+RETRIES = 2#new connections tried after a call failed on a broken one
+RETRY_DELAY = 0.5#seconds, grows with every attempt
+BROKEN = (OSError, protocol.ProtocolError)#the connection is gone or out of step, a new one may work
+
+Result = namedtuple("Result", "item ok message")#outcome of one item of a batch call
+
+
+class FileClientError(Exception):
+    """The server refused a request (the message is its reason), or a transfer could not complete."""
+
+
+class ServerBusy(FileClientError):
+    """The server could not take the request for now and changed nothing; it may be sent again after retry_after seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Progress:
+    """Receives the progress of one transfer; this one ignores it. add() may be called from several threads."""
+
+    def set_total(self, total):#size of the file, once the server told us
+        pass
+
+    def skip(self, count):#bytes that need no transfer (resumed, deduplicated)
+        pass
+
+    def add(self, count):#bytes sent or received
+        pass
+
+
+def shutdown(sock):#wakes up threads blocked on sock (close alone does not), then closes it
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def open_socket(host, port):#header and body go out as separate writes, do not let them wait on each other's ACK
+    sock = socket.create_connection((host, port), CONNECT_TIMEOUT)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def folder_items(directory):#[(path, name on the server)] of every file under directory, named folder/relative/path
+    base = os.path.basename(os.path.normpath(directory))
+    items = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            items.append((path, "/".join([base] + os.path.relpath(path, directory).split(os.sep))))
+    return items
+
+
+def local_path(directory, filename):#where a download goes, folders in the name become directories
+    parts = [part for part in filename.split("/") if part not in ("", ".", "..")]
+    if not parts:
+        raise FileClientError(f"Bad filename '{filename}'")
+    return os.path.join(directory, *parts)
+
+
+class ConnectionPool:
+    """Data connections of one session, reused between calls.
+
+    A connection that saw an error is closed instead of going back, it may be
+    in the middle of a frame. At most size idle connections are kept."""
+
+    def __init__(self, open_connection, size=POOL_SIZE):
+        self.open_connection = open_connection
+        self.size = size
+        self.idle = []
+        self.busy = set()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.lock:
+            sock = self.idle.pop() if self.idle else None
+        if sock is None:
+            sock = self.open_connection()
+        with self.lock:
+            self.busy.add(sock)
+        try:
+            yield sock
+        except BaseException:
+            with self.lock:
+                self.busy.discard(sock)
+            sock.close()
+            raise
+        with self.lock:
+            self.busy.discard(sock)
+            if len(self.idle) < self.size:
+                self.idle.append(sock)
+                return
+        sock.close()
+
+    def close(self):#closes idle connections and interrupts busy ones
+        with self.lock:
+            idle, busy = self.idle, list(self.busy)
+            self.idle = []
+        for sock in idle + busy:
+            shutdown(sock)
+
+
+class FileClient:
+    """Blocking client of one user; see the module docstring."""
+
+    def __init__(self, host, port, name, compression_codecs=COMPRESSION, pool_size=POOL_SIZE, retries=RETRIES,
+                 log=None, on_notify=None, on_disconnect=None):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.accepted_codecs = list(compression_codecs)
+        self.retries = retries
+        self.log_message = log or (lambda message: None)#informational lines (resuming, deduplicated chunks, ...)
+        self.on_notify = on_notify or (lambda message: self.log_message(f"Notification: {message}"))
+        self.on_disconnect = on_disconnect#called from the listener thread when the server drops the session
+        self.main_socket = None#main connection, after the handshake it only carries notifications
+        self.session_token = None#lets more connections join this session
+        self.compression = []#codecs both sides have, agreed on at connect time
+        self.batch_limit = 0#operations the server takes in one BATCH request, 0 if it has no BATCH
+        self.session_lock = threading.Lock()
+        self.request_id = 0#id of the last framed request we sent
+        self.request_id_lock = threading.Lock()
+        self.buffers = threading.local()#receive buffer of each thread, reused by its downloads
+        self.file_list = {}#local mirror of the server listing, {(owner, filename): (size, checksum)}
+        self.file_list_version = 0#catalog version the mirror is at
+        self.file_list_lock = threading.Lock()
+        self.active_downloads = set()#.part files being written, one download per file
+        self.pool = ConnectionPool(self.open_data_connection, pool_size)
+        self.closed = False
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #session
+
+    def connect(self):#open the main connection; raises FileClientError if the server refuses the name
+        with self.session_lock:
+            self.closed = False
+            self.start_session()
+
+    def start_session(self):#called with session_lock held
+        if self.main_socket is not None:
+            shutdown(self.main_socket)
+            self.main_socket = None
+        sock = open_socket(self.host, self.port)
+        try:
+            #negotiate the framed protocol, then send the username
+            response = self.handshake(sock, {"name": self.name})
+            if response.type == protocol.ERROR:
+                raise FileClientError(response.meta.get("message", ""))
+            sock.settimeout(None)
+        except BaseException:
+            sock.close()
+            raise
+        self.main_socket = sock
+        self.session_token = response.meta.get("session_token")
+        self.compression = [name for name in self.accepted_codecs if name in response.meta.get("compression", [])]
+        self.batch_limit = response.meta.get("batch", 0)
+        with self.file_list_lock:#maybe another server, the next LIST fetches a full snapshot
+            self.file_list.clear()
+            self.file_list_version = 0
+        threading.Thread(target=self.listen, args=(sock,), daemon=True).start()
+
+    def reconnect(self, token):#the session behind token is gone: start a new one, unless another thread already did
+        with self.session_lock:
+            if self.closed:
+                raise ConnectionError("Client is closed.")
+            if self.session_token == token:
+                self.log_message("Session lost, reconnecting.")
+                self.pool.close()
+                self.start_session()
+
+    def listen(self, sock):#listener thread of the main connection, where the server pushes NOTIFY frames
+        try:
+            while True:
+                frame = protocol.recv_frame(sock)
+                if frame.body_len:#nothing but notifications is expected here, skip anything else
+                    protocol.recv_exact(sock, frame.body_len)
+                if frame.type == protocol.NOTIFY:
+                    self.on_notify(frame.meta.get("message", ""))
+        except BROKEN:
+            pass
+        if sock is self.main_socket and not self.closed and self.on_disconnect is not None:
+            self.on_disconnect()
+
+    def close(self):
+        with self.session_lock:
+            self.closed = True
+            if self.main_socket is not None:
+                shutdown(self.main_socket)
+                self.main_socket = None
+        self.pool.close()
+
+    @property
+    def connected(self):
+        return self.main_socket is not None
+
+    def handshake(self, sock, hello):#preface and HELLO in one write, returns the server's reply
+        with self.request_id_lock:
+            self.request_id += 1
+            request_id = self.request_id
+        sock.sendall(protocol.PREFACE + protocol.encode_header(protocol.HELLO, request_id, hello))
+        version = protocol.parse_preface(protocol.recv_exact(sock, len(protocol.PREFACE)))
+        if version != protocol.VERSION:
+            raise protocol.ProtocolError(f"Server speaks protocol version {version}, not {protocol.VERSION}")
+        return self.wait_response(sock, request_id)
+
+    def open_data_connection(self):#extra connection that joins the session, the pool calls this
+        for attempt in range(2):
+            token = self.session_token
+            if self.closed or token is None:
+                raise ConnectionError("Not connected to the server.")
+            sock = open_socket(self.host, self.port)
+            try:
+                response = self.handshake(sock, {"name": self.name, "attach": token})
+                if response.type != protocol.ERROR:
+                    sock.settimeout(None)
+                    return sock
+            except BaseException:
+                sock.close()
+                raise
+            sock.close()
+            if attempt == 0:#server restarted or dropped the session, get a new one
+                self.reconnect(token)
+        raise ConnectionError(response.meta.get("message", ""))
+
+    def with_connection(self, work):#work(sock) on a pooled connection, tried again on a new one if it breaks or later if the server is busy
+        for attempt in range(self.retries + 1):
+            try:
+                with self.pool.connection() as sock:
+                    return work(sock)
+            except BROKEN as e:
+                if attempt == self.retries or self.closed:
+                    raise
+                self.log_message(f"Connection problem ({e}), retrying.")
+                time.sleep(RETRY_DELAY * (attempt + 1))
+            except ServerBusy as e:
+                if attempt == self.retries or self.closed:
+                    raise
+                self.log_message("Server busy, retrying.")
+                time.sleep(e.retry_after * (attempt + 1))
+
+    def send_request(self, sock, frame_type, meta, body_len=0):#send a request header, the body (if any) follows
+        with self.request_id_lock:
+            self.request_id += 1
+            request_id = self.request_id
+        sock.sendall(protocol.encode_header(frame_type, request_id, meta, body_len))
+        return request_id
+
+    def wait_response(self, sock, request_id):#read frames until the reply to request_id arrives
+        while True:
+            frame = protocol.recv_frame(sock)
+            if frame.type == protocol.NOTIFY:#server push, not a reply
+                self.on_notify(frame.meta.get("message", ""))
+            elif frame.request_id == request_id:
+                return frame
+            else:#reply to a request we gave up on, drop its body
+                protocol.recv_exact(sock, frame.body_len)
+
+    def check(self, response):#the reply's message, FileClientError for an ERROR reply
+        message = response.meta.get("message", "")
+        if response.type == protocol.ERROR:
+            if "retry_after" in response.meta:
+                raise ServerBusy(message, float(response.meta["retry_after"]))
+            raise FileClientError(message)
+        return message
+
+    def run_streams(self, work, groups, sock):
+        """work(sock, group) for every group at the same time, each over its own connection.
+
+        The first group runs in this thread on sock, the others in threads on more
+        pooled connections. Returns the results in group order."""
+        if not groups:
+            return []
+        if len(groups) == 1:
+            return [work(sock, groups[0])]
+
+        def pooled(group):
+            with self.pool.connection() as extra:
+                return work(extra, group)
+        with ThreadPoolExecutor(len(groups) - 1) as pool:
+            futures = [pool.submit(pooled, group) for group in groups[1:]]
+            first = work(sock, groups[0])
+            return [first] + [future.result() for future in futures]
+
+    def recv_buffer(self):#reusable receive buffer of the calling thread
+        buf = getattr(self.buffers, "buf", None)
+        if buf is None:
+            buf = self.buffers.buf = bytearray(transfer.RECV_CHUNK_SIZE)
+        return buf
+
+    #listing
+
+    def list_files(self, owner=None, prefix=None, checksums=False):
+        """[(owner, filename, size)] on the server, optionally filtered; with checksums each entry
+        ends with the file's whole-file checksum too (None if the server has none)."""
+        self.with_connection(self.refresh_file_list)
+        with self.file_list_lock:
+            return sorted((file_owner, filename, size, checksum)[:4 if checksums else 3]
+                          for (file_owner, filename), (size, checksum) in self.file_list.items()
+                          if (owner is None or file_owner == owner) and (prefix is None or filename.startswith(prefix)))
+
+    def refresh_file_list(self, sock):#bring the local mirror of the listing up to date
+        #only ask for what changed since the listing we already have
+        request_id = self.send_request(sock, protocol.LIST, {
+            "since": self.file_list_version, "accept_encoding": self.compression, "checksums": True})
+        response = self.wait_response(sock, request_id)#response of server
+        self.check(response)
+
+        #the changes are the body of the reply, one buffer of the announced size filled with recv_into
+        received_data = protocol.recv_exact(sock, response.body_len)
+        if response.meta.get("encoding"):
+            received_data = compression.decode(response.meta["encoding"], received_data, None)
+        self.apply_file_changes(received_data.decode(), response.meta)
+
+    def apply_file_changes(self, changes, meta):#update the local mirror of the server's file list
+        with self.file_list_lock:
+            if meta.get("reset"):#server sent a full snapshot
+                self.file_list.clear()
+            for line in changes.splitlines():
+                op, owner, filename, size, *checksum = line.split("\t")
+                if op == "+":
+                    self.file_list[(owner, filename)] = (int(size), checksum[0] if checksum and checksum[0] else None)
+                else:
+                    self.file_list.pop((owner, filename), None)
+            self.file_list_version = meta.get("version", 0)
+
+    def known_size(self, owner, filename):#size from the last listing, 0 if unknown
+        with self.file_list_lock:
+            return self.file_list.get((owner, filename), (0, None))[0]
+
+    #uploads
+
+    def upload(self, path, filename=None, progress=None):#returns the server's message
+        filename = filename or os.path.basename(path)
+        progress = progress or Progress()
+        progress.set_total(os.path.getsize(path))
+        return self.with_connection(lambda sock: self.upload_on(sock, path, filename, progress))
+
+    def upload_on(self, sock, path, filename, progress):
+        filesize = os.path.getsize(path)
+        if filesize >= transfer.DEDUP_MIN_SIZE:#hashes first, stored chunks are skipped; chunks survive a dropped connection
+            return self.check(self.upload_resumable(sock, path, filename, filesize, progress))
+        request_id = self.send_upload(sock, path, filename, filesize)
+        progress.add(filesize)
+        return self.check(self.wait_response(sock, request_id))#response of server
+
+    def send_upload(self, sock, path, filename, filesize):#a whole small file as one UPLOAD, returns the request id
+        #the whole-file checksum goes with the header, the server stores nothing that does not match it
+        codec = compression.pick(self.compression, self.compression, filename)
+        encoded = None
+        if codec is not None:#small enough to compress in one piece
+            with open(path, 'rb') as f:
+                data = f.read()
+            checksum = transfer.file_checksum([transfer.chunk_hasher(data).hexdigest()])
+            encoded = compression.encode(codec, data)
+        else:
+            checksum = transfer.file_checksum(transfer.file_chunk_hashes(path))
+        if encoded is not None:
+            request_id = self.send_request(sock, protocol.UPLOAD, {
+                "filename": filename, "size": filesize, "encoding": codec, "checksum": checksum}, len(encoded))
+            sock.sendall(encoded)
+        else:
+            #upload header carries the size, the file bytes follow directly
+            request_id = self.send_request(sock, protocol.UPLOAD, {"filename": filename, "checksum": checksum}, filesize)
+            with open(path, 'rb') as f:
+                transfer.send_file_blocking(sock, f, 0, filesize)#zero-copy where possible
+        return request_id
+
+    def upload_resumable(self, sock, path, filename, filesize, progress):#returns the server's final reply
+        #chunk hashes go first, the server skips every chunk it already stores (from anyone)
+        hashes = transfer.file_chunk_hashes(path, transfer.TRANSFER_CHUNK_SIZE)
+        request_id = self.send_request(sock, protocol.UPLOAD_OPEN, {
+            "filename": filename, "size": filesize, "chunk_size": transfer.TRANSFER_CHUNK_SIZE, "hashes": hashes})
+        response = self.wait_response(sock, request_id)
+        if response.type == protocol.ERROR:
+            return response
+        upload_id = response.meta["upload_id"]
+        offset = response.meta["offset"]#bytes the server already has from an earlier attempt
+        chunk_size = response.meta["chunk_size"]
+        stored = set(response.meta.get("stored", []))#chunks past offset that arrived out of order
+        if response.meta.get("resumed", offset > 0):
+            self.log_message(f"Resuming upload of '{filename}' at byte {offset}.")
+
+        #missing chunks are split into contiguous runs, each sent over its own connection
+        missing = [index for index in range(-(-offset // chunk_size), -(-filesize // chunk_size)) if index not in stored]
+        progress.skip(filesize - sum(min(chunk_size, filesize - index * chunk_size) for index in missing))
+        if chunk_size != transfer.TRANSFER_CHUNK_SIZE:#server picked another size, our hashes do not apply
+            hashes = transfer.file_chunk_hashes(path, chunk_size)
+        if response.meta.get("deduplicated"):
+            self.log_message(f"{response.meta['deduplicated']} of {len(hashes)} chunks of '{filename}'"
+                             " are already stored on the server, skipping them.")
+        streams = transfer.choose_streams(len(missing) * chunk_size) if self.session_token else 1
+        groups = transfer.split_chunks(missing, streams)
+        if len(groups) > 1:
+            self.log_message(f"Uploading '{filename}' over {len(groups)} connections.")
+
+        codec = compression.pick(self.compression, self.compression, filename)
+
+        def work(stream, indexes):
+            return self.send_chunks(stream, path, upload_id, filesize, chunk_size, hashes, indexes, codec, progress)
+        for response in self.run_streams(work, groups, sock):
+            if response is not None:
+                return response
+
+        request_id = self.send_request(sock, protocol.UPLOAD_COMMIT, {
+            "upload_id": upload_id, "checksum": transfer.file_checksum(hashes)})
+        return self.wait_response(sock, request_id)
+
+    def send_chunks(self, sock, path, upload_id, filesize, chunk_size, hashes, indexes, codec=None, progress=None):
+        """Send the given chunks over sock; returns the first error reply, or None when all were stored.
+
+        With a codec every chunk that shrinks enough goes compressed, the others raw."""
+        #chunks are pipelined, replies are checked while later chunks are already on the wire
+        pending = []
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        with open(path, 'rb') as f:
+            for i, index in enumerate(indexes):
+                offset = index * chunk_size
+                f.seek(offset)
+                n = f.readinto(view[:min(chunk_size, filesize - offset)])
+                meta = {"upload_id": upload_id, "offset": offset, "crc32": zlib.crc32(view[:n]), "hash": hashes[index]}
+                body = view[:n]
+                encoded = compression.encode(codec, body) if codec is not None else None
+                if encoded is not None:
+                    meta["encoding"] = codec
+                    body = encoded
+                pending.append(self.send_request(sock, protocol.UPLOAD_CHUNK, meta, len(body)))
+                sock.sendall(body)
+                if progress is not None:
+                    progress.add(n)
+                while pending and (len(pending) >= UPLOAD_WINDOW or i == len(indexes) - 1):
+                    response = self.wait_response(sock, pending.pop(0))
+                    if response.type == protocol.ERROR:#later chunks fail too, skip to their last reply
+                        if pending:
+                            self.wait_response(sock, pending[-1])
+                        return response
+        return None
+
+    #downloads
+
+    def download(self, owner, filename, directory, progress=None):#returns the local path of the file
+        progress = progress or Progress()
+        return self.with_connection(lambda sock: self.download_on(sock, owner, filename, directory, progress))
+
+    def download_on(self, sock, owner, filename, directory, progress):
+        #a .part file left by an interrupted download is continued, not started over
+        filepath = local_path(directory, filename)
+        part_path = self.claim_part(filepath)
+        try:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            streams = transfer.choose_streams(self.known_size(owner, filename) - offset) if self.session_token else 1
+            if streams > 1:#large file, chunk ranges come over several connections at once
+                response, complete, problem = self.download_parallel(sock, owner, filename, part_path, offset, streams, progress)
+            else:
+                request_id = self.send_request(sock, protocol.DOWNLOAD, self.download_meta(owner, filename, offset))
+                response = self.wait_response(sock, request_id)#server response
+                response, complete, problem = self.finish_download(sock, response, filename, part_path, progress)
+            return self.finish_part(response, complete, problem, filepath, offset)
+        finally:
+            self.release_part(part_path)
+
+    def claim_part(self, filepath):#one download per local file at a time; returns the .part path
+        part_path = filepath + ".part"
+        with self.file_list_lock:
+            if part_path in self.active_downloads:
+                raise FileClientError(f"'{filepath}' is already being downloaded.")
+            self.active_downloads.add(part_path)
+        try:
+            os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        except OSError:
+            self.release_part(part_path)
+            raise
+        return part_path
+
+    def release_part(self, part_path):
+        with self.file_list_lock:
+            self.active_downloads.discard(part_path)
+
+    def finish_part(self, response, complete, problem, filepath, offset):#rename a complete .part, or report why not
+        part_path = filepath + ".part"
+        if response.type != protocol.OK:
+            if offset and os.path.exists(part_path):#stale .part that no longer fits the file
+                os.remove(part_path)
+            self.check(response)
+        if complete == response.meta["size"]:#checking if file received correctly
+            os.replace(part_path, filepath)
+            return filepath
+        message = f"{problem}, download again to resume at byte {complete}"
+        if problem == "File download incomplete":#the connection broke, a retry continues from here
+            raise ConnectionError(message)
+        raise FileClientError(message)
+
+    def download_meta(self, owner, filename, offset):#DOWNLOAD of the rest of a file as one reply
+        return {"owner": owner, "filename": filename, "offset": offset, "checksums": True,
+                "accept_encoding": self.compression}
+
+    def finish_download(self, sock, response, filename, part_path, progress):
+        """The body of a download_meta reply into part_path; returns (reply, bytes complete, problem)."""
+        if response.type != protocol.OK:
+            return response, 0, None
+        meta = response.meta#the file is the body of the reply, no READY needed
+        start = meta["offset"]#server moves the start back to a chunk boundary
+        progress.set_total(meta["size"])
+        progress.skip(start)
+        if start:
+            self.log_message(f"Resuming download of '{filename}' at byte {start}.")
+
+        with open(part_path, 'ab') as f:#receiving file through the reusable buffer
+            f.truncate(start)
+            #chunks are hashed on the hash pool as they arrive, a resumed start from disk meanwhile
+            target = f
+            if meta.get("checksum"):
+                target = transfer.ChunkHashWriter(f, meta["chunk_size"], part_path, start)
+            bytes_received, verified = self.receive_download(sock, response, target, self.recv_buffer(), progress)
+            f.truncate(start + verified)#keep only chunks that matched their checksum
+
+        if bytes_received < meta["length"]:
+            return response, start + verified, "File download incomplete"
+        if start + verified < meta["size"]:
+            return response, start + verified, "Checksum mismatch"
+        if target is f:#the server gave no whole-file checksum, the chunk crc32s are all there is
+            return response, meta["size"], None
+        return self.check_file(response, target.digests(), part_path)
+
+    def check_file(self, response, digests, part_path):#complete .part against the whole-file checksum
+        if transfer.file_checksum(digests) == response.meta["checksum"]:
+            return response, response.meta["size"], None
+        #every chunk passed its crc32, yet the file is not the one uploaded; resuming would not help
+        os.truncate(part_path, 0)
+        return response, 0, "File checksum mismatch"
+
+    def download_parallel(self, sock, owner, filename, part_path, offset, streams, progress):
+        """Like finish_download, with the missing chunks split into one byte range per connection."""
+        #an empty range tells us the size, chunk size and aligned start without sending data
+        request_id = self.send_request(sock, protocol.DOWNLOAD, {
+            "owner": owner, "filename": filename, "offset": offset, "length": 0, "checksums": True})
+        response = self.wait_response(sock, request_id)
+        if response.type != protocol.OK:
+            return response, 0, None
+        meta = response.meta
+        start, size, chunk_size = meta["offset"], meta["size"], meta["chunk_size"]
+        progress.set_total(size)
+        progress.skip(start)
+        if start:
+            self.log_message(f"Resuming download of '{filename}' at byte {start}.")
+        groups = transfer.split_chunks(list(range(start // chunk_size, -(-size // chunk_size))), streams)
+        self.log_message(f"Downloading '{filename}' over {len(groups)} connections.")
+        #every range hashes its own chunks as they arrive, the start of a resumed download is read back meanwhile
+        hashing = bool(meta.get("checksum"))
+        before = transfer.hash_pool().submit(transfer.file_chunk_hashes, part_path, chunk_size, count=start) \
+            if hashing and start else None
+
+        def work(stream, indexes):#returns (bytes expected, received, verified, ChunkHashWriter or None) of one range
+            first = indexes[0] * chunk_size
+            length = min(size, (indexes[-1] + 1) * chunk_size) - first
+            request_id = self.send_request(stream, protocol.DOWNLOAD, {
+                "owner": owner, "filename": filename, "offset": first, "length": length,
+                "checksums": True, "accept_encoding": self.compression})
+            reply = self.wait_response(stream, request_id)
+            if reply.type != protocol.OK:#e.g. deleted meanwhile
+                return length, 0, 0, None
+            fd = os.open(part_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+            try:#ranges are written in place, each through its own offset
+                target = transfer.PositionalWriter(fd, first)
+                if hashing:
+                    target = transfer.ChunkHashWriter(target, chunk_size)
+                received, verified = self.receive_download(stream, reply, target, self.recv_buffer(), progress)
+            finally:
+                os.close(fd)
+            return length, received, verified, target if hashing else None
+
+        results = []
+        with open(part_path, 'ab') as f:
+            f.truncate(start)
+            try:
+                results = self.run_streams(work, groups, sock)
+            finally:#keep only the prefix where every chunk arrived and matched its checksum
+                complete = start
+                for length, received, verified, _ in results:
+                    complete += verified
+                    if verified < length:
+                        break
+                f.truncate(complete)
+        if any(received < length for length, received, _, _ in results):
+            return response, complete, "File download incomplete"
+        if complete < size:
+            return response, complete, "Checksum mismatch"
+        if not hashing:#the server gave no whole-file checksum
+            return response, size, None
+        digests = before.result() if before is not None else []
+        for *_, target in results:
+            digests += target.digests()
+        return self.check_file(response, digests, part_path)
+
+    def receive_download(self, sock, reply, f, buf, progress=None):
+        """Body of a DOWNLOAD reply into f; returns (bytes received, leading bytes verified).
+
+        A compressed reply comes as one frame per chunk, FLAG_MORE set on all but the
+        last; each frame says whether its chunk is encoded. Every chunk is checked
+        against its crc32, and the whole body is read even after a mismatch."""
+        chunk_size, checksums, length = reply.meta["chunk_size"], reply.meta["checksums"], reply.meta["length"]
+        count = progress.add if progress is not None else None
+        received = verified = 0
+        frame = reply
+        try:
+            while True:
+                index = received // chunk_size
+                codec = frame.meta.get("encoding")
+                if codec is not None:#one compressed chunk
+                    data = protocol.recv_exact(sock, frame.body_len)
+                    try:
+                        data = compression.decode(codec, data, chunk_size)
+                    except ValueError:#counts as a checksum mismatch
+                        data = b""
+                    f.write(data)
+                    n = min(chunk_size, length - received)
+                    good = n if len(data) == n and index < len(checksums) and zlib.crc32(data) == checksums[index] else 0
+                    if count is not None:
+                        count(n)
+                else:
+                    n, good = transfer.recv_chunks_into_file(
+                        sock, f, frame.body_len, buf, chunk_size, checksums[index:], count)
+                if verified == received:
+                    verified += good
+                received += n
+                if received >= length or (codec is None and n < frame.body_len) or not frame.flags & protocol.FLAG_MORE:
+                    break
+                frame = self.wait_response(sock, reply.request_id)
+                if frame.type != protocol.OK:#e.g. the file went away halfway
+                    break
+        except ConnectionError:#keep what was verified, the caller reports the rest
+            pass
+        return received, verified
+
+    #deletes
+
+    def delete(self, filename):#returns the server's message
+        def work(sock):
+            request_id = self.send_request(sock, protocol.DELETE, {"filename": filename})#delete command
+            return self.check(self.wait_response(sock, request_id))
+        return self.with_connection(work)
+
+    #batches: small files go as BATCH requests, a manifest of up to batch_limit operations answered in
+    #one round trip (to a server without BATCH: single requests, BATCH_WINDOW in flight), over several
+    #connections at once. Large files go one by one with parallel streams, and items a broken connection
+    #left unanswered are retried one at a time. Every call returns one Result per item, in order, and
+    #never raises for a single item
+
+    def upload_many(self, items, concurrency=DEFAULT_CONCURRENCY):
+        """items: paths or (path, name on the server) pairs; a directory uploads everything under it."""
+        pairs = []
+        for item in items:
+            path, filename = item if isinstance(item, tuple) else (item, None)
+            if os.path.isdir(path):
+                pairs.extend(folder_items(path))
+            else:
+                pairs.append((path, filename or os.path.basename(path)))
+
+        def size(item):#small files go in batches, the rest (and missing ones) hash first through upload()
+            try:
+                filesize = os.path.getsize(item[0])
+            except OSError:
+                return None
+            return filesize if filesize < transfer.DEDUP_MIN_SIZE else None
+
+        def prepare(item):
+            path, filename = item
+            with open(path, 'rb') as f:
+                data = f.read()
+            meta = {"filename": filename, "size": len(data),
+                    "checksum": transfer.file_checksum([transfer.chunk_hasher(data).hexdigest()])}
+            codec = compression.pick(self.compression, self.compression, filename)
+            encoded = compression.encode(codec, data) if codec is not None else None
+            if encoded is not None:
+                meta["encoding"] = codec
+                data = encoded
+            return protocol.UPLOAD, meta, data
+
+        def one(item):
+            return self.upload(*item)
+        return self.run_batch(pairs, size, prepare, lambda sock, item, reply: self.check(reply), one, concurrency)
+
+    def download_many(self, items, directory, concurrency=DEFAULT_CONCURRENCY):
+        """items: (owner, filename) pairs; a filename ending in / downloads the owner's files under that folder."""
+        listing = self.list_files()
+        sizes = {(owner, filename): filesize for owner, filename, filesize in listing}
+        pairs = []
+        for owner, filename in items:
+            if filename.endswith("/"):
+                pairs.extend((file_owner, name) for file_owner, name, _ in listing
+                             if file_owner == owner and name.startswith(filename))
+            else:
+                pairs.append((owner, filename))
+        parts = {}#item -> (.part path, offset) while its request is in flight
+
+        def size(item):#unknown files go through download() too, to report the server's error
+            filesize = sizes.get(item)
+            return filesize if filesize is not None and filesize <= transfer.TRANSFER_CHUNK_SIZE else None
+
+        def prepare(item):
+            owner, filename = item
+            part_path = self.claim_part(local_path(directory, filename))
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            parts[item] = (part_path, offset)
+            return protocol.DOWNLOAD, self.download_meta(owner, filename, offset), b""
+
+        def receive(sock, item, reply):
+            part_path, offset = parts.pop(item)
+            try:
+                response, complete, problem = self.finish_download(sock, reply, item[1], part_path, Progress())
+                return self.finish_part(response, complete, problem, part_path[:-len(".part")], offset)
+            finally:
+                self.release_part(part_path)
+
+        def one(item):
+            if item in parts:#its batch broke before the reply came
+                self.release_part(parts.pop(item)[0])
+            return self.download(*item, directory)
+        try:
+            return self.run_batch(pairs, size, prepare, receive, one, concurrency)
+        finally:
+            for part_path, _ in parts.values():#batches the server refused as a whole
+                self.release_part(part_path)
+
+    def delete_many(self, filenames, concurrency=1):
+        def prepare(filename):
+            return protocol.DELETE, {"filename": filename}, b""
+        return self.run_batch(list(filenames), lambda filename: 0, prepare,
+                              lambda sock, filename, reply: self.check(reply), self.delete, concurrency)
+
+    def run_batch(self, items, size, prepare, receive, one, concurrency):
+        """size(item): bytes the item adds to a batch, None to run it alone as one(item).
+
+        prepare(item) gives (frame type, meta, body) of its request, receive(sock, item, reply)
+        reads the reply (the first frame of it) and returns the item's message."""
+        results = [None] * len(items)
+        sizes = [size(item) for item in items]
+        batched = [i for i, cost in enumerate(sizes) if cost is not None]
+        limit = min(self.batch_limit or protocol.MAX_BATCH, -(-len(batched) // max(1, concurrency)) or 1)
+        groups = []#runs of items, each one BATCH request (or one pipeline)
+        group_bytes = 0
+        for i in batched:
+            if not groups or len(groups[-1]) >= limit or group_bytes + sizes[i] > BATCH_BYTES:
+                groups.append([])
+                group_bytes = 0
+            groups[-1].append(i)
+            group_bytes += sizes[i]
+
+        def run_one(i):
+            try:
+                results[i] = Result(items[i], True, one(items[i]))
+            except (FileClientError, OSError, protocol.ProtocolError, ValueError) as e:
+                results[i] = Result(items[i], False, str(e))
+
+        def answer(i, sock, reply):
+            try:
+                results[i] = Result(items[i], True, receive(sock, items[i], reply))
+            except FileClientError as e:
+                results[i] = Result(items[i], False, str(e))
+
+        def run_group(indexes):
+            requests = []
+            for i in indexes:
+                try:
+                    requests.append((i,) + prepare(items[i]))
+                except (FileClientError, OSError, ValueError) as e:#e.g. the local file went away
+                    results[i] = Result(items[i], False, str(e))
+            try:
+                with self.pool.connection() as sock:
+                    if self.batch_limit:
+                        self.send_batch(sock, requests, answer)
+                    else:
+                        self.send_pipelined(sock, requests, answer)
+            except FileClientError as e:#the server refused the whole batch
+                for i in indexes:
+                    if results[i] is None:
+                        results[i] = Result(items[i], False, str(e))
+            except BROKEN:#the rest go one at a time, on new connections
+                for i in indexes:
+                    if results[i] is None:
+                        run_one(i)
+
+        with ThreadPoolExecutor(max(1, concurrency)) as pool:
+            jobs = [pool.submit(run_group, indexes) for indexes in groups]
+            jobs += [pool.submit(run_one, i) for i, cost in enumerate(sizes) if cost is None]
+            for job in jobs:
+                job.result()
+        return results
+
+    def send_batch(self, sock, requests, answer):#[(index, frame type, meta, body)] as one BATCH request
+        ops = [dict(meta, op=protocol.COMMAND_NAMES[frame_type]) for _, frame_type, meta, _ in requests]
+        for op, (*_, body) in zip(ops, requests):
+            if op["op"] == "UPLOAD":#its share of the body; for a DOWNLOAD, length would be a byte range
+                op["length"] = len(body)
+        request_id = self.send_request(sock, protocol.BATCH, {"ops": ops}, sum(len(body) for *_, body in requests))
+        for *_, body in requests:#upload bodies one after another, in manifest order
+            if body:
+                sock.sendall(body)
+        while True:#a frame per item as the server gets to it, then the summary
+            reply = self.wait_response(sock, request_id)
+            if "index" not in reply.meta:
+                self.check(reply)
+                return
+            if not 0 <= reply.meta["index"] < len(requests):
+                raise protocol.ProtocolError(f"Batch reply for unknown item {reply.meta['index']}")
+            answer(requests[reply.meta["index"]][0], sock, reply)
+
+    def send_pipelined(self, sock, requests, answer):#one request per item, BATCH_WINDOW ahead of the replies
+        pending = deque()
+        for n, (i, frame_type, meta, body) in enumerate(requests):
+            pending.append((i, self.send_request(sock, frame_type, meta, len(body))))
+            if body:
+                sock.sendall(body)
+            while pending and (len(pending) >= BATCH_WINDOW or n == len(requests) - 1):
+                i, request_id = pending.popleft()
+                answer(i, sock, self.wait_response(sock, request_id))
+
+
+class AsyncFileClient:
+    """FileClient for asyncio code: the same calls as coroutines, run on a thread pool of the client.
+
+        async with AsyncFileClient("127.0.0.1", 5000, "alice") as client:
+            await asyncio.gather(client.upload("a.bin"), client.upload("b.bin"))
+    """
+
+    def __init__(self, host, port, name, workers=DEFAULT_CONCURRENCY, **options):
+        self.client = FileClient(host, port, name, **options)
+        self.executor = ThreadPoolExecutor(workers)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+    async def connect(self):
+        await self.call(self.client.connect)
+
+    async def close(self):
+        await self.call(self.client.close)
+        self.executor.shutdown(wait=False)
+
+    async def list_files(self, owner=None, prefix=None, checksums=False):
+        return await self.call(self.client.list_files, owner, prefix, checksums)
+
+    async def upload(self, path, filename=None, progress=None):
+        return await self.call(self.client.upload, path, filename, progress)
+
+    async def download(self, owner, filename, directory, progress=None):
+        return await self.call(self.client.download, owner, filename, directory, progress)
+
+    async def delete(self, filename):
+        return await self.call(self.client.delete, filename)
+
+    async def upload_many(self, items, concurrency=DEFAULT_CONCURRENCY):
+        return await self.call(self.client.upload_many, items, concurrency)
+
+    async def download_many(self, items, directory, concurrency=DEFAULT_CONCURRENCY):
+        return await self.call(self.client.download_many, items, directory, concurrency)
+
+    async def delete_many(self, filenames, concurrency=1):
+        return await self.call(self.client.delete_many, filenames, concurrency)
+
+
+def main(argv=None):#command line client, the same operations as the client window
+    parser = argparse.ArgumentParser(description="File server client.")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("name", help="username")
+    parser.add_argument("-j", "--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="connections used at once")
+    parser.add_argument("--no-compression", action="store_true", help="never compress transfers")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print failures")
+    commands = parser.add_subparsers(dest="command", required=True)
+    upload = commands.add_parser("upload", help="upload files and folders")
+    upload.add_argument("paths", nargs="+")
+    download = commands.add_parser("download", help="download files of one owner (name/ for a folder)")
+    download.add_argument("owner")
+    download.add_argument("filenames", nargs="+")
+    download.add_argument("-o", "--output", default=".", help="download directory (default .)")
+    delete = commands.add_parser("delete", help="delete your files")
+    delete.add_argument("filenames", nargs="+")
+    listing = commands.add_parser("list", help="list files on the server")
+    listing.add_argument("--owner")
+    listing.add_argument("--prefix")
+    listing.add_argument("--checksums", action="store_true", help="show the whole-file checksum of each file")
+    args = parser.parse_args(argv)
+
+    log = (lambda message: None) if args.quiet else print
+    codecs = () if args.no_compression else COMPRESSION
+    try:
+        with FileClient(args.host, args.port, args.name, codecs, log=log) as client:
+            if args.command == "list":
+                for owner, filename, size, *checksum in client.list_files(args.owner, args.prefix, args.checksums):
+                    print("\t".join([filename, owner, str(size)] + [value or "-" for value in checksum]))
+                return 0
+            if args.command == "upload":
+                results = client.upload_many(args.paths, args.concurrency)
+            elif args.command == "download":
+                results = client.download_many([(args.owner, name) for name in args.filenames], args.output,
+                                               args.concurrency)
+            else:
+                results = client.delete_many(args.filenames)
+    except (FileClientError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    for item, ok, message in results:
+        if not ok:
+            print(f"Error: {item}: {message}", file=sys.stderr)
+        elif not args.quiet:
+            print(f"{item}: {message}")
+    return 0 if all(ok for _, ok, _ in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Hot-file cache of the server: chunk files many clients download stay mapped in memory.
+
+Without it every download opens each chunk file and sendfile()s it. With it,
+a chunk that is requested again gets one read-only mmap, and every download of
+it, concurrent ones included, writes memoryview slices of that mapping: no
+open, fstat or sendfile setup per download. That setup is what small chunks
+cost; large ones are cheaper to sendfile than to copy into the transport, so
+only chunks up to HOT_MAX_FILE are cached.
+
+Chunk files are content-addressed and never change, so a mapping cannot go
+stale. A re-upload or delete leaves the old chunks to garbage collection, and
+FileServer invalidates them as they are removed. Admission takes a second
+request within the recent misses, so one-off downloads do not push out hot
+entries. Eviction is LRU with a second chance for entries hit more than once
+(their count is halved on each pass), so steady favourites outlive bursts.
+Evicting only drops the cache's reference; downloads still writing from a
+mapping keep it alive until they are done.
+"""
+import mmap
+import os
+from collections import OrderedDict
+
+HOT_CACHE_SIZE = 256 << 20#bytes mapped at most
+HOT_MAX_FILE = 1 << 20#larger files are always sent with sendfile: for them its zero copy beats the saved setup
+RECENT_MISSES = 4096#paths remembered for admission on their next request
+
+
+class _Entry:
+    __slots__ = ("view", "size", "hits")
+
+    def __init__(self, mapping, size):
+        self.view = memoryview(mapping)#the mapping lives as long as this view or a slice of it
+        self.size = size
+        self.hits = 0
+
+
+class HotFileCache:
+    """path -> read-only mapping of the whole file, bounded by capacity bytes. Event loop only."""
+
+    def __init__(self, capacity=HOT_CACHE_SIZE, max_file=HOT_MAX_FILE):
+        #Windows cannot delete a file that is mapped, and chunks are deleted while downloads may map them
+        self.capacity = capacity if os.name != "nt" else 0
+        self.max_file = max_file
+        self.entries = OrderedDict()#path -> _Entry, least recently used first
+        self.recent_misses = OrderedDict()#path -> None, oldest first
+        self.size = 0#bytes mapped
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, size):#memoryview of the whole file of size bytes, or None: send it the usual way
+        if size > self.max_file:#never cached, so not even a miss
+            return None
+        entry = self.entries.get(path)
+        if entry is not None:
+            self.entries.move_to_end(path)
+            entry.hits += 1
+            self.hits += 1
+            return entry.view
+        self.misses += 1
+        if not self.capacity:
+            return None
+        if path not in self.recent_misses:#first request: only remembered
+            self.recent_misses[path] = None
+            if len(self.recent_misses) > RECENT_MISSES:
+                self.recent_misses.popitem(last=False)
+            return None
+        del self.recent_misses[path]
+        return self.admit(path)
+
+    def admit(self, path):
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if not 0 < size <= min(self.max_file, self.capacity):#empty files cannot be mapped
+                    return None
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        self.make_room(size)
+        entry = self.entries[path] = _Entry(mapping, size)
+        self.size += size
+        return entry.view
+
+    def make_room(self, size):
+        while self.entries and self.size + size > self.capacity:
+            path, entry = next(iter(self.entries.items()))
+            if entry.hits > 1:#second chance, with half the count
+                entry.hits //= 2
+                self.entries.move_to_end(path)
+                continue
+            self.drop(path)
+            self.evictions += 1
+
+    def drop(self, path):
+        entry = self.entries.pop(path)
+        self.size -= entry.size
+
+    def invalidate(self, path):#the file is about to be deleted or replaced
+        self.recent_misses.pop(path, None)
+        if path in self.entries:
+            self.drop(path)
+
+    def clear(self):
+        for path in list(self.entries):
+            self.drop(path)
+        self.recent_misses.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "bytes": self.size, "capacity": self.capacity, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,80 @@
+"""Log pane shared by the server and client windows.
+
+Any thread may log: messages go into a thread-safe queue and a QTimer on the
+GUI thread moves them into the list widget in batches, so a busy server costs
+the UI one repaint per tick instead of one per line. The widget keeps only the
+newest LOG_HISTORY lines; with a log file every line is also written there
+(one write per batch), rotated by size.
+"""
+import logging
+import logging.handlers
+import queue
+import time
+
+from PyQt5.QtCore import QTimer
+
+LOG_HISTORY = 5000#lines kept in the widget, older ones are dropped from the top
+LOG_INTERVAL = 100#ms between drains of the queue
+LOG_BATCH = 20000#most lines taken from the queue per tick, the rest wait for the next one
+LOG_FILE_SIZE = 10 << 20#bytes per log file before it is rotated
+LOG_FILE_COUNT = 5#rotated files kept next to the current one
+
+
+class LogView:
+    """Feeds a QListWidget from a queue; create it on the GUI thread, call log() from anywhere."""
+
+    def __init__(self, list_widget, log_file=None, history=LOG_HISTORY, interval=LOG_INTERVAL):
+        self.widget = list_widget
+        self.history = history
+        self.pending = queue.SimpleQueue()#(time logged, message)
+        self.spill = None
+        if log_file:
+            self.spill = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_FILE_SIZE,
+                                                              backupCount=LOG_FILE_COUNT, encoding="utf-8")
+        self.timer = QTimer(list_widget)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(interval)
+
+    def log(self, message):#thread-safe, never touches the widget
+        self.pending.put((time.time(), message))
+
+    def flush(self):#GUI thread: move what is queued into the widget (and the log file)
+        batch = []
+        try:
+            while len(batch) < LOG_BATCH:
+                batch.append(self.pending.get_nowait())
+        except queue.Empty:
+            pass
+        if not batch:
+            return
+        if self.spill is not None:#the whole batch as one record, rotation is checked per batch
+            self.spill.handle(logging.makeLogRecord({"msg": "\n".join(stamped_lines(batch))}))
+
+        widget = self.widget
+        batch = [message for _, message in batch[-self.history:]]#lines that would be dropped at once are never added
+        at_bottom = widget.verticalScrollBar().value() == widget.verticalScrollBar().maximum()
+        widget.setUpdatesEnabled(False)
+        try:
+            widget.addItems(batch)
+            excess = widget.count() - self.history
+            if excess > 0:#ring buffer: drop the oldest lines in one model call
+                widget.model().removeRows(0, excess)
+        finally:
+            widget.setUpdatesEnabled(True)
+        if at_bottom:#follow the log unless the user scrolled up to read
+            widget.scrollToBottom()
+
+    def close(self):#final drain, then release the log file
+        self.timer.stop()
+        self.flush()
+        if self.spill is not None:
+            self.spill.close()
+
+
+def stamped_lines(batch):#"date time message" per (time, message), strftime once per second
+    second = stamp = None
+    for created, message in batch:
+        if int(created) != second:
+            second = int(created)
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        yield f"{stamp} {message}"
@@ -0,0 +1,257 @@
+"""Server instrumentation: counters, latency histograms, a Prometheus endpoint and a sampling profiler.
+
+FileServer feeds one Metrics object from the event loop; the GUI stats panel
+reads snapshot() from its own thread, the HTTP endpoint renders the
+Prometheus text format (version 0.0.4) on the loop. The endpoint also turns
+the SamplingProfiler on and off:
+
+    GET /metrics          everything below, as Prometheus text
+    GET /profile/start    start sampling the event loop thread
+    GET /profile/stop     stop, answer with the hottest functions
+    GET /profile          the same report while sampling goes on
+    GET /profile/folded   all sampled stacks, one "a;b;c count" line each (flame graph input)
+"""
+import asyncio
+import bisect
+import contextlib
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)#seconds
+SAMPLE_INTERVAL = 0.005#seconds between profiler samples
+MAX_STACK_DEPTH = 64#frames kept per sample, counted from the innermost
+HTTP_REQUEST_LIMIT = 8192#bytes of request line and headers the endpoint reads
+HTTP_TIMEOUT = 10#seconds a scraper may take to send its request
+
+
+class Histogram:
+    """Bucketed distribution of observed values, as Prometheus histograms count them."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)#per bucket, not cumulative; the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, share):#estimate, interpolated inside the bucket the share falls into
+        if not self.count:
+            return None
+        rank = share * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def copy(self):
+        other = Histogram(self.buckets)
+        other.counts = list(self.counts)
+        other.count = self.count
+        other.sum = self.sum
+        return other
+
+
+class Metrics:
+    """Everything FileServer counts. Changed on the event loop, readable from any thread."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()#guards requests and latency, snapshots copy them under it
+        self.requests = Counter()#(command, "ok" or "error") -> requests handled
+        self.latency = {}#command -> Histogram of seconds per request
+        self.bytes_in = 0#received on client connections, headers included
+        self.bytes_out = 0#sent on client connections, headers included
+        self.connections = 0#open client connections, data connections included
+        self.connections_total = 0
+        self.transfers = Counter()#"upload"/"download" -> in flight right now
+        self.gauges = {}#name -> (help, function returning the value, "gauge" or "counter"), read when rendering
+
+    def observe(self, command, ok, seconds):#one finished request
+        with self.lock:
+            self.requests[command, "ok" if ok else "error"] += 1
+            histogram = self.latency.get(command)
+            if histogram is None:
+                histogram = self.latency[command] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def transfer(self, direction):#counts a file transfer as in flight while the block runs
+        self.transfers[direction] += 1
+        try:
+            yield
+        finally:
+            self.transfers[direction] -= 1
+
+    def add_gauge(self, name, help_text, read, kind="gauge"):#a value kept elsewhere, kind "counter" if it only grows
+        self.gauges[name] = (help_text, read, kind)
+
+    def snapshot(self):#plain dict of the current values, for the GUI
+        with self.lock:
+            requests = dict(self.requests)
+            latency = {command: histogram.copy() for command, histogram in self.latency.items()}
+        return {
+            "uptime": time.time() - self.started,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "connections": self.connections,
+            "connections_total": self.connections_total,
+            "transfers": dict(self.transfers),
+            "requests": requests,
+            "latency": latency,
+            "gauges": {name: read() for name, (_, read, _) in self.gauges.items()},
+        }
+
+    def render(self):#Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):#samples: [(labels dict, value)]
+            lines.append(f"# HELP fileserver_{name} {help_text}")
+            lines.append(f"# TYPE fileserver_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"fileserver_{name}{{{label_text}}} {value}" if label_text else f"fileserver_{name} {value}")
+
+        metric("uptime_seconds", "gauge", "Seconds since the server started.", [({}, round(snapshot["uptime"], 3))])
+        metric("requests_total", "counter", "Requests handled, by command and outcome.",
+               [({"command": command, "outcome": outcome}, count)
+                for (command, outcome), count in sorted(snapshot["requests"].items())])
+        lines.append("# HELP fileserver_request_duration_seconds Time from reading a request to finishing its reply.")
+        lines.append("# TYPE fileserver_request_duration_seconds histogram")
+        for command, histogram in sorted(snapshot["latency"].items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'fileserver_request_duration_seconds_bucket{{command="{command}",le="{bound}"}} {cumulative}')
+            lines.append(f'fileserver_request_duration_seconds_sum{{command="{command}"}} {histogram.sum:.6f}')
+            lines.append(f'fileserver_request_duration_seconds_count{{command="{command}"}} {histogram.count}')
+        metric("received_bytes_total", "counter", "Bytes received from clients.", [({}, snapshot["bytes_in"])])
+        metric("sent_bytes_total", "counter", "Bytes sent to clients.", [({}, snapshot["bytes_out"])])
+        metric("connections", "gauge", "Open client connections.", [({}, snapshot["connections"])])
+        metric("connections_total", "counter", "Client connections accepted.", [({}, snapshot["connections_total"])])
+        metric("transfers_in_flight", "gauge", "File transfers in progress.",
+               [({"direction": direction}, snapshot["transfers"].get(direction, 0)) for direction in ("upload", "download")])
+        for name, value in sorted(snapshot["gauges"].items()):
+            help_text, _, kind = self.gauges[name]
+            metric(name, kind, help_text, [({}, value)])
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread (the event loop) from a background thread.
+
+    Counts how often each stack was seen; a function's share of the samples is
+    its share of the thread's time. Costs nothing while stopped."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()#tuple of frames, outermost first -> samples
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.started = self.stopped = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, thread_id):#begin a new profile of the thread with that ident
+        if self.running:
+            return
+        self.stacks = Counter()
+        self.samples = 0
+        self.started, self.stopped = time.time(), None
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.sample, args=(thread_id,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.stopped = time.time()
+
+    def sample(self, thread_id):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:#thread ended
+                break
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def report(self, limit=25):#text: the functions with the most samples, on their own and with callees
+        stacks = dict(self.stacks)
+        samples = sum(stacks.values())
+        elapsed = (self.stopped or time.time()) - self.started if self.started else 0.0
+        own, inclusive = Counter(), Counter()
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack):
+                inclusive[frame] += count
+        idle = sum(count for stack, count in stacks.items() if stack[-1].startswith(("select ", "poll ", "epoll")))
+        lines = [f"{samples} samples over {elapsed:.1f}s, {100 * idle / samples if samples else 0:.0f}% waiting in select."]
+        for title, counter in (("Own time", own), ("Including callees", inclusive)):
+            lines.append(f"{title}:")
+            for frame, count in counter.most_common(limit):
+                lines.append(f"  {100 * count / samples:5.1f}%  {count:7d}  {frame}")
+        return "\n".join(lines) + "\n"
+
+    def folded(self):#"outer;inner count" lines, the input of flamegraph.pl and speedscope
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+
+async def serve_http(metrics, profiler, thread_id, host, port):
+    """Local HTTP endpoint for metrics and the profiler; returns the asyncio server."""
+
+    async def handle(reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_TIMEOUT)
+            parts = head.split(b"\r\n", 1)[0].decode("latin-1").split()
+            path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+            status, body = "200 OK", None
+            if path == "/metrics":
+                body = metrics.render()
+            elif path == "/profile/start":
+                profiler.start(thread_id)
+                body = "Profiler started.\n"
+            elif path == "/profile/stop":
+                profiler.stop()
+                body = profiler.report() if profiler.started else "Profiler was not started.\n"
+            elif path == "/profile":
+                body = profiler.report() if profiler.started else "Profiler was not started.\n"
+            elif path == "/profile/folded":
+                body = profiler.folded()
+            else:
+                status, body = "404 Not Found", "Not found.\n"
+            data = body.encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port, limit=HTTP_REQUEST_LIMIT)
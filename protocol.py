@@ -0,0 +1,140 @@
+"""Binary frame format shared by the server core and the client.
+
+A connection starts with a 4 byte preface (MAGIC + version byte). The server
+answers with its own preface carrying VERSION, the only frame version it
+speaks; a peer that offered an older one is disconnected right after, a newer
+client has to fall back to VERSION. A client may send its HELLO frame (and
+requests after it) in the same write as its preface, without waiting for the
+server's. Then both sides exchange frames:
+
+    header  = version:u8 type:u8 flags:u16 request_id:u32 meta_len:u32 body_len:u64
+    meta    = meta_len bytes of UTF-8 JSON (command fields)
+    body    = body_len raw bytes (file data, listings)
+
+Responses carry the request_id of the request they answer, so a client can
+send many requests back to back and match the replies as they arrive. A
+reply with FLAG_MORE set is followed by more frames for the same request,
+each with a piece of the body (compressed downloads go one chunk per frame).
+A BATCH request carries a manifest of operations and gets one such
+multi-frame reply: every frame of an item carries the item's index, downloads
+bring their file right behind their header (a tar-like stream of files), and a
+final frame without FLAG_MORE sums up.
+Anything that does not start with MAGIC is treated as the original text
+protocol (version 1) by the server.
+"""
+import asyncio
+import json
+import struct
+from collections import namedtuple
+
+MAGIC = b"\x00FS"#first byte can never start a typed username, so it is safe to sniff
+VERSION = 2#version 1 is the original text protocol
+PREFACE = MAGIC + bytes([VERSION])
+HEADER = struct.Struct("!BBHIIQ")
+MAX_META = 1 << 20#upper bound for the JSON part of a frame
+
+#frame types, requests
+HELLO = 1
+UPLOAD = 2
+DOWNLOAD = 3
+DELETE = 4
+LIST = 5
+UPLOAD_OPEN = 6#start or resume a chunked upload, the reply says how much is already committed
+UPLOAD_CHUNK = 7#one chunk at a given offset, with its crc32
+UPLOAD_COMMIT = 8#all chunks are in, move the staged file into place
+BATCH = 9#manifest of UPLOAD/DOWNLOAD/DELETE operations, upload bodies follow each other in the body
+#frame types, replies and server pushes
+OK = 16
+ERROR = 17
+NOTIFY = 18
+
+FLAG_MORE = 0x1#another frame of the same reply follows
+
+COMMAND_NAMES = {
+    HELLO: "HELLO", UPLOAD: "UPLOAD", DOWNLOAD: "DOWNLOAD", DELETE: "DELETE", LIST: "LIST",
+    UPLOAD_OPEN: "UPLOAD_OPEN", UPLOAD_CHUNK: "UPLOAD_CHUNK", UPLOAD_COMMIT: "UPLOAD_COMMIT", BATCH: "BATCH",
+}
+BATCH_COMMANDS = ("UPLOAD", "DOWNLOAD", "DELETE")#operations a BATCH manifest may contain
+MAX_BATCH = 1024#operations in one BATCH request
+
+Frame = namedtuple("Frame", "type flags request_id meta body_len")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_header(frame_type, request_id, meta=None, body_len=0, flags=0):#header + meta, body is sent by the caller
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode() if meta else b""
+    return HEADER.pack(VERSION, frame_type, flags, request_id, len(meta_bytes), body_len) + meta_bytes
+
+
+def decode_header(raw):#returns (type, flags, request_id, meta_len, body_len)
+    version, frame_type, flags, request_id, meta_len, body_len = HEADER.unpack(raw)
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported frame version {version}")
+    if meta_len > MAX_META:
+        raise ProtocolError(f"Frame metadata too large ({meta_len} bytes)")
+    return frame_type, flags, request_id, meta_len, body_len
+
+
+def decode_meta(raw):
+    if not raw:
+        return {}
+    try:
+        meta = json.loads(raw)
+    except ValueError as e:
+        raise ProtocolError(f"Bad frame metadata: {e}")
+    if not isinstance(meta, dict):
+        raise ProtocolError("Frame metadata must be an object")
+    return meta
+
+
+def parse_preface(data):#version offered by the peer's preface
+    if len(data) != len(PREFACE) or not data.startswith(MAGIC):
+        raise ProtocolError("Bad protocol preface")
+    return data[len(MAGIC)]
+
+
+#blocking socket helpers (client side)
+
+def recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionError("Connection closed by peer")
+        received += n
+    return buf
+
+
+def send_frame(sock, frame_type, request_id, meta=None, body=b""):
+    sock.sendall(encode_header(frame_type, request_id, meta, len(body)) + body)
+
+
+def recv_frame(sock):#reads header and meta; the caller reads body_len bytes itself
+    frame_type, flags, request_id, meta_len, body_len = decode_header(recv_exact(sock, HEADER.size))
+    meta = decode_meta(recv_exact(sock, meta_len)) if meta_len else {}
+    return Frame(frame_type, flags, request_id, meta, body_len)
+
+
+#asyncio stream helpers (server side)
+
+async def read_frame(reader):#returns None on a clean end of stream between frames
+    try:
+        raw = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    frame_type, flags, request_id, meta_len, body_len = decode_header(raw)
+    meta = decode_meta(await reader.readexactly(meta_len)) if meta_len else {}
+    return Frame(frame_type, flags, request_id, meta, body_len)
+
+
+def write_frame(writer, frame_type, request_id, meta=None, body=b"", flags=0):#caller drains
+    writer.write(encode_header(frame_type, request_id, meta, len(body), flags))
+    if body:
+        writer.write(body)
@@ -0,0 +1,192 @@
+"""Startup reconciliation of the storage directory with the catalog, in a background thread.
+
+The server already accepts clients while this runs. It checks:
+
+* files stored whole (from before the chunk store): records whose file is
+  gone are dropped, and a file whose size or mtime differs from the
+  fingerprint saved by the last scan gets its size updated and its cached
+  chunk checksums dropped;
+* the chunk store: chunk files no record knows (orphans), and chunks the
+  records need that are missing or have the wrong size;
+* anything else in the storage directory that no record accounts for.
+
+Chunks are written once and never change, so a chunk directory whose mtime
+still equals the one saved after its last complete scan (its checkpoint)
+holds the same files as then and is not listed again. After the first start
+only the directories that gained or lost chunks are read, and an interrupted
+scan continues where it stopped. (A chunk file changed in place from outside
+keeps its directory's mtime, so its size is checked again only once the
+directory changes.) Findings stay in the catalog until the
+directory they were found in is scanned again, and are summarized in the log.
+"""
+import os
+import threading
+import time
+from collections import Counter
+
+from chunkstore import CHUNK_DIR
+
+ORPHAN_FILE = "orphan file"#in the storage directory, no record has it
+ORPHAN_DIRECTORY = "orphan directory"
+ORPHAN_CHUNK = "orphan chunk"#in the chunk store, no record references it
+MISSING_CHUNK = "missing chunk"#referenced, but its file is gone; the files using it cannot be downloaded
+DAMAGED_CHUNK = "damaged chunk"#its file does not have the size the record says
+RACY_WINDOW = 2.0#seconds; a directory changed this recently could change again within the same mtime, no checkpoint
+REPORT_LIMIT = 20#findings logged one by one, the rest only counted
+
+
+class Reconciler:
+    """Compares one storage directory with its catalog; run() does it all, start() in a thread."""
+
+    def __init__(self, directory, catalog, chunk_store, log=print, ignore=()):
+        self.directory = directory
+        self.catalog = catalog
+        self.chunk_store = chunk_store
+        self.log_message = log
+        self.ignore = set(ignore)#names in the storage directory that belong to the server (the catalog's files)
+        self.stopping = threading.Event()
+        self.thread = None
+        self.stats = Counter()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="reconcile", daemon=True)
+        self.thread.start()
+
+    def stop(self):#the scan ends after the directory it is in, the next start continues from the checkpoints
+        self.stopping.set()
+
+    def run(self):
+        started = time.monotonic()
+        try:
+            self.scan_top()
+            self.scan_chunks()
+        except Exception as e:
+            self.log_message(f"Storage reconciliation failed: {e}")
+            return
+        if self.stopping.is_set():
+            return
+        self.catalog.checkpoint()
+        self.report(time.monotonic() - started)
+
+    def scan_top(self):#files stored whole, and whatever else lies in the storage directory
+        fingerprints = self.catalog.whole_file_fingerprints()
+        findings = []
+        seen = set()
+        listed_at = time.time()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith(".") or name in self.ignore:#the chunk store and staging area are checked apart
+                    continue
+                fingerprint = fingerprints.get(name)
+                try:
+                    if fingerprint is None or not entry.is_file():
+                        is_dir = entry.is_dir()
+                        findings.append((name, ORPHAN_DIRECTORY if is_dir else ORPHAN_FILE,
+                                         0 if is_dir else entry.stat().st_size))
+                        continue
+                    st = entry.stat()
+                except FileNotFoundError:#removed since the listing
+                    continue
+                seen.add(name)
+                if (st.st_size, st.st_mtime_ns) != fingerprint:#new or changed since the last scan
+                    changed = fingerprint[1] is not None or st.st_size != fingerprint[0]
+                    mtime_ns = st.st_mtime_ns if st.st_mtime_ns / 1e9 < listed_at - RACY_WINDOW else None
+                    self.catalog.update_fingerprint(name, st.st_size, mtime_ns, changed)
+                    self.stats["refreshed"] += 1
+
+        #identify missing files, looked up again against the current records: a client may have
+        #deleted, replaced or uploaded one anew since the listing
+        missing = self.catalog.remove_missing([name for name in fingerprints if name not in seen],
+                                              lambda name: os.path.exists(os.path.join(self.directory, name)))
+        for missing_file in missing:
+            self.log_message(f"File {missing_file} not found in directory. Removing from records.")
+        self.catalog.set_findings("", findings)
+        self.stats["removed"] += len(missing)
+        self.stats["scanned"] += 1
+
+    def scan_chunks(self):#the 256 fan-out directories of the chunk store, unchanged ones skipped
+        root = self.chunk_store.root
+        prefixes = [f"{i:02x}" for i in range(256)]
+        findings = []
+        if os.path.isdir(root):
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.name not in prefixes:
+                        is_dir = entry.is_dir()
+                        try:
+                            size = 0 if is_dir else entry.stat().st_size
+                        except FileNotFoundError:
+                            continue
+                        findings.append((f"{CHUNK_DIR}/{entry.name}", ORPHAN_DIRECTORY if is_dir else ORPHAN_FILE, size))
+        self.catalog.set_findings(CHUNK_DIR, findings)
+
+        for prefix in prefixes:
+            if self.stopping.is_set():
+                return
+            path = os.path.join(root, prefix)
+            relative = f"{CHUNK_DIR}/{prefix}"
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtime_ns = None#no chunk starts with this prefix, unless the records say otherwise
+            if mtime_ns is not None and mtime_ns == self.catalog.scan_checkpoint(relative):
+                self.stats["unchanged"] += 1
+                continue
+            listed_at = time.time()
+            self.catalog.set_findings(relative, self.scan_chunk_dir(path, prefix, relative))
+            racy = mtime_ns is None or mtime_ns / 1e9 >= listed_at - RACY_WINDOW
+            self.catalog.save_scan_checkpoint(relative, None if racy else mtime_ns)
+            self.stats["scanned"] += mtime_ns is not None
+
+    def scan_chunk_dir(self, path, prefix, relative):#findings in one fan-out directory
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except FileNotFoundError:
+            entries = []
+        sizes = self.catalog.chunk_sizes(prefix)#after the listing: a chunk stored in between is found on disk below
+        findings = []
+        present = set()
+        for entry in entries:
+            digest, _, codec = entry.name.partition(".")
+            try:
+                if digest not in sizes:
+                    if os.path.exists(entry.path):#not collected as garbage while we looked
+                        findings.append((f"{relative}/{entry.name}", ORPHAN_CHUNK, entry.stat().st_size))
+                    continue
+                if codec:#compressed copy of a known chunk, any size
+                    continue
+                present.add(digest)
+                size = entry.stat().st_size
+            except FileNotFoundError:#removed since the listing
+                continue
+            if size != sizes[digest]:
+                findings.append((f"{relative}/{entry.name}", DAMAGED_CHUNK, size))
+        for digest in sizes.keys() - present:
+            if not os.path.exists(self.chunk_store.path(digest)):#not stored since the listing either
+                findings.append((f"{relative}/{digest}", MISSING_CHUNK, sizes[digest]))
+        return findings
+
+    def report(self, elapsed):
+        findings = self.catalog.findings()
+        counts = Counter(kind for _, kind, _ in findings)
+        orphan_bytes = sum(size for _, kind, size in findings if kind in (ORPHAN_FILE, ORPHAN_CHUNK))
+        stats = self.stats
+        self.log_message(
+            f"Storage reconciled in {elapsed:.1f}s: {stats['scanned']} directories scanned, {stats['unchanged']} unchanged,"
+            f" {stats['removed']} missing files removed from records, {stats['refreshed']} fingerprints updated.")
+        if not findings:
+            self.log_message("File records synchronized with the directory.")
+            return
+        self.log_message(
+            f"Found {counts[ORPHAN_FILE] + counts[ORPHAN_DIRECTORY]} orphaned files and directories,"
+            f" {counts[ORPHAN_CHUNK]} orphaned chunks ({orphan_bytes} orphaned bytes in all),"
+            f" {counts[MISSING_CHUNK]} missing and {counts[DAMAGED_CHUNK]} damaged chunks.")
+        for path, kind, size in findings[:REPORT_LIMIT]:
+            detail = ""
+            if kind in (MISSING_CHUNK, DAMAGED_CHUNK):
+                detail = f", used by {', '.join(self.catalog.files_with_chunk(path.rsplit('/', 1)[-1])) or 'no file'}"
+            self.log_message(f"  {kind}: {path} ({size} bytes{detail})")
+        if len(findings) > REPORT_LIMIT:
+            self.log_message(f"  ... and {len(findings) - REPORT_LIMIT} more.")
@@ -0,0 +1,1016 @@
+import asyncio
+import argparse
+import contextlib
+import os
+import secrets
+import socket
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import compression
+import protocol
+import transfer
+from bandwidth import NO_LIMITS, BandwidthLimits, BandwidthScheduler
+from catalog import Catalog, is_busy, legacy_json_path
+from cluster import CoordinatorLink, serve_cluster
+from chunkstore import ChunkingWriter, ChunkStore
+from concurrency import ClientRegistry, KeyLocks
+from connection import RECV_BUFFER_SIZE, BufferPool, ServerConnection
+from hotcache import HOT_CACHE_SIZE, HotFileCache
+from metrics import Metrics, SamplingProfiler, serve_http
+from reconcile import Reconciler
+from sessions import DISCONNECTS, BatchItem, FramedSession, LegacySession, Request
+
+LISTEN_BACKLOG = 1024#pending connections the kernel may queue for us
+STAGING_DIR = ".uploads"#inside the storage directory
+STALE_UPLOAD_AGE = 7 * 24 * 3600#resumable uploads untouched this long are dropped at startup
+MIN_CHUNK_SIZE = 64 << 10
+MAX_CHUNK_SIZE = 64 << 20
+STOP_TIMEOUT = 5#seconds stop() waits for the server thread and the storage scan to end
+BUSY_RETRY_AFTER = 0.2#seconds a client is told to wait when another worker held the catalog too long
+BULK_COMMANDS = ("UPLOAD", "UPLOAD_CHUNK", "DOWNLOAD", "BATCH")#their bodies wait their turn under a bandwidth limit
+
+
+class FileServer:
+    """Headless file server: one asyncio event loop serves every client connection."""
+
+    def __init__(self, directory, port, host="0.0.0.0", log=print, catalog_path="files.db",
+                 chunk_size=transfer.SEND_CHUNK_SIZE, recv_buffer_size=RECV_BUFFER_SIZE, codecs=tuple(compression.CODECS),
+                 metrics_port=None, metrics_host="127.0.0.1", hot_cache_size=HOT_CACHE_SIZE, bandwidth_limits=NO_LIMITS,
+                 coordinator_path=None):
+        self.directory = directory#storing uploaded files
+        self.chunk_size = chunk_size#copy block size when sendfile cannot be used
+        self.buffer_pool = BufferPool(recv_buffer_size)#reused upload receive buffers
+        self.codecs = list(codecs)#compression offered to framed clients, preferred first
+        self.port = port
+        self.host = host
+        self.log_message = log#where log lines go (print, or the GUI log box)
+        self.catalog_path = catalog_path
+        self.files = None#Catalog of {unique_filename: owner, filename, size, manifest}
+        self.chunk_store = ChunkStore(directory)#file contents, one copy of every distinct chunk
+        self.hot_files = HotFileCache(hot_cache_size)#popular chunk files, mapped once and shared by their downloads
+        self.connected_clients = ClientRegistry()#client name -> session, claimed atomically
+        self.bandwidth = BandwidthScheduler(bandwidth_limits)#rate limits and fair queuing of upload and download bodies
+        self.session_tokens = {}#session token -> primary session, for attaching data connections
+        self.server = None
+        self.loop = None
+        self.thread = None#thread running the event loop when started with start_in_thread
+        self.list_cache = {}#kind -> (encoded listing, catalog version it was built from)
+        self.file_locks = KeyLocks()#per-file work that awaits between reading and updating the catalog
+        self.pinned_chunks = Counter()#chunk hash -> downloads reading it right now, garbage collection keeps these
+        self.garbage_deferred = False#a collection skipped pinned chunks, run again when downloads end
+        self.metrics = Metrics()#counters and latencies, read by the stats panel and the metrics endpoint
+        self.metrics.add_gauge("clients", "Connected clients.", lambda: len(self.connected_clients))
+        self.profiler = SamplingProfiler()#samples the event loop thread while switched on
+        self.metrics_port = metrics_port#local HTTP endpoint for Prometheus, None for none
+        self.metrics_host = metrics_host
+        self.metrics_server = None
+        self.loop_thread = None#ident of the thread running the event loop, the one the profiler samples
+        self.reconciler = None#background comparison of the storage directory with the catalog
+        self.coordinator_path = coordinator_path#Unix socket of the coordinator when this is one of several workers
+        self.coordinator = None#CoordinatorLink once started as a worker
+        self.metrics.add_gauge("storage_findings", "Orphaned files and missing or damaged chunks the storage scan found.",
+                               lambda: sum(self.files.finding_counts().values()))
+        self.metrics.add_gauge("hot_cache_bytes", "Bytes of files mapped in the hot-file cache.", lambda: self.hot_files.size)
+        self.metrics.add_gauge("hot_cache_files", "Files mapped in the hot-file cache.", lambda: len(self.hot_files.entries))
+        self.metrics.add_gauge("hot_cache_hits_total", "Sends served from the hot-file cache.",
+                               lambda: self.hot_files.hits, "counter")
+        self.metrics.add_gauge("hot_cache_misses_total", "Sends the hot-file cache could not serve.",
+                               lambda: self.hot_files.misses, "counter")
+        self.metrics.add_gauge("hot_cache_evictions_total", "Files evicted from the hot-file cache.",
+                               lambda: self.hot_files.evictions, "counter")
+        self.metrics.add_gauge("bandwidth_waiting", "Bulk transfers queued behind the server bandwidth limit.",
+                               self.bandwidth.waiting)
+        self.metrics.add_gauge("bandwidth_wait_seconds_total", "Seconds bulk transfers waited for bandwidth.",
+                               lambda: self.bandwidth.waited, "counter")
+        self.handlers = {#command name -> coroutine(session, request)
+            "UPLOAD": self.handle_upload,
+            "DOWNLOAD": self.handle_download,
+            "DELETE": self.handle_delete,
+            "LIST": self.handle_list,
+            "UPLOAD_OPEN": self.handle_upload_open,
+            "UPLOAD_CHUNK": self.handle_upload_chunk,
+            "UPLOAD_COMMIT": self.handle_upload_commit,
+            "BATCH": self.handle_batch,
+        }
+
+        #load previous existing files
+        self.load_files()
+
+    async def start(self):#bind, listen and start accepting clients
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        if self.coordinator_path is not None:
+            self.coordinator = await CoordinatorLink.connect(self.coordinator_path, self)
+        #BufferedProtocol connections: the kernel recv_into()s our own buffers; workers share the port
+        self.server = await self.loop.create_server(
+            lambda: ServerConnection(self.handle_client, self.buffer_pool, self.metrics),
+            self.host, self.port, backlog=LISTEN_BACKLOG, reuse_port=self.coordinator is not None,
+        )
+        self.log_message(f"Server started on port {self.port}...")
+        if self.metrics_port is not None:
+            self.metrics_server = await serve_http(self.metrics, self.profiler, self.loop_thread,
+                                                   self.metrics_host, self.metrics_port)
+            self.log_message(f"Metrics on http://{self.metrics_host}:{self.metrics_port}/metrics")
+
+        #validate files in the storage directory, the coordinator does it once for all workers
+        if self.coordinator is None:
+            self.validate_files()
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            if self.coordinator is not None:#a worker ends with its coordinator
+                await self.coordinator.closed
+            else:
+                await self.server.serve_forever()
+
+    def run(self):#blocking entry point used by the command line
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            self.log_message("Server stopped.")
+        finally:
+            self.save_files()
+
+    def start_in_thread(self):#run the event loop in a background thread (GUI front end)
+        started = threading.Event()
+        errors = []
+
+        def runner():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.start())
+            except Exception as e:
+                errors.append(e)
+                started.set()
+                loop.close()
+                return
+            started.set()
+            loop.run_forever()
+            #stopped: client handlers still running get cancelled, their cleanup closes the sockets
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+        self.thread = threading.Thread(target=runner, daemon=True)
+        self.thread.start()
+        started.wait()
+        if errors:#report bind errors etc. to the caller
+            raise errors[0]
+
+    def stop(self):#stop a server started with start_in_thread, returns once its thread has cleaned up
+        if self.loop and self.server and not self.loop.is_closed():#a second stop has nothing left to do
+            self.loop.call_soon_threadsafe(self.server.close)
+            if self.metrics_server is not None:
+                self.loop.call_soon_threadsafe(self.metrics_server.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.profiler.stop()
+        if self.reconciler is not None:
+            self.reconciler.stop()
+        for thread in (self.thread, self.reconciler and self.reconciler.thread):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(STOP_TIMEOUT)
+
+    def start_profiler(self):#sample the event loop until stop_profiler, callable from any thread
+        if self.loop_thread is not None:
+            self.profiler.start(self.loop_thread)
+
+    def stop_profiler(self):#returns the report of the hottest functions
+        self.profiler.stop()
+        return self.profiler.report()
+
+    def set_limits(self, limits):#new BandwidthLimits, callable from any thread
+        if self.loop is not None and self.loop.is_running() and threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.bandwidth.set_limits, limits)
+        else:
+            self.bandwidth.set_limits(limits)
+
+    def validate_files(self):
+        """Synchronize the file records with the actual directory contents.
+
+        Only abandoned uploads are cleaned up before clients are served; the scan
+        of the directory and the chunk store runs in a background thread (reconcile.py)."""
+        if not os.path.exists(self.directory):#check if directory exists
+            self.log_message("Warning: Storage directory does not exist.")
+            return
+        self.clean_staging()
+        self.reconciler = Reconciler(self.directory, self.files, self.chunk_store, self.log_message,
+                                     ignore=self.server_files())
+        self.reconciler.start()
+
+    def server_files(self):#names in the storage directory that are the catalog's own files, not orphans
+        directory = os.path.abspath(self.directory)
+        names = []
+        for path in (self.catalog_path, legacy_json_path(self.catalog_path)):
+            if os.path.dirname(os.path.abspath(path)) == directory:
+                base = os.path.basename(path)
+                names += [base, f"{base}-wal", f"{base}-shm", f"{base}-journal"]
+        return names
+
+    async def handle_client(self, reader, writer):#handle each client individually
+        name = None
+        session = None
+        token = None
+        flow = None
+        self.metrics.connections += 1
+        self.metrics.connections_total += 1
+        try:
+            #the first bytes decide the protocol: framed preface or a bare username
+            data = await reader.read(1024)
+            if data.startswith(protocol.MAGIC[:1]):
+                session = FramedSession(reader, writer)
+            else:
+                session = LegacySession(reader, writer)
+            hello_name = await session.hello(data)
+            if "attach" in session.hello_meta:#extra data connection of a client that is already connected
+                await self.serve_data_connection(session, session.hello_meta["attach"])
+                return
+            name = hello_name
+            if not name:
+                return
+            session.name = name
+            if not await self.claim_name(name, session):#the name belongs to another connection
+                await session.reject("Name already in use")
+                name = None
+                return
+            self.log_message(f"{name} connected.")
+            flow = writer.conn.flow = self.bandwidth.flow(name)
+
+            #acknowledge connection, framed clients get a token to open parallel data connections
+            meta = None
+            if session.framed:
+                token = secrets.token_hex(16)
+                self.session_tokens[token] = session
+                if self.coordinator is not None:#its data connections may land on another worker
+                    await self.coordinator.register(token, name)
+                meta = {"session_token": token, "compression": self.codecs, "batch": protocol.MAX_BATCH}
+            await session.accept(meta)
+
+            #processing client commands
+            await self.process_requests(session)
+        except Exception as outer_e:
+            self.log_message(f"Error with client {name}: {outer_e}")
+        finally:
+            #cleanup on disconnection
+            if token is not None:
+                del self.session_tokens[token]
+                if self.coordinator is not None:
+                    self.coordinator.unregister(token)
+            if name is not None:
+                self.connected_clients.release(name, session)
+                if self.coordinator is not None:
+                    self.coordinator.release(name)
+            if flow is not None:
+                flow.close()
+            writer.close()#close the client socket
+            self.metrics.connections -= 1
+            if name is not None:
+                self.log_message(f"{name} disconnected.")
+
+    async def claim_name(self, name, session):#True if the name was free on every worker and now belongs to session
+        if not self.connected_clients.claim(name, session):
+            return False
+        if self.coordinator is not None and not await self.coordinator.claim(name):
+            self.connected_clients.release(name, session)
+            return False
+        return True
+
+    async def serve_data_connection(self, session, token):
+        """Additional connection of a connected client, used to move chunks of one large file in parallel.
+
+        It acts as its owner but is not listed in connected_clients, so it does not take the
+        name and gets no notifications."""
+        primary = self.session_tokens.get(token)
+        name = primary.name if primary is not None else None
+        if name is None and self.coordinator is not None:#the primary connection is on another worker
+            name = await self.coordinator.attach(token)
+        if name is None:
+            await session.reject("Unknown session.")
+            return
+        session.name = name
+        flow = session.writer.conn.flow = self.bandwidth.flow(session.name)#shares the client's limits
+        try:
+            await session.accept()
+            await self.process_requests(session)
+        finally:
+            flow.close()
+
+    async def process_requests(self, session):#read and dispatch commands until the client goes away
+        name = session.name
+        flow = session.writer.conn.flow
+        while True:
+            try:
+                request = await session.read_request()
+                if request is None:
+                    break
+
+                #understand the command type
+                self.log_message(f"Command from {name}: {request.text}")
+                handler = self.handlers.get(request.command)
+                started = time.perf_counter()
+                ok = False
+                flow.bulk = request.command in BULK_COMMANDS#anything else goes ahead of bulk data
+                try:
+                    if handler:
+                        await handler(session, request)
+                    else:
+                        await session.reply_error(request, "Unknown command.")
+                    ok = session.failed_request is not request
+                finally:
+                    flow.bulk = False
+                    session.end_reply()#notifications held back during the reply go out now
+                    self.metrics.observe(request.command if handler else "UNKNOWN", ok, time.perf_counter() - started)
+                await session.finish_request()
+            except DISCONNECTS:
+                break
+            except Exception as inner_e:
+                self.log_message(f"Error while processing command from {name}: {inner_e}")
+
+    async def handle_batch(self, session, request):
+        """Runs a manifest of UPLOAD/DOWNLOAD/DELETE operations in order, one reply per item as it finishes.
+
+        Each operation is handled by the handler of its single command, through a BatchItem,
+        so thousands of small files cost one round trip instead of one each. An UPLOAD op
+        says how many bytes of the batch body are its file ("length")."""
+        try:
+            ops = request.args.get("ops")
+            if not session.framed or not isinstance(ops, list) or not all(isinstance(op, dict) for op in ops):
+                raise ValueError("Bad batch manifest.")
+            if len(ops) > protocol.MAX_BATCH:
+                raise ValueError(f"A batch holds at most {protocol.MAX_BATCH} operations.")
+            lengths = [int(op.get("length", 0)) if op.get("op") == "UPLOAD" else 0 for op in ops]
+            if min(lengths, default=0) < 0 or sum(lengths) != request.body_len:
+                raise ValueError("Batch body does not match its manifest.")
+        except DISCONNECTS:
+            raise
+        except Exception as e:
+            await self.reply_failure(session, request, e)
+            return
+
+        failed = 0
+        for index, (op, length) in enumerate(zip(ops, lengths)):
+            started = time.perf_counter()
+            item = BatchItem(session, index, length)
+            command = op.get("op")
+            args = {key: value for key, value in op.items() if key != "op"}
+            item_request = Request(command, args, request.request_id, length, f"{command} {args}")
+            if command in protocol.BATCH_COMMANDS:
+                await self.handlers[command](item, item_request)
+            else:
+                await item.reply_error(item_request, "Unknown command.")
+            await item.finish_request()
+            failed += not item.ok
+            self.metrics.observe(f"BATCH/{command if command in protocol.BATCH_COMMANDS else 'UNKNOWN'}",
+                                 item.ok, time.perf_counter() - started)#items apart from single requests
+        self.log_message(f"{session.name} ran a batch of {len(ops)} operations, {failed} failed.")
+        await session.reply(request, f"{len(ops) - failed} of {len(ops)} operations succeeded.",
+                            {"count": len(ops), "failed": failed})
+
+    async def handle_upload(self, session, request):#handling file upload
+        writer = None
+        try:
+            filename = request.args["filename"]
+            #the size of a compressed body, or the legacy size field, which must be there
+            filesize = request.args.get("size", request.body_len if session.framed else None)
+            if not is_count(filesize):#nothing is received, an empty record would replace the stored file
+                await session.reply_error(request, "Invalid file size.")
+                return
+            unique_filename = f"{session.name}_{filename}"#create unique filename for this
+
+            #receive file data into staged chunks, the stored file is only replaced once it is complete
+            writer = ChunkingWriter(self.staging_dir, transfer.TRANSFER_CHUNK_SIZE)
+            target = self.body_target(request, writer, filesize)
+            try:
+                with self.metrics.transfer("upload"):
+                    received = await session.receive_body(request, target)
+            finally:
+                writer.close()
+            if target is not writer:#compressed body, size is what it decoded to
+                target.finish()
+                if target.error is not None:
+                    await session.reply_error(request, target.error)
+                    return
+                received = target.written
+            if received < filesize:#legacy client went away mid-upload
+                await session.reply_error(request, "Upload incomplete.")
+                return
+            await writer.hashed()
+            checksum = writer.checksum
+            if request.args.get("checksum", checksum) != checksum:#changed on the way, keep nothing
+                await session.reply_error(request, "Checksum mismatch.")
+                return
+
+            #chunks we already have are dropped, the file record points at the stored copies
+            with self.files.transaction():
+                chunks = self.store_chunks(writer)
+                self.files.ref_chunks(chunks)
+                self.files.add(unique_filename, session.name, filename, received, writer.chunk_size,
+                               [crc for _, _, crc in chunks], [digest for digest, _, _ in chunks], checksum)
+            if target is not writer and len(chunks) == 1:#keep the compressed form of a one-chunk file
+                self.chunk_store.put_encoded(writer.copy_path, chunks[0][0], request.args["encoding"])
+            self.replaced_content(unique_filename)
+            self.log_message(f"{session.name} uploaded {filename}.")
+            await session.reply(request, "Upload successful.", {"checksum": checksum})
+        except DISCONNECTS:
+            raise
+        except Exception as e:
+            await self.reply_failure(session, request, e)
+        finally:
+            if writer is not None:
+                writer.discard()
+
+    async def reply_failure(self, session, request, error):#error reply for a request a handler failed on
+        if is_busy(error):#nothing was changed, the same request can simply be sent again
+            await session.reply_error(request, "Server busy, try again.", {"retry_after": BUSY_RETRY_AFTER})
+        else:
+            await session.reply_error(request, str(error))
+
+    def body_target(self, request, writer, limit):#where a request body goes: writer, or a decoder in front of it
+        codec = request.args.get("encoding")
+        if codec is None:
+            return writer
+        if codec not in self.codecs:
+            raise ValueError(f"Unsupported encoding: {codec}")
+        return compression.DecodingWriter(codec, writer, limit, writer.open_copy())
+
+    def store_chunks(self, writer):#move received chunks into the chunk store, returns [(hash, size, crc)]
+        chunks = [(chunk.digest, chunk.size, chunk.crc) for chunk in writer.chunks]
+        known = self.files.known_chunks(digest for digest, _, _ in chunks)
+        for chunk, (digest, _, _) in zip(writer.chunks, chunks):
+            self.chunk_store.put(chunk.path, digest, digest in known)
+            known[digest] = None#the same chunk twice in one file is stored once
+        return chunks
+
+    def replaced_content(self, unique_filename):#after a new version was committed: drop what the old one used
+        self.remove_whole_file(unique_filename)
+        self.try_collect_garbage()
+
+    def remove_whole_file(self, unique_filename):#file stored whole before the chunk store, its record is already gone
+        try:
+            os.remove(os.path.join(self.directory, unique_filename))
+        except FileNotFoundError:
+            pass
+        except OSError as e:#the storage scan reports it as an orphan
+            self.log_message(f"Could not remove {unique_filename}: {e}")
+
+    def try_collect_garbage(self):#collect_garbage after a committed change, a failure is logged and the collection deferred
+        try:
+            return self.collect_garbage()
+        except Exception as e:#the change stands, its reply must not say otherwise
+            self.garbage_deferred = True#tried again when a download ends, or by the next change
+            self.log_message(f"Garbage collection deferred: {e}")
+            return []
+
+    def collect_garbage(self):#delete chunks no file or upload references any more, returns their hashes
+        if self.coordinator is not None:#it collects for every worker, it knows all their downloads
+            if self.files.has_garbage():
+                self.coordinator.collect()
+            return []
+        retired = []#files of the collected chunks, moved to staging while the catalog is locked
+        collected = self.files.garbage_chunks(keep=self.pinned_chunks,
+                                              discard=lambda digest: retired.extend(self.discard_chunk(digest)))
+        self.garbage_deferred = bool(self.pinned_chunks)
+        for path in retired:#deleted once the lock is released, clean_staging gets them after a crash
+            os.remove(path)
+        return collected
+
+    def discard_chunk(self, digest):#runs inside the catalog transaction that forgets the chunk, returns the moved files
+        self.invalidate_chunk(digest)
+        return self.chunk_store.retire(digest, self.staging_dir)
+
+    def invalidate_chunk(self, digest):#its files are about to go, drop them from the hot-file cache
+        for path in self.chunk_store.paths(digest):
+            self.hot_files.invalidate(path)
+
+    @contextlib.asynccontextmanager
+    async def pinned(self, unique_filename):
+        """Yields the content of a file (None if there is no such file) and keeps its chunks on disk
+        until the block ends, even if the file is deleted or replaced meanwhile; they are collected
+        when the last download using them ends."""
+        content = self.files.content(unique_filename)
+        digests = set(content[2] or ()) if content is not None else set()
+        while self.coordinator is not None and digests:#another worker may collect them before the pin arrives
+            await self.coordinator.pin(digests)
+            latest = self.files.content(unique_filename)
+            if latest == content:#still referenced after the pin, so still on disk
+                break
+            self.coordinator.unpin(digests)
+            content = latest
+            digests = set(content[2] or ()) if content is not None else set()
+        if self.coordinator is None:
+            self.pin(digests)
+        try:
+            yield content
+        finally:
+            if self.coordinator is not None:
+                if digests:
+                    self.coordinator.unpin(digests)
+            else:
+                self.unpin(digests)
+
+    def pin(self, digests):#collect_garbage leaves these chunks alone until they are unpinned
+        self.pinned_chunks.update(digests)
+
+    def unpin(self, digests):#returns the hashes of the chunks a deferred collection removed now
+        for digest in digests:
+            self.pinned_chunks[digest] -= 1
+            if not self.pinned_chunks[digest]:
+                del self.pinned_chunks[digest]
+        if digests and self.garbage_deferred:
+            return self.try_collect_garbage()
+        return []
+
+    async def handle_upload_open(self, session, request):#start or resume a chunked upload
+        try:
+            filename = request.args["filename"]
+            filesize = int(request.args["size"])
+            chunk_size = int(request.args.get("chunk_size", transfer.TRANSFER_CHUNK_SIZE))
+            if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+                raise ValueError(f"Chunk size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE} bytes.")
+            upload_id = f"{session.name}_{filename}"
+            committed, checksums = self.files.open_upload(upload_id, session.name, filename, filesize, chunk_size)
+            resumed = any(crc is not None for crc in checksums)
+            if resumed:
+                self.log_message(f"{session.name} resumes upload of {filename} at byte {committed}.")
+
+            #chunk hashes sent up front: chunks the store already has count as received
+            hashes = request.args.get("hashes") or []
+            deduplicated = 0
+            if len(hashes) == -(-filesize // chunk_size):
+                with self.files.transaction():#referenced before garbage collection can take them
+                    known = self.files.known_chunks(hashes)
+                    for index, digest in enumerate(hashes):
+                        length = min(chunk_size, filesize - index * chunk_size)
+                        stored = index < len(checksums) and checksums[index] is not None
+                        if not stored and digest in known and known[digest][0] == length:
+                            committed = self.files.store_chunk(upload_id, index, known[digest][1], digest, length)
+                            deduplicated += 1
+                checksums = self.files.get_upload(upload_id)["checksums"]
+            #chunks already stored past the complete prefix (left by parallel streams)
+            stored = [index for index, crc in enumerate(checksums) if crc is not None and index * chunk_size >= committed]
+            await session.reply(request, "Upload ready.", {
+                "upload_id": upload_id, "offset": committed, "chunk_size": chunk_size, "stored": stored,
+                "resumed": resumed, "deduplicated": deduplicated})
+        except DISCONNECTS:
+            raise
+        except Exception as e:
+            await self.reply_failure(session, request, e)
+
+    async def handle_upload_chunk(self, session, request):#one chunk, written and fsynced before it counts
+        try:
+            upload = self.files.get_upload(request.args["upload_id"])
+            if upload is None or upload["owner"] != session.name:
+                await session.reply_error(request, "Unknown upload.")
+                return
+            offset = int(request.args["offset"])
+            chunk_size = upload["chunk_size"]
+            index = offset // chunk_size
+            #any missing chunk may come next, so several connections can fill one upload
+            if offset % chunk_size or not 0 <= offset < upload["size"]:
+                await session.reply_error(request, "Unexpected offset.", {"offset": upload["committed"]})
+                return
+            expected = min(chunk_size, upload["size"] - offset)
+            if "encoding" not in request.args and request.body_len != expected:#compressed ones are checked decoded
+                await session.reply_error(request, "Bad chunk length.", {"offset": offset})
+                return
+            if index < len(upload["checksums"]) and upload["checksums"][index] is not None:#resent, already have it
+                await session.reply(request, "Chunk stored.", {"offset": upload["committed"]})
+                return
+
+            writer = ChunkingWriter(self.staging_dir, chunk_size)
+            try:
+                target = self.body_target(request, writer, expected)
+                with self.metrics.transfer("upload"):
+                    await session.receive_body(request, target)
+                if target is not writer:
+                    target.finish()
+                    if target.error is not None:
+                        await session.reply_error(request, target.error, {"offset": offset})
+                        return
+                if not writer.chunks or writer.chunks[0].size != expected:
+                    await session.reply_error(request, "Bad chunk length.", {"offset": offset})
+                    return
+                chunk = writer.chunks[0]
+                if chunk.crc != int(request.args["crc32"]):#corrupted in transit, it will be resent
+                    await session.reply_error(request, "Checksum mismatch.", {"offset": offset})
+                    return
+                await asyncio.gather(writer.hashed(), self.loop.run_in_executor(None, writer.sync))#hash during fsync
+                if request.args.get("hash", chunk.digest) != chunk.digest:
+                    await session.reply_error(request, "Chunk hash mismatch.", {"offset": offset})
+                    return
+                writer.close()
+
+                #no await from here on, so the upload cannot change under us
+                if self.files.get_upload(upload["upload_id"]) is None:
+                    await session.reply_error(request, "Unknown upload.")
+                    return
+                with self.files.transaction():#a chunk found in the store is referenced before it can be collected
+                    self.store_chunks(writer)
+                    committed = self.files.store_chunk(upload["upload_id"], index, chunk.crc, chunk.digest, chunk.size)
+                if target is not writer:#compressed as it arrived, later downloads can be sent as-is
+                    self.chunk_store.put_encoded(writer.copy_path, chunk.digest, request.args["encoding"])
+            finally:
+                writer.discard()
+            await session.reply(request, "Chunk stored.", {"offset": committed})
+        except DISCONNECTS:
+            raise
+        except Exception as e:
+            await self.reply_failure(session, request, e)
+
+    async def handle_upload_commit(self, session, request):#all chunks are in, publish the file atomically
+        try:
+            upload = self.files.get_upload(request.args["upload_id"])
+            if upload is None or upload["owner"] != session.name:
+                await session.reply_error(request, "Unknown upload.")
+                return
+            if upload["committed"] != upload["size"]:
+                await session.reply_error(request, "Upload incomplete.", {"offset": upload["committed"]})
+                return
+            checksum = transfer.file_checksum(upload["hashes"])#from the chunk hashes, the file is never read again
+            if request.args.get("checksum", checksum) != checksum:#the client's copy is not what arrived
+                await session.reply_error(request, "Checksum mismatch.")
+                return
+            unique_filename = upload["upload_id"]
+            with self.files.transaction():#the chunk references of the upload move to the file
+                self.files.add(unique_filename, session.name, upload["filename"], upload["size"],
+                               upload["chunk_size"], upload["checksums"], upload["hashes"], checksum)
+                self.files.finish_upload(unique_filename)
+            self.replaced_content(unique_filename)
+            self.log_message(f"{session.name} uploaded {upload['filename']}.")
+            await session.reply(request, "Upload successful.", {"checksum": checksum})
+        except DISCONNECTS:
+            raise
+        except Exception as e:
+            await self.reply_failure(session, request, e)
+
+    async def handle_download(self, session, request):#handle file downloads
+        try:
+            owner_name = request.args["owner"]
+            filename = request.args["filename"]
+            unique_filename = f"{owner_name}_{filename}"
+            async with self.pinned(unique_filename) as content:#its chunks stay on disk until the body is out
+                if content is None:#check if file exist if not error
+                    await session.reply_error(request, "File not found.")
+                    return
+                filepath = os.path.join(self.directory, unique_filename)#file path, for files stored whole
+                filesize = content[0] if content[2] is not None else os.path.getsize(filepath)
+
+                #optional byte range, resumed downloads ask for the rest of the file
+                offset = request.args.get("offset", 0)
+                length = request.args.get("length")
+                if not is_count(offset) or not (length is None or is_count(length)):
+                    await session.reply_error(request, "Requested range not satisfiable.")
+                    return
+                checksum = content[3]#whole-file checksum, files stored before there were checksums have none
+                if checksum is None and content[2] is not None:#but their chunk hashes give it
+                    checksum = transfer.file_checksum(content[2])
+                meta = {"size": filesize, "checksum": checksum}
+                if request.args.get("checksums"):#per-chunk crc32, the range then starts on a chunk boundary
+                    chunk_size, checksums, stored = await self.chunk_checksums(unique_filename, filepath)
+                    meta["checksum"] = stored or checksum
+                    offset -= offset % chunk_size
+                    meta["chunk_size"] = chunk_size
+                if not 0 <= offset <= filesize:
+                    await session.reply_error(request, "Requested range not satisfiable.")
+                    return
+                length = filesize - offset if length is None else min(length, filesize - offset)
+                if "chunk_size" in meta:
+                    meta["checksums"] = checksums[offset // chunk_size:-(-(offset + length) // chunk_size)]
+                meta["offset"] = offset
+                meta["length"] = length
+
+                codec = None
+                if session.framed and "chunk_size" in meta and length:#compressed bodies go one chunk per frame
+                    codec = compression.pick(self.codecs, request.args.get("accept_encoding"), filename)
+                with self.metrics.transfer("download"):
+                    if codec is not None:
+                        await self.send_segments(session, request, meta, filepath, content, offset, length, codec)
+                    else:
+                        #announce the size (legacy clients answer READY first)
+                        if not await session.begin_payload(request, length, meta):
+                            return
+
+                        #send file chunk by chunk, from the hot-file cache or zero-copy where the kernel supports it
+                        for path, start, count, file_size in self.content_ranges(filepath, content, offset, length):
+                            await self.send_range(session, path, start, count, file_size)
+            if offset + length < filesize:#only part of the file so far
+                return
+            self.log_message(f"{session.name} downloaded {filename} from {owner_name}.")
+
+            #let owner know if connected, queued on the owner's connection so it never splits a transfer there
+            owner = self.connected_clients.get(owner_name)
+            if owner is not None:
+                owner.notify(f"{session.name} downloaded your file {filename}.")
+            elif self.coordinator is not None:#maybe connected to another worker
+                self.coordinator.notify(owner_name, f"{session.name} downloaded your file {filename}.")
+        except DISCONNECTS:
+            raise
+        except Exception as e:
+            await self.reply_failure(session, request, e)
+
+    async def send_segments(self, session, request, meta, filepath, content, offset, length, codec):
+        """DOWNLOAD body as one frame per chunk, each compressed with codec where that pays off.
+
+        The first frame carries the reply meta, every frame says whether its body is
+        encoded. A stored chunk is compressed once, later downloads send the saved
+        compressed copy with sendfile like any other file."""
+        chunk_size = meta["chunk_size"]
+        starts = range(offset, offset + length, chunk_size)
+        for i, start in enumerate(starts):
+            count = min(chunk_size, offset + length - start)
+            (path, position, _, file_size), = self.content_ranges(filepath, content, start, count)
+            digest = None
+            if content[2] is not None and count == min(chunk_size, content[0] - start):#a whole stored chunk
+                digest = content[2][start // chunk_size]
+            segment = dict(meta) if i == 0 else {}
+            flags = protocol.FLAG_MORE if i < len(starts) - 1 else 0
+
+            source = (path, position, count)
+            if digest is not None and os.path.exists(self.chunk_store.encoded_path(digest, codec)):
+                encoded_path = self.chunk_store.encoded_path(digest, codec)
+                source = (encoded_path, 0, os.path.getsize(encoded_path))
+                file_size = source[2]
+                segment["encoding"] = codec
+            else:
+                encoded = await self.loop.run_in_executor(None, self.encode_piece, codec, path, position, count, digest)
+                if encoded is not None:
+                    source = encoded
+                    segment["encoding"] = codec
+
+            if isinstance(source, bytes):
+                await session.begin_payload(request, len(source), segment, flags)
+                session.writer.write(source)
+                await session.writer.drain()
+            else:
+                path, position, count = source
+                await session.begin_payload(request, count, segment, flags)
+                await self.send_range(session, path, position, count, file_size)
+
+    async def send_range(self, session, path, start, count, file_size=None):
+        """count bytes of the file at path from start. Chunk files (file_size given, they never change)
+        come from the hot-file cache when they are mapped there, in pieces so a slow client
+        never has more than one piece buffered; everything else goes out with sendfile."""
+        view = self.hot_files.get(path, file_size) if file_size is not None else None
+        if view is None or start + count > len(view):
+            with open(path, 'rb') as f:
+                await transfer.send_file(session.writer, f, start, count, self.chunk_size)
+            return
+        for position in range(start, start + count, self.chunk_size):
+            session.writer.write(view[position:min(position + self.chunk_size, start + count)])
+            await session.writer.drain()
+
+    def encode_piece(self, codec, path, position, count, digest=None):
+        """Blocking, runs in the executor: the piece compressed with codec, or None if it does not shrink.
+
+        For a whole stored chunk (digest given) the result is saved for later downloads."""
+        with open(path, 'rb') as f:
+            if not compression.looks_compressible(lambda at, n: transfer.pread(f, n, position + at), count):
+                return None
+            encoded = compression.encode(codec, transfer.pread(f, count, position))
+        if encoded is not None and digest is not None:
+            fd, temp_path = tempfile.mkstemp(dir=self.staging_dir, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                f.write(encoded)
+            self.chunk_store.put_encoded(temp_path, digest, codec)
+        return encoded
+
+    def content_ranges(self, filepath, content, offset, length):
+        """[(path, offset, count, file size)] holding a byte range; the size is that of the chunk file,
+        from the manifest, and None for a file stored whole."""
+        size, chunk_size, manifest, _ = content
+        if manifest is None:
+            return [(filepath, offset, length, None)]
+        ranges = []
+        for path, start, count in self.chunk_store.ranges(chunk_size, manifest, offset, length):
+            ranges.append((path, start, count, min(chunk_size, size - (offset - start))))#the chunk begins at offset - start
+            offset += count
+        return ranges
+
+    async def chunk_checksums(self, unique_filename, filepath):
+        """(chunk_size, [crc32 per chunk], whole-file checksum): stored ones, or computed once off the
+        event loop for a file stored whole, the checksum in the same read."""
+        async with self.file_locks[unique_filename]:#concurrent downloads of the file wait for one computation
+            stored = self.files.chunk_checksums(unique_filename)
+            if stored is None:
+                hashers = []
+                checksums = await self.loop.run_in_executor(
+                    None, lambda: transfer.file_checksums(filepath, hashers=hashers))
+                stored = (transfer.TRANSFER_CHUNK_SIZE, checksums,
+                          transfer.file_checksum([hasher.hexdigest() for hasher in hashers]))
+                self.files.set_chunk_checksums(unique_filename, *stored)
+        return stored
+
+    @property
+    def staging_dir(self):#uploads in progress, same filesystem as the storage so rename is atomic
+        return os.path.join(self.directory, STAGING_DIR)
+
+    def clean_staging(self):#forget abandoned uploads and temp files of interrupted transfers
+        os.makedirs(self.staging_dir, exist_ok=True)
+        for upload_id in self.files.stale_uploads(STALE_UPLOAD_AGE):
+            self.files.abort_upload(upload_id)
+        self.collect_garbage()
+        for entry in os.listdir(self.staging_dir):
+            if entry.endswith((".tmp", ".part")):#.part files are from before the chunk store
+                os.remove(os.path.join(self.staging_dir, entry))
+
+    async def handle_delete(self, session, request):#handle file deletion
+        try:
+            filename = request.args["filename"]
+            unique_filename = f"{session.name}_{filename}"
+            content = self.files.content(unique_filename)
+            if content is None:#check if file exist
+                await session.reply_error(request, "File not found.")#error if no file found with that name
+                return
+            if not self.files.remove(unique_filename):#remove from file record, this releases its chunks
+                await session.reply_error(request, "File not found.")#deleted meanwhile on another worker
+                return
+            if content[2] is None:#stored whole, delete file now that no record points at it
+                self.remove_whole_file(unique_filename)
+            self.try_collect_garbage()
+            self.log_message(f"{session.name} deleted {filename}.")
+            await session.reply(request, "Delete successful.")#log message of success
+        except DISCONNECTS:
+            raise
+        except Exception as e:
+            await self.reply_failure(session, request, e)
+
+    async def handle_list(self, session, request):
+        try:
+            args = request.args
+            meta = {}
+            checksums = session.framed and bool(args.get("checksums"))#legacy listings keep their format
+            if "since" in args:#delta mode: what changed after the client's version
+                file_list_bytes, meta = self.list_delta(int(args["since"]), checksums)
+            elif any(key in args for key in ("owner", "prefix", "cursor", "limit")):#filtered page
+                file_list_bytes, meta = self.list_page(args, checksums)
+            else:#the full listing, encoded once per catalog version
+                file_list_bytes, meta["version"] = self.cached_listing(
+                    "text checksums" if checksums else "text", lambda rows: self.encode_listing(rows, checksums))
+            codec = compression.pick(self.codecs, args.get("accept_encoding")) if session.framed else None
+            if codec is not None and self.encoded_listing(file_list_bytes, codec) is not None:
+                file_list_bytes = self.encoded_listing(file_list_bytes, codec)
+                meta["encoding"] = codec
+
+            #size of the file list
+            file_list_size = len(file_list_bytes)
+            meta["size"] = file_list_size
+            self.log_message(f"Sending file list of size: {file_list_size} bytes.")
+
+            #send the size of the file list (legacy clients answer READY first)
+            if not await session.begin_payload(request, file_list_size, meta):
+                self.log_message("Client failed to acknowledge list request.")
+                return
+
+            #send the file list data
+            session.writer.write(file_list_bytes)
+            await session.writer.drain()
+            self.log_message("File list sent to client successfully.")
+        except DISCONNECTS:
+            raise
+        except Exception as e:
+            self.log_message(f"Error in handle_list: {e}")
+            if session.framed:#a framed client is waiting for a reply with this id
+                await self.reply_failure(session, request, e)
+
+    def cached_listing(self, kind, encode):#(bytes, version); rebuilt only after an upload or delete
+        version = self.files.version()
+        cached = self.list_cache.get(kind)
+        if cached is None or cached[1] != version:
+            cached = (encode(self.files.page()), version)
+            self.list_cache[kind] = cached
+        return cached
+
+    def encoded_listing(self, body, codec):#compressed body (or None), reused while the same listing is sent
+        cached = self.list_cache.get(("encoded", codec))
+        if cached is None or cached[0] is not body:
+            cached = (body, compression.encode(codec, body))
+            self.list_cache[("encoded", codec)] = cached
+        return cached[1]
+
+    def encode_listing(self, rows, checksums=False):
+        """"filename (Owner: owner)" lines, the format every client shows; with checksums each line
+        ends with a tab and the whole-file checksum (nothing after the tab if not known)."""
+        if checksums:
+            return "\n".join(f"{filename} (Owner: {owner})\t{checksum or ''}"
+                             for _, owner, filename, _, checksum in rows).encode()
+        return "\n".join(f"{filename} (Owner: {owner})" for _, owner, filename, *_ in rows).encode()
+
+    def encode_changes(self, changes, checksums=False):
+        """op<TAB>owner<TAB>filename<TAB>size lines, op is + or -; with checksums a fifth column
+        holds the whole-file checksum of an added file (empty if not known)."""
+        if checksums:
+            return "".join(f"{op}\t{owner}\t{filename}\t{size}\t{checksum or ''}\n"
+                           for op, owner, filename, size, checksum in changes).encode()
+        return "".join(f"{op}\t{owner}\t{filename}\t{size}\n" for op, owner, filename, size, _ in changes).encode()
+
+    def list_page(self, args, checksums=False):
+        limit = int(args["limit"]) if args.get("limit") is not None else None
+        if limit is not None and limit < 1:#SQLite would take a negative limit as none at all
+            raise ValueError("Page limit must be at least 1.")
+        rows = self.files.page(args.get("owner"), args.get("prefix"), int(args.get("cursor") or 0), limit)
+        more = rows and len(rows) == limit#a full page, there may be more after its last row
+        meta = {"version": self.files.version(), "count": len(rows), "next_cursor": rows[-1][0] if more else None}
+        return self.encode_listing(rows, checksums), meta
+
+    def list_delta(self, since, checksums=False):
+        version, changes = self.files.changes_since(since)
+        if changes is None:#log does not reach back that far, send everything as additions
+            body, version = self.cached_listing(
+                "snapshot checksums" if checksums else "snapshot",
+                lambda rows: self.encode_changes((("+", o, f, n, c) for _, o, f, n, c in rows), checksums)
+            )
+            return body, {"version": version, "reset": True}
+        return self.encode_changes(changes, checksums), {"version": version, "reset": False}
+
+    def load_files(self):#open the catalog, records are read on demand
+        self.files = Catalog(self.catalog_path)
+        json_path = legacy_json_path(self.catalog_path)
+        if self.files.created and os.path.exists(json_path):#first start after the files.json era
+            count = self.files.import_json(json_path)
+            self.log_message(f"Imported {count} file records from {json_path}.")
+
+    def save_files(self):#every change is already committed, just fold the log into the database
+        self.files.checkpoint()
+
+
+def is_count(value):#a non-negative integer from request meta (JSON true is not one)
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def raise_fd_limit():#idle connections each hold a descriptor, so lift the soft limit
+    try:
+        import resource
+    except ImportError:#not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def main(argv=None):#command line entry point, no GUI needed
+    parser = argparse.ArgumentParser(description="Headless CS408 file server.")
+    parser.add_argument("directory", help="storage directory for uploaded files")
+    parser.add_argument("-p", "--port", type=int, required=True, help="TCP port to listen on")
+    parser.add_argument("-b", "--bind", default="0.0.0.0", help="bind address (default 0.0.0.0)")
+    parser.add_argument("--catalog", default="files.db", help="SQLite file records (default files.db)")
+    parser.add_argument("--chunk-size", type=int, default=transfer.SEND_CHUNK_SIZE,
+                        help="copy block size in bytes when sendfile is unavailable")
+    parser.add_argument("--recv-buffer", type=int, default=RECV_BUFFER_SIZE,
+                        help="size in bytes of the pooled upload receive buffers")
+    parser.add_argument("--compression", default=",".join(compression.CODECS),
+                        help="codecs offered to clients, preferred first (empty to turn compression off)")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--metrics-bind", default="127.0.0.1", help="bind address of the metrics endpoint (default 127.0.0.1)")
+    parser.add_argument("--hot-cache", type=int, default=HOT_CACHE_SIZE >> 20,
+                        help=f"MiB of popular chunk files kept mapped in memory (default {HOT_CACHE_SIZE >> 20}, 0 turns it off)")
+    parser.add_argument("--limit-in", type=float, default=0, help="server upload bandwidth cap in MiB/s (0 for none)")
+    parser.add_argument("--limit-out", type=float, default=0, help="server download bandwidth cap in MiB/s (0 for none)")
+    parser.add_argument("--client-limit-in", type=float, default=0, help="upload bandwidth cap of each client in MiB/s")
+    parser.add_argument("--client-limit-out", type=float, default=0, help="download bandwidth cap of each client in MiB/s")
+    parser.add_argument("--weight", action="append", default=[], metavar="NAME=WEIGHT",
+                        help="share of a client under the server caps, relative to the default 1 (repeatable)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port through SO_REUSEPORT (default 1, one process)")
+    args = parser.parse_args(argv)
+
+    raise_fd_limit()
+    codecs = [name for name in args.compression.split(",") if name]
+    unknown = [name for name in codecs if name not in compression.CODECS]
+    if unknown:
+        parser.error(f"unknown codec {unknown[0]}, choose from {', '.join(compression.CODECS)}")
+    weights = {}
+    for item in args.weight:
+        name, _, weight = item.rpartition("=")
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = 0
+        if not name or weight <= 0:
+            parser.error(f"bad weight {item}, expected NAME=WEIGHT with a positive weight")
+        weights[name] = weight
+    limits = BandwidthLimits.from_mib(args.limit_in, args.limit_out, args.client_limit_in, args.client_limit_out)
+    options = dict(host=args.bind, catalog_path=args.catalog, chunk_size=args.chunk_size, recv_buffer_size=args.recv_buffer,
+                   codecs=codecs, metrics_port=args.metrics_port, metrics_host=args.metrics_bind,
+                   hot_cache_size=args.hot_cache << 20, bandwidth_limits=limits)
+    if args.workers > 1:
+        if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+            parser.error("--workers needs SO_REUSEPORT and Unix sockets (Linux, BSD)")
+        serve_cluster(args.directory, args.port, args.workers, options, weights)
+        return
+    server = FileServer(args.directory, args.port, **options)
+    for name, weight in weights.items():
+        server.bandwidth.set_weight(name, weight)
+    server.run()
+
+
+if __name__ == "__main__":
+    main()
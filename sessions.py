@@ -0,0 +1,233 @@
+"""Per-connection wire handling for the server core.
+
+FileServer handlers only talk to a session object, so the same handler serves
+the original text protocol (LegacySession) and the framed protocol from
+protocol.py (FramedSession).
+"""
+import asyncio
+from collections import deque, namedtuple
+
+import protocol
+
+#errors that mean the peer is gone, handlers let these through instead of replying
+DISCONNECTS = (ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError)
+
+Request = namedtuple("Request", "command args request_id body_len text")
+
+NOTICE_BACKLOG = 1000#notifications held for one connection, the oldest are dropped past this
+NOTICE_BUFFER_LIMIT = 1 << 20#unsent bytes in the transport above which notifications wait too
+
+LEGACY_FIELDS = {#text command -> names of its '|' separated fields
+    "UPLOAD": ("filename", "size"),
+    "DOWNLOAD": ("owner", "filename"),
+    "DELETE": ("filename",),
+    "LIST": (),
+}
+
+
+class NoticeQueue:
+    """Per-connection outbound queue for notifications raised by other clients' requests.
+
+    A notification is written straight away when nothing else is going out on
+    the connection. While a reply is being sent it waits for the reply to end:
+    it must not land between a payload header and its body, and asyncio refuses
+    writes while sendfile runs. Either way the notifying client never waits."""
+
+    def init_notices(self):
+        self.sending = False#a payload header is out and its body is not finished yet
+        self.notices = deque(maxlen=NOTICE_BACKLOG)
+
+    def notify(self, message):
+        if self.sending or self.notices or self.writer.transport.get_write_buffer_size() > NOTICE_BUFFER_LIMIT:
+            self.notices.append(message)
+        else:
+            self.writer.write(self.encode_notice(message))
+
+    def end_reply(self):#called after every request, delivers what was held back
+        self.sending = False
+        while self.notices and self.writer.transport.get_write_buffer_size() <= NOTICE_BUFFER_LIMIT:
+            self.writer.write(self.encode_notice(self.notices.popleft()))
+
+
+class LegacySession(NoticeQueue):
+    """Original text protocol: one recv(1024) per command, fields split on '|'."""
+    framed = False
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.name = None
+        self.hello_meta = {}#the text protocol has nothing besides the username
+        self.failed_request = None#last request answered with an error, for the metrics
+        self.init_notices()
+
+    async def hello(self, data):#first message is the bare username
+        return data.decode()
+
+    async def accept(self, meta=None):
+        await self.send_text("Connected successfully.")
+
+    async def reject(self, message):
+        await self.send_text(f"Error: {message}")
+
+    async def read_request(self):
+        data = (await self.reader.read(1024)).decode()
+        if not data:
+            return None
+        parts = data.split('|')
+        args = dict(zip(LEGACY_FIELDS.get(parts[0], ()), parts[1:]))
+        body_len = 0
+        size = args.get("size", "")
+        if parts[0] == "UPLOAD" and size.isascii() and size.isdigit():#anything else stays a string, handle_upload refuses it
+            body_len = args["size"] = int(size)
+        return Request(parts[0], args, 0, body_len, data)
+
+    async def finish_request(self):#nothing to resync, the text protocol has no framing
+        pass
+
+    async def receive_body(self, request, f, count=None):#returns the number of bytes written to f
+        return await self.reader.readinto_file(f, request.body_len if count is None else count)
+
+    async def reply(self, request, message, meta=None, flags=0):
+        await self.send_text(message)
+
+    async def reply_error(self, request, message, meta=None, flags=0):
+        self.failed_request = request
+        await self.send_text(f"Error: {message}")
+
+    async def begin_payload(self, request, size, meta=None):#announce the size and wait for READY
+        self.sending = True
+        await self.send_text(f"{request.command}|{size}")
+        ack = (await self.reader.read(1024)).decode()
+        return ack == "READY"
+
+    def encode_notice(self, message):
+        return f"NOTIFY|{message}".encode()
+
+    async def send_text(self, text):
+        self.writer.write(text.encode())
+        await self.writer.drain()
+
+
+class FramedSession(NoticeQueue):
+    """Length-prefixed frames (protocol.py); requests may be pipelined by the client."""
+    framed = True
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.name = None
+        self.hello_id = 0
+        self.hello_meta = {}#everything the HELLO frame carried besides the name
+        self.body_left = 0#unread body bytes of the request being handled
+        self.failed_request = None#last request answered with an error, for the metrics
+        self.init_notices()
+
+    async def hello(self, data):#finish the preface, answer it, then read the HELLO frame
+        while len(data) < len(protocol.PREFACE) and protocol.PREFACE.startswith(data[:len(protocol.MAGIC)]):
+            more = await self.reader.read(len(protocol.PREFACE) - len(data))
+            if not more:
+                raise protocol.ProtocolError("Connection closed during negotiation")
+            data += more
+        offered = protocol.parse_preface(data[:len(protocol.PREFACE)])
+        if len(data) > len(protocol.PREFACE):#the HELLO frame came in the same write, leave it for read_frame
+            self.reader.unread(data[len(protocol.PREFACE):])
+        self.writer.write(protocol.PREFACE)#frames are always VERSION, a peer that cannot speak it learns so and goes
+        await self.writer.drain()
+        if offered < protocol.VERSION:
+            raise protocol.ProtocolError(f"Unsupported protocol version {offered}")
+
+        frame = await protocol.read_frame(self.reader)
+        if frame is None or frame.type != protocol.HELLO:
+            raise protocol.ProtocolError("Expected HELLO frame")
+        self.hello_id = frame.request_id
+        self.hello_meta = frame.meta
+        return str(frame.meta.get("name", ""))
+
+    async def accept(self, meta=None):
+        protocol.write_frame(self.writer, protocol.OK, self.hello_id, dict(meta or {}, message="Connected successfully."))
+        await self.writer.drain()
+
+    async def reject(self, message):
+        protocol.write_frame(self.writer, protocol.ERROR, self.hello_id, {"message": message})
+        await self.writer.drain()
+
+    async def read_request(self):
+        frame = await protocol.read_frame(self.reader)
+        if frame is None:
+            return None
+        self.body_left = frame.body_len
+        command = protocol.COMMAND_NAMES.get(frame.type, f"TYPE{frame.type}")
+        text = f"{command} {frame.meta}"
+        if isinstance(frame.meta.get("ops"), list):#a manifest would flood the log
+            text = f"{command} ({len(frame.meta['ops'])} operations)"
+        return Request(command, frame.meta, frame.request_id, frame.body_len, text)
+
+    async def finish_request(self):#skip whatever body the handler did not consume
+        if self.body_left:
+            await self.receive_body(None, None)
+
+    async def receive_body(self, request, f, count=None):#f=None discards; count takes only that much of the body
+        expected = self.body_left if count is None else min(count, self.body_left)
+        received = await self.reader.readinto_file(f, expected)
+        self.body_left -= received
+        if received < expected:
+            raise asyncio.IncompleteReadError(b"", expected)
+        return received
+
+    async def reply(self, request, message, meta=None, flags=0):
+        protocol.write_frame(self.writer, protocol.OK, request.request_id, dict(meta or {}, message=message), flags=flags)
+        await self.writer.drain()
+
+    async def reply_error(self, request, message, meta=None, flags=0):
+        self.failed_request = request
+        protocol.write_frame(self.writer, protocol.ERROR, request.request_id, dict(meta or {}, message=message), flags=flags)
+        await self.writer.drain()
+
+    async def begin_payload(self, request, size, meta=None, flags=0):#no READY round trip, the body follows the header
+        self.sending = True
+        self.writer.write(protocol.encode_header(protocol.OK, request.request_id, meta, size, flags))
+        return True
+
+    def encode_notice(self, message):
+        return protocol.encode_header(protocol.NOTIFY, 0, {"message": message}, 0)
+
+
+class BatchItem:
+    """The session as seen by a handler running one operation of a BATCH request.
+
+    Replies become frames of the batch reply, tagged with the item's index and
+    flagged FLAG_MORE (more items or the summary follow). The request body is
+    the item's slice of the batch body. Everything else is the real session."""
+
+    def __init__(self, session, index, length):
+        self.session = session
+        self.index = index
+        self.body_left = length#unread bytes of this item's slice
+        self.ok = False#the handler answered with a success
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    async def receive_body(self, request, f, count=None):
+        count = self.body_left if count is None else min(count, self.body_left)
+        received = await self.session.receive_body(request, f, count)
+        self.body_left -= received
+        return received
+
+    async def finish_request(self):#skip what the handler left of the slice, the next item's body follows
+        if self.body_left:
+            await self.receive_body(None, None)
+
+    async def reply(self, request, message, meta=None, flags=0):
+        self.ok = True
+        await self.session.reply(request, message, dict(meta or {}, index=self.index), flags | protocol.FLAG_MORE)
+
+    async def reply_error(self, request, message, meta=None, flags=0):
+        self.ok = False
+        await self.session.reply_error(request, message, dict(meta or {}, index=self.index), flags | protocol.FLAG_MORE)
+
+    async def begin_payload(self, request, size, meta=None, flags=0):
+        self.ok = True
+        return await self.session.begin_payload(request, size, dict(meta or {}, index=self.index),
+                                                flags | protocol.FLAG_MORE)
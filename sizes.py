@@ -0,0 +1,8 @@
+"""Byte counts as people read them, shared by the client window and the server's stats panel (no Qt here)."""
+
+
+def format_size(count):#decimal units: "512 B", "1.2 MB"
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1000 or unit == "GB":
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1000
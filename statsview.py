@@ -0,0 +1,73 @@
+"""Compact live statistics of a running FileServer for the server window.
+
+A QTimer on the GUI thread takes a Metrics snapshot once per interval and
+shows connections, transfers, throughput and per-command latency in a label,
+so the panel never touches the event loop.
+"""
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QFontDatabase
+
+from sizes import format_size#the same sizes the client window shows
+
+STATS_INTERVAL = 1000#ms between refreshes
+
+
+class StatsPanel:
+    """Fills a QLabel from metrics.snapshot(); create it on the GUI thread."""
+
+    def __init__(self, label, interval=STATS_INTERVAL):
+        self.label = label
+        self.metrics = None
+        self.last = None#(uptime, bytes in, bytes out) at the previous refresh, for the rates
+        label.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        label.setText("Server not running.")
+        self.timer = QTimer(label)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(interval)
+
+    def watch(self, metrics):#the Metrics of the server that just started
+        self.metrics = metrics
+        self.last = None
+        self.refresh()
+
+    def refresh(self):
+        if self.metrics is None:
+            return
+        snapshot = self.metrics.snapshot()
+        now = (snapshot["uptime"], snapshot["bytes_in"], snapshot["bytes_out"])
+        rate_in = rate_out = 0.0
+        if self.last is not None and now[0] > self.last[0]:
+            rate_in = (now[1] - self.last[1]) / (now[0] - self.last[0])
+            rate_out = (now[2] - self.last[2]) / (now[0] - self.last[0])
+        self.last = now
+
+        transfers = snapshot["transfers"]
+        requests = snapshot["requests"]
+        gauges = snapshot["gauges"]
+        errors = sum(count for (_, outcome), count in requests.items() if outcome == "error")
+        lines = [
+            f"Clients {gauges.get('clients', 0)}   connections {snapshot['connections']}"
+            f"   transfers {transfers.get('upload', 0)} up / {transfers.get('download', 0)} down",
+            f"In {format_rate(rate_in)}   out {format_rate(rate_out)}"
+            f"   requests {sum(requests.values())} ({errors} failed)",
+        ]
+        if "hot_cache_hits_total" in gauges:
+            lookups = gauges["hot_cache_hits_total"] + gauges["hot_cache_misses_total"]
+            ratio = 100 * gauges["hot_cache_hits_total"] / lookups if lookups else 0
+            lines.append(f"Hot cache {format_size(gauges['hot_cache_bytes'])} in {gauges['hot_cache_files']} files,"
+                         f" {ratio:.0f}% of sends hit")
+        if gauges.get("bandwidth_wait_seconds_total"):#only once a limit has held something back
+            lines.append(f"Bandwidth limited: {gauges['bandwidth_waiting']} transfers queued,"
+                         f" {gauges['bandwidth_wait_seconds_total']:.1f} s waited in all")
+        for command, histogram in sorted(snapshot["latency"].items()):
+            lines.append(f"{command:<16} {histogram.count:>8}   p50 {format_ms(histogram.quantile(0.5))}"
+                         f"   p99 {format_ms(histogram.quantile(0.99))}")
+        self.label.setText("\n".join(lines))
+
+
+def format_rate(count):#bytes per second
+    return f"{format_size(count)}/s"
+
+
+def format_ms(seconds):
+    return f"{seconds * 1000:8.1f} ms" if seconds is not None else "       - ms"
@@ -0,0 +1,87 @@
+"""Fixtures: a FileServer on a free local port in this process, and connected FileClients."""
+import os
+import socket
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from catalog import SCHEMA  # noqa: E402
+from fileclient import FileClient  # noqa: E402
+from server_core import FileServer  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def random_file(path, size):#writes size random bytes to path, returns them
+    data = os.urandom(size)
+    with open(path, "wb") as f:
+        f.write(data)
+    return data
+
+
+def old_catalog(path, version):#empty catalog as a server of that schema version left it, returns an open connection
+    db = sqlite3.connect(path)
+    for statements in SCHEMA[1:version + 1]:
+        for statement in statements:
+            db.execute(statement)
+    db.execute(f"PRAGMA user_version={version}")
+    db.commit()
+    return db
+
+
+@pytest.fixture
+def storage(tmp_path):#storage directory of the server, the catalog sits next to it
+    path = tmp_path / "store"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def start_server(tmp_path, storage):
+    """start_server(**options) runs a FileServer on storage, stopped after the test. Call it after
+    putting whatever the server should find at startup (catalog, files.json, files) in place. Clients
+    connect to server.port; start_server(port=...) restarts on the port of a server stopped before."""
+    servers = []
+
+    def start(port=None, **options):
+        log = []
+        server = FileServer(str(storage), port or free_port(), "127.0.0.1", log=log.append,
+                            catalog_path=str(tmp_path / "files.db"), **options)
+        server.log = log#lines the server logged so far
+        server.start_in_thread()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+        server.save_files()
+
+
+@pytest.fixture
+def server(start_server):
+    return start_server()
+
+
+@pytest.fixture
+def connect():
+    """connect(port, name, **options) returns a connected FileClient whose log lines are in client.log."""
+    clients = []
+
+    def connect(port, name, **options):
+        log = []
+        client = FileClient("127.0.0.1", port, name, log=log.append, **options)
+        client.log = log
+        client.connect()
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        client.close()
@@ -0,0 +1,179 @@
+"""Bandwidth scheduling (bandwidth.py): token buckets, weighted fair queuing, and a client cap on a real download."""
+import asyncio
+import os
+import time
+
+import pytest
+
+import bandwidth
+from bandwidth import MIB, NO_LIMITS, QUANTUM, RECEIVE, SEND, BandwidthLimits, BandwidthScheduler, FairQueue, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bandwidth, "time", clock)
+    return clock
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket()
+    bucket.take(10 * MIB)
+    assert bucket.delay() == 0#no limit
+
+    bucket.set_rate(4 * MIB)
+    assert bucket.capacity == MIB#BURST seconds of the rate
+    bucket.take(2 * MIB)
+    assert bucket.delay() == pytest.approx(0.5)#in debt by 2 MiB at 4 MiB/s
+    clock.now += 0.25
+    assert bucket.delay() == pytest.approx(0.25)
+    clock.now += 10#idle: saves up no more than its capacity
+    assert bucket.delay() == 0 and bucket.tokens == MIB
+
+    bucket.set_rate(QUANTUM)#a slow rate still allows a quantum at once
+    assert bucket.capacity == QUANTUM and bucket.tokens == QUANTUM
+
+
+def test_limits_in_mib():
+    limits = BandwidthLimits.from_mib(1.5, 0, 2, 0)
+    assert limits == (int(1.5 * MIB), None, 2 * MIB, None)
+    assert limits.mib() == [1.5, 0, 2, 0]
+
+
+class Gate:#server bucket that grants only as many times as the test allows
+    def __init__(self):
+        self.allowed = 0
+
+    def delay(self):
+        return 0.0 if self.allowed else 3600.0
+
+    def take(self, count):
+        self.allowed -= 1
+
+
+class FakeFlow:
+    def __init__(self, weight=1):
+        self.weight = weight
+        self.finish = dict.fromkeys(bandwidth.DIRECTIONS, 0.0)
+
+
+def grant_order(flows, requests, grants):#names in the order the queue served them, one grant at a time
+    async def run():
+        gate = Gate()
+        queue = FairQueue(gate)
+        order = []
+
+        async def transfer(name, flow):
+            for _ in range(requests):
+                await queue.acquire(flow, SEND, QUANTUM)
+                order.append(name)
+
+        tasks = [asyncio.ensure_future(transfer(name, flow)) for name, flow in flows.items()]
+        await asyncio.sleep(0)#all of them wait behind the gate now
+        for _ in range(grants):
+            gate.allowed = 1
+            queue.dispatch()
+            for _ in range(3):#the served flow asks for its next quantum
+                await asyncio.sleep(0)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        queue.dispatch()#drops the cancelled waiters
+        return order
+    return asyncio.run(run())
+
+
+def test_fair_queue_shares_by_weight():
+    order = grant_order({"a": FakeFlow(), "b": FakeFlow(), "heavy": FakeFlow(2)}, requests=100, grants=40)
+    assert len(order) == 40
+    assert (order.count("a"), order.count("b"), order.count("heavy")) == (10, 10, 20)
+
+
+def test_newcomer_is_served_within_one_round():
+    async def run():
+        gate = Gate()
+        queue = FairQueue(gate)
+        big, small = FakeFlow(), FakeFlow()
+        order = []
+
+        async def transfer(name, flow, requests):
+            for _ in range(requests):
+                await queue.acquire(flow, SEND, QUANTUM)
+                order.append(name)
+
+        tasks = [asyncio.ensure_future(transfer("big", big, 1000))]
+        for _ in range(50):#the big transfer has had the link to itself for a while
+            await asyncio.sleep(0)
+            gate.allowed = 1
+            queue.dispatch()
+            await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(transfer("small", small, 1)))
+        await asyncio.sleep(0)
+        for _ in range(2):
+            gate.allowed = 1
+            queue.dispatch()
+            for _ in range(3):
+                await asyncio.sleep(0)
+        tasks[0].cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return order
+    order = asyncio.run(run())
+    assert "small" in order[-2:]#after at most one more quantum of the big one
+
+
+def test_control_traffic_never_waits_bulk_does():
+    async def run():
+        scheduler = BandwidthScheduler(BandwidthLimits(None, None, None, 16 * QUANTUM))
+        flow = scheduler.flow("alice")
+        started = time.monotonic()
+        await flow.take(SEND, 8 * QUANTUM)#control: at once, into debt
+        assert time.monotonic() - started < 0.05
+        assert await asyncio.wait_for(flow.take(RECEIVE, 8 * QUANTUM), 0.05) is None#no limit that way
+        flow.bulk = True
+        started = time.monotonic()
+        await flow.take(SEND, QUANTUM)#pays off the debt first: half a second at 16 quanta/s
+        elapsed = time.monotonic() - started
+        assert scheduler.waited == pytest.approx(elapsed, abs=0.05)
+        return elapsed
+    assert 0.4 < asyncio.run(run()) < 2
+
+
+def test_scheduler_clients_and_limits():
+    scheduler = BandwidthScheduler()
+    first, second = scheduler.flow("alice"), scheduler.flow("alice")
+    assert first.client is second.client and not first.limited(SEND)
+    scheduler.set_limits(BandwidthLimits(MIB, None, None, 2 * MIB))#applies to connected clients too
+    assert first.client.buckets[SEND].rate == 2 * MIB and first.limited(SEND) and first.limited(RECEIVE)
+    assert scheduler.limits == (MIB, None, None, 2 * MIB)
+    with pytest.raises(ValueError):
+        scheduler.set_weight("alice", 0)
+    scheduler.set_weight("alice", 3)
+    assert first.weight == 3 and scheduler.flow("bob").weight == 1
+    first.close()
+    assert "alice" in scheduler.clients
+    second.close()
+    assert "alice" not in scheduler.clients
+    scheduler.set_limits(NO_LIMITS)
+    assert not scheduler.flow("alice").limited(SEND)
+
+
+def test_client_cap_on_a_download(tmp_path, start_server, connect):
+    server = start_server(bandwidth_limits=BandwidthLimits(None, None, None, 4 * MIB))
+    data = os.urandom(2 * MIB)
+    (tmp_path / "f.bin").write_bytes(data)
+    connect(server.port, "alice", compression_codecs=()).upload(str(tmp_path / "f.bin"))
+
+    reader = connect(server.port, "bob", compression_codecs=())
+    started = time.monotonic()
+    with open(reader.download("alice", "f.bin", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == data
+    assert time.monotonic() - started > 0.3#2 MiB at 4 MiB/s, less the first burst
+    assert server.bandwidth.waited > 0
@@ -0,0 +1,85 @@
+"""BATCH: a manifest of operations run in order, one reply frame per item and a summary at the end."""
+import socket
+
+import pytest
+
+import protocol
+from conftest import random_file
+
+
+@pytest.fixture
+def framed(server):#raw framed connection of "alice", for frames the client library would not send
+    sock = socket.create_connection(("127.0.0.1", server.port))
+    sock.sendall(protocol.PREFACE + protocol.encode_header(protocol.HELLO, 1, {"name": "alice"}))
+    protocol.recv_exact(sock, len(protocol.PREFACE))
+    assert protocol.recv_frame(sock).type == protocol.OK
+    yield sock
+    sock.close()
+
+
+def send_batch(sock, request_id, ops, body=b""):#returns [(frame, body)] up to and including the summary
+    protocol.send_frame(sock, protocol.BATCH, request_id, {"ops": ops}, body)
+    frames = []
+    while True:
+        frame = protocol.recv_frame(sock)
+        assert frame.request_id == request_id
+        frames.append((frame, bytes(protocol.recv_exact(sock, frame.body_len))))
+        if not frame.flags & protocol.FLAG_MORE:
+            return frames
+
+
+def test_items_answered_in_order_with_their_own_errors(framed):
+    ops = [
+        {"op": "UPLOAD", "filename": "a.txt", "length": 5},
+        {"op": "DELETE", "filename": "missing.txt"},
+        {"op": "DOWNLOAD", "owner": "alice", "filename": "a.txt"},
+        {"op": "LIST"},#not allowed in a batch
+        {"op": "UPLOAD", "filename": "b.txt", "length": 3},
+        {"op": "DELETE", "filename": "b.txt"},
+    ]
+    frames = send_batch(framed, 2, ops, b"hello" + b"abc")
+    *items, (summary, _) = frames
+    assert [frame.meta["index"] for frame, _ in items] == list(range(len(ops)))
+    assert [frame.type for frame, _ in items] == [protocol.OK, protocol.ERROR, protocol.OK, protocol.ERROR,
+                                                 protocol.OK, protocol.OK]
+    assert items[1][0].meta["message"] == "File not found."
+    assert items[2][1] == b"hello"#the downloaded file follows its frame
+    assert items[3][0].meta["message"] == "Unknown command."
+    assert summary.type == protocol.OK and "index" not in summary.meta
+    assert (summary.meta["count"], summary.meta["failed"]) == (6, 2)
+
+
+@pytest.mark.parametrize("ops, body, message", [
+    ([{"op": "UPLOAD", "filename": "a.txt", "length": 5}], b"hello!", "Batch body does not match its manifest."),
+    ([{"op": "UPLOAD", "filename": "a.txt", "length": -1}], b"", "Batch body does not match its manifest."),
+    ([{"op": "DELETE", "filename": "a.txt"}] * (protocol.MAX_BATCH + 1), b"",
+     f"A batch holds at most {protocol.MAX_BATCH} operations."),
+    (["DELETE"], b"", "Bad batch manifest."),
+])
+def test_bad_manifest_is_refused_as_a_whole(server, framed, ops, body, message):
+    (frame, _), = send_batch(framed, 3, ops, body)
+    assert frame.type == protocol.ERROR and frame.meta["message"] == message
+    assert server.files.page() == []#nothing ran
+    #the body was skipped, the connection goes on
+    protocol.send_frame(framed, protocol.LIST, 4, {})
+    assert protocol.recv_frame(framed)[:3] == (protocol.OK, 0, 4)
+
+
+def test_many_small_files_through_the_client(tmp_path, server, connect):
+    client = connect(server.port, "alice")
+    assert client.batch_limit == protocol.MAX_BATCH
+    files = {f"f{i}.bin": random_file(tmp_path / f"f{i}.bin", 100 + i) for i in range(40)}
+    paths = [str(tmp_path / name) for name in files] + [str(tmp_path / "missing.bin")]
+    results = client.upload_many(paths, concurrency=2)
+    assert [result.item[1] for result in results] == list(files) + ["missing.bin"]#one result per item, in order
+    assert all(result.ok for result in results[:-1]) and not results[-1].ok
+
+    results = client.download_many([("alice", name) for name in files], str(tmp_path / "downloads"))
+    assert all(result.ok for result in results)
+    for name, data in files.items():
+        assert (tmp_path / "downloads" / name).read_bytes() == data
+
+    results = client.delete_many(list(files)[:10] + ["missing.bin"])
+    assert [result.ok for result in results] == [True] * 10 + [False]
+    assert results[-1].message == "File not found."
+    assert len(client.list_files()) == 30
@@ -0,0 +1,53 @@
+"""The SQLite catalog takes over from files.json, and a catalog from an older version opens with its records."""
+import json
+import sqlite3
+
+from catalog import SCHEMA, SCHEMA_VERSION, Catalog
+
+
+def user_version(path):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_files_json_import(tmp_path, storage, start_server, connect):
+    data = b"stored before there was a catalog\n" * 100
+    (storage / "alice_notes.txt").write_bytes(data)
+    (tmp_path / "files.json").write_text(json.dumps({"alice_notes.txt": "alice"}))
+
+    server = start_server()
+    assert user_version(tmp_path / "files.db") == SCHEMA_VERSION
+    assert "Imported 1 file records" in " ".join(server.log)
+
+    client = connect(server.port, "bob")
+    assert [(owner, filename) for owner, filename, _ in client.list_files("alice")] == [("alice", "notes.txt")]
+    path = client.download("alice", "notes.txt", str(tmp_path / "downloads"))
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+def test_every_migration_from_version_1(tmp_path, storage, start_server, connect):
+    path = tmp_path / "files.db"
+    db = sqlite3.connect(path)
+    for statement in SCHEMA[1]:
+        db.execute(statement)
+    db.execute("INSERT INTO files (unique_name, owner, filename, size) VALUES ('carol_a.bin', 'carol', 'a.bin', 5)")
+    db.execute("PRAGMA user_version=1")
+    db.commit()
+    db.close()
+    (storage / "carol_a.bin").write_bytes(b"hello")
+
+    catalog = Catalog(str(path))
+    assert not catalog.created
+    assert catalog.content("carol_a.bin") == (5, 0, None, None)
+    catalog.close()
+    assert user_version(path) == SCHEMA_VERSION
+
+    server = start_server()
+    client = connect(server.port, "dave")
+    assert client.list_files() == [("carol", "a.bin", 5)]
+    with open(client.download("carol", "a.bin", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == b"hello"
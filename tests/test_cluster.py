@@ -0,0 +1,114 @@
+"""--workers 2: two SO_REUSEPORT worker processes and their coordinator serve one port like a single server,
+and a request that finds the catalog locked by another worker either changes nothing or succeeds."""
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import free_port, random_file
+from fileclient import FileClient, FileClientError, ServerBusy
+
+needs_cluster = pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"),
+                                   reason="--workers needs SO_REUSEPORT and Unix sockets")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def cluster(tmp_path, storage):#port of a two-worker server, stopped with Ctrl+C after the test
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "server_core.py"), str(storage), "-p", str(port),
+                                "-b", "127.0.0.1", "--catalog", str(tmp_path / "files.db"), "--workers", "2"],
+                               cwd=str(tmp_path), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                pytest.fail("the cluster did not start")
+            time.sleep(0.1)
+    yield port
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def wait_for(condition, seconds=5):
+    deadline = time.monotonic() + seconds
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+@needs_cluster
+def test_round_trip(tmp_path, cluster, connect):
+    notes = []
+    alice = connect(cluster, "alice", on_notify=notes.append)
+    data = random_file(tmp_path / "a.bin", 3 << 20)
+    assert alice.upload(str(tmp_path / "a.bin")) == "Upload successful."
+
+    #the kernel spreads these connections over both workers, each sees alice's file and reaches her
+    for i in range(6):
+        reader = connect(cluster, f"bob{i}")
+        with open(reader.download("alice", "a.bin", str(tmp_path / f"downloads{i}")), "rb") as f:
+            assert f.read() == data
+    assert wait_for(lambda: len(notes) == 6)
+
+    #names are claimed through the coordinator, whichever worker takes the connection
+    for _ in range(6):
+        with pytest.raises(FileClientError, match="Name already in use"):
+            FileClient("127.0.0.1", cluster, "alice").connect()
+
+    assert alice.delete("a.bin") == "Delete successful."
+    readers = [connect(cluster, f"carol{i}") for i in range(4)]
+    assert wait_for(lambda: all(reader.list_files() == [] for reader in readers))
+
+
+def locked(*args, **kwargs):#what a catalog write raises when another worker held the lock past BUSY_TIMEOUT
+    raise sqlite3.OperationalError("database is locked")
+
+
+def test_busy_delete_changes_nothing(storage, server, connect, monkeypatch):
+    (storage / "alice_w.bin").write_bytes(b"stored whole")
+    server.files.add("alice_w.bin", "alice", "w.bin", 12)
+    client = connect(server.port, "alice", retries=0)
+
+    monkeypatch.setattr(server.files, "remove", locked)
+    with pytest.raises(ServerBusy):
+        client.delete("w.bin")
+    assert (storage / "alice_w.bin").exists()#the record still points at it, a retry can succeed
+    assert server.files.content("alice_w.bin") is not None
+
+    monkeypatch.undo()
+    assert client.delete("w.bin") == "Delete successful."
+    assert not (storage / "alice_w.bin").exists()
+    assert server.files.content("alice_w.bin") is None
+
+
+def test_busy_collection_after_upload_is_deferred(tmp_path, storage, server, connect, monkeypatch):
+    client = connect(server.port, "alice", retries=0)
+    random_file(tmp_path / "f.bin", 1000)
+    assert client.upload(str(tmp_path / "f.bin")) == "Upload successful."
+
+    monkeypatch.setattr(server.files, "garbage_chunks", locked)
+    data = random_file(tmp_path / "f.bin", 1000)#the new version is committed before the old one is collected
+    assert client.upload(str(tmp_path / "f.bin")) == "Upload successful."
+    assert server.garbage_deferred
+    assert any("Garbage collection deferred" in line for line in server.log)
+    with open(client.download("alice", "f.bin", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == data
+
+    monkeypatch.undo()
+    assert client.delete("f.bin") == "Delete successful."#the next collection takes both versions
+    assert [name for _, _, names in os.walk(storage / ".chunks") for name in names] == []
@@ -0,0 +1,87 @@
+"""Compression (compression.py): codecs, the streaming decoder, and compressed transfers through the server."""
+import os
+
+import pytest
+
+import compression
+from compression import DecodingWriter
+
+TEXT = b"".join(b"line %d of a log file that compresses well\n" % i for i in range(20000))
+
+
+class Sink:#file-like target collecting what is written
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+@pytest.mark.parametrize("codec", list(compression.CODECS))
+def test_round_trip(codec):
+    encoded = compression.encode(codec, TEXT)
+    assert encoded is not None and len(encoded) < len(TEXT) * compression.MAX_RATIO
+    assert compression.decode(codec, encoded, len(TEXT)) == TEXT
+
+
+def test_incompressible_data_is_sent_raw():
+    assert compression.encode("zlib", os.urandom(1 << 16)) is None#entropy close to 8 bits per byte
+    assert compression.encode("zlib", b"a" * (compression.MIN_SIZE - 1)) is None#too small to bother
+
+
+def test_pick():
+    assert compression.pick(["zlib", "lzma"], ["lzma", "zlib"]) == "zlib"#the server's preference wins
+    assert compression.pick(["zlib", "lzma"], ["lzma"]) == "lzma"
+    assert compression.pick(["zlib"], None) is None
+    assert compression.pick(["zlib"], ["zlib"], "photo.JPG") is None#already compressed
+
+
+@pytest.mark.parametrize("codec", list(compression.CODECS))
+def test_decoding_writer_in_pieces(codec):
+    encoded = compression.encode(codec, TEXT)
+    target, copy = Sink(), Sink()
+    writer = DecodingWriter(codec, target, len(TEXT), copy)
+    for start in range(0, len(encoded), 1000):
+        assert writer.write(memoryview(encoded)[start:start + 1000]) == len(encoded[start:start + 1000])
+    writer.finish()
+    assert writer.error is None
+    assert bytes(target.data) == TEXT and writer.written == len(TEXT)
+    assert bytes(copy.data) == encoded#kept as it arrived
+
+
+def test_decoding_writer_errors():
+    encoded = compression.encode("zlib", TEXT)
+
+    writer = DecodingWriter("zlib", Sink(), len(TEXT) - 1)
+    writer.write(encoded)
+    assert writer.error == "Compressed data expands past the expected size"
+    with pytest.raises(ValueError, match="expands past"):
+        compression.decode("zlib", encoded, 100)
+
+    writer = DecodingWriter("zlib", Sink())
+    writer.write(encoded[:len(encoded) // 2])
+    writer.finish()
+    assert writer.error == "Compressed data is truncated"
+
+    writer = DecodingWriter("zlib", Sink())
+    writer.write(b"not zlib at all")
+    writer.write(encoded)#the rest of the body is still consumed
+    assert writer.error.startswith("Bad compressed data")
+
+
+def test_compressed_upload_and_download(tmp_path, storage, server, connect):
+    client = connect(server.port, "alice")
+    assert client.compression == list(compression.CODECS)
+    (tmp_path / "log.txt").write_bytes(TEXT)
+    assert client.upload(str(tmp_path / "log.txt")) == "Upload successful."
+
+    digest, = server.files.content("alice_log.txt")[2]#one chunk, its compressed form kept as it arrived
+    assert os.path.exists(server.chunk_store.encoded_path(digest, client.compression[0]))
+    with open(server.chunk_store.path(digest), "rb") as f:
+        assert f.read() == TEXT#stored decoded
+
+    reader = connect(server.port, "bob")
+    with open(reader.download("alice", "log.txt", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == TEXT
+    assert server.metrics.snapshot()["bytes_out"] < len(TEXT) // 2#sent compressed
@@ -0,0 +1,91 @@
+"""Many connections at once: a client name is claimed atomically, and a download keeps the chunks it reads."""
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import protocol
+import transfer
+from conftest import random_file
+from fileclient import FileClient, FileClientError
+
+
+def chunk_files(storage):
+    return sorted(name for _, _, names in os.walk(storage / ".chunks") for name in names)
+
+
+def test_duplicate_name_is_claimed_once(server):
+    attempts = 16
+    barrier = threading.Barrier(attempts)
+    results = []
+
+    def claim():
+        client = FileClient("127.0.0.1", server.port, "alice")
+        barrier.wait()
+        try:
+            client.connect()
+            results.append(client)
+        except FileClientError as e:
+            results.append(str(e))
+
+    threads = [threading.Thread(target=claim) for _ in range(attempts)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    accepted = [result for result in results if isinstance(result, FileClient)]
+    assert len(accepted) == 1
+    assert results.count("Name already in use") == attempts - 1
+
+    #the name is free again once its connection is gone
+    accepted[0].close()
+    deadline = time.monotonic() + 5
+    while True:
+        client = FileClient("127.0.0.1", server.port, "alice")
+        try:
+            client.connect()
+            client.close()
+            break
+        except FileClientError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def test_download_keeps_chunks_of_a_deleted_file(tmp_path, storage, server, connect):
+    owner = connect(server.port, "owner")
+    data = random_file(tmp_path / "big.bin", 2 * transfer.TRANSFER_CHUNK_SIZE + 12345)
+    owner.upload(str(tmp_path / "big.bin"))
+    stored = chunk_files(storage)
+    assert len(stored) == 3
+
+    #a reader that takes the body slowly: the server is still sending when the file is deleted
+    sock = socket.create_connection(("127.0.0.1", server.port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 << 10)
+    sock.sendall(protocol.PREFACE)
+    protocol.recv_exact(sock, len(protocol.PREFACE))
+    protocol.send_frame(sock, protocol.HELLO, 1, {"name": "reader"})
+    assert protocol.recv_frame(sock).type == protocol.OK
+    protocol.send_frame(sock, protocol.DOWNLOAD, 2, {"owner": "owner", "filename": "big.bin"})
+    reply = protocol.recv_frame(sock)
+    assert reply.type == protocol.OK and reply.body_len == len(data)
+    head = bytes(protocol.recv_exact(sock, 1 << 20))
+
+    assert owner.delete("big.bin") == "Delete successful."
+    assert server.pinned_chunks
+    assert chunk_files(storage) == stored#pinned, not collected yet
+
+    body = head + bytes(protocol.recv_exact(sock, len(data) - len(head)))
+    assert body == data
+    sock.close()
+
+    #the download is over, a collection deferred for it removes the chunks
+    deadline = time.monotonic() + 5
+    while chunk_files(storage) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert chunk_files(storage) == []
+    assert not server.pinned_chunks
+    with pytest.raises(FileClientError):
+        owner.download("owner", "big.bin", str(tmp_path / "downloads"))
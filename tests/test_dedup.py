@@ -0,0 +1,55 @@
+"""Content-addressed storage: chunk hashes go first, chunks the server stores (from anyone) are not sent again."""
+import os
+
+import pytest
+
+import transfer
+from conftest import random_file
+
+
+def chunk_files(storage):#chunk files in the store, compressed copies included
+    return sorted(name for _, _, names in os.walk(storage / ".chunks") for name in names)
+
+
+@pytest.mark.parametrize("size", [transfer.DEDUP_MIN_SIZE, 2 * transfer.TRANSFER_CHUNK_SIZE + 100])
+def test_unchanged_file_is_not_sent_again(tmp_path, server, connect, size):
+    client = connect(server.port, "alice", compression_codecs=())
+    random_file(tmp_path / "f.bin", size)
+    assert client.upload(str(tmp_path / "f.bin")) == "Upload successful."
+
+    received = server.metrics.bytes_in
+    assert client.upload(str(tmp_path / "f.bin")) == "Upload successful."
+    assert server.metrics.bytes_in - received < 4096#hashes and headers only
+    chunks = -(-size // transfer.TRANSFER_CHUNK_SIZE)
+    assert f"{chunks} of {chunks} chunks of 'f.bin' are already stored on the server, skipping them." in client.log
+
+
+def test_small_file_is_sent_whole(tmp_path, server, connect):
+    client = connect(server.port, "alice", compression_codecs=())
+    random_file(tmp_path / "f.bin", transfer.DEDUP_MIN_SIZE - 1)
+    client.upload(str(tmp_path / "f.bin"))
+    received = server.metrics.bytes_in
+    client.upload(str(tmp_path / "f.bin"))
+    assert server.metrics.bytes_in - received >= transfer.DEDUP_MIN_SIZE - 1
+
+
+def test_same_content_from_two_users_is_stored_once(tmp_path, storage, server, connect):
+    alice = connect(server.port, "alice", compression_codecs=())
+    bob = connect(server.port, "bob", compression_codecs=())
+    data = random_file(tmp_path / "dataset.bin", transfer.TRANSFER_CHUNK_SIZE + 1000)
+    alice.upload(str(tmp_path / "dataset.bin"))
+    stored = chunk_files(storage)
+    assert len(stored) == 2
+
+    received = server.metrics.bytes_in
+    assert bob.upload(str(tmp_path / "dataset.bin"), "copy.bin") == "Upload successful."
+    assert server.metrics.bytes_in - received < 4096
+    assert chunk_files(storage) == stored
+    assert server.files.content("alice_dataset.bin")[2] == server.files.content("bob_copy.bin")[2]
+
+    assert alice.delete("dataset.bin") == "Delete successful."#bob's file keeps the chunks
+    assert chunk_files(storage) == stored
+    with open(bob.download("bob", "copy.bin", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == data
+    assert bob.delete("copy.bin") == "Delete successful."#the last reference is gone, so are the chunks
+    assert chunk_files(storage) == []
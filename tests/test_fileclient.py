@@ -0,0 +1,133 @@
+"""The client library (fileclient.py): pooled connections, reconnects, the *_many calls, AsyncFileClient and the CLI."""
+import asyncio
+import os
+import threading
+
+import transfer
+from conftest import random_file
+from fileclient import AsyncFileClient, main
+
+
+def test_calls_reuse_pooled_connections(tmp_path, server, connect):
+    client = connect(server.port, "alice")
+    random_file(tmp_path / "a.bin", 1000)
+    client.upload(str(tmp_path / "a.bin"))
+    sock, = client.pool.idle
+    client.list_files()
+    client.download("alice", "a.bin", str(tmp_path / "downloads"))
+    assert client.pool.idle == [sock]#one call after another, all on the same data connection
+
+    barrier = threading.Barrier(3)
+
+    def call(work):
+        def hold(sock):
+            barrier.wait(5)#every call has its connection before any returns one
+            return work(sock)
+        client.with_connection(hold)
+    threads = [threading.Thread(target=call, args=(client.refresh_file_list,)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(client.pool.idle) == 3 and sock in client.pool.idle
+
+
+def test_broken_connection_is_replaced(tmp_path, server, connect):
+    client = connect(server.port, "alice")
+    assert client.list_files() == []
+    sock, = client.pool.idle
+    sock.close()#as if the network dropped it while it sat in the pool
+    random_file(tmp_path / "a.bin", 1000)
+    assert client.upload(str(tmp_path / "a.bin")) == "Upload successful."
+    assert any(line.startswith("Connection problem") for line in client.log)
+    assert sock not in client.pool.idle
+
+
+def test_reconnect_after_a_server_restart(tmp_path, start_server, connect):
+    server = start_server()
+    client = connect(server.port, "alice")
+    data = random_file(tmp_path / "a.bin", 1000)
+    client.upload(str(tmp_path / "a.bin"))
+    token = client.session_token
+
+    server.stop()
+    start_server(port=server.port)#same storage and catalog, the old session is gone
+    assert client.list_files() == [("alice", "a.bin", 1000)]
+    assert "Session lost, reconnecting." in client.log
+    assert client.connected and client.session_token != token
+    with open(client.download("alice", "a.bin", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == data
+
+
+def test_many_calls_report_every_item(tmp_path, server, connect):
+    client = connect(server.port, "alice", compression_codecs=())
+    folder = tmp_path / "photos"
+    (folder / "2024").mkdir(parents=True)
+    files = {"photos/a.jpg": random_file(folder / "a.jpg", 500),
+             "photos/2024/b.jpg": random_file(folder / "2024" / "b.jpg", 700),
+             "photos/big.raw": random_file(folder / "big.raw", transfer.TRANSFER_CHUNK_SIZE + 10)}#alone, hash first
+    random_file(tmp_path / "c.txt", 10)
+    results = client.upload_many([str(folder), (str(tmp_path / "c.txt"), "renamed.txt"), str(tmp_path / "gone.txt")])
+    assert [result.item[1] for result in results] == ["photos/a.jpg", "photos/big.raw", "photos/2024/b.jpg",
+                                                      "renamed.txt", "gone.txt"]#a folder's own files, then its subfolders
+    assert [result.ok for result in results] == [True, True, True, True, False]
+
+    results = client.download_many([("alice", "photos/"), ("alice", "missing.txt"), ("bob", "renamed.txt")],
+                                   str(tmp_path / "downloads"))
+    assert [result.item for result in results] == [("alice", name) for name in sorted(files)] + [
+        ("alice", "missing.txt"), ("bob", "renamed.txt")]
+    assert [result.ok for result in results] == [True, True, True, False, False]
+    assert results[-1].message == "File not found."
+    for name, data in files.items():
+        assert (tmp_path / "downloads" / name).read_bytes() == data
+    assert not os.path.exists(tmp_path / "downloads" / "missing.txt.part")
+
+    results = client.delete_many(["renamed.txt", "renamed.txt", "photos/a.jpg"])
+    assert [(result.ok, result.message) for result in results] == [
+        (True, "Delete successful."), (False, "File not found."), (True, "Delete successful.")]
+    assert [filename for _, filename, _ in client.list_files()] == ["photos/2024/b.jpg", "photos/big.raw"]
+
+
+def test_async_client(tmp_path, server):
+    paths = [tmp_path / f"f{i}.bin" for i in range(4)]
+    data = [random_file(path, 1000 * (i + 1)) for i, path in enumerate(paths)]
+
+    async def run():
+        async with AsyncFileClient("127.0.0.1", server.port, "alice") as client:
+            replies = await asyncio.gather(*(client.upload(str(path)) for path in paths))
+            assert replies == ["Upload successful."] * 4
+            assert await client.list_files(prefix="f") == [("alice", path.name, len(d)) for path, d in zip(paths, data)]
+            downloaded = await client.download("alice", "f2.bin", str(tmp_path / "downloads"))
+            results = await client.download_many([("alice", "f0.bin"), ("alice", "nope")], str(tmp_path / "more"))
+            deleted = await client.delete_many(["f0.bin", "f1.bin"])
+            return downloaded, results, deleted, await client.list_files()
+    downloaded, results, deleted, listing = asyncio.run(run())
+    with open(downloaded, "rb") as f:
+        assert f.read() == data[2]
+    assert [result.ok for result in results] == [True, False]
+    assert all(result.ok for result in deleted)
+    assert [filename for _, filename, _ in listing] == ["f2.bin", "f3.bin"]
+
+
+def test_command_line(tmp_path, server, capsys):
+    random_file(tmp_path / "a.bin", 100)
+    args = ["127.0.0.1", str(server.port), "alice"]
+    assert main(args + ["upload", str(tmp_path / "a.bin")]) == 0
+    assert f"('{tmp_path / 'a.bin'}', 'a.bin'): Upload successful." in capsys.readouterr().out
+
+    assert main(args + ["list", "--checksums"]) == 0
+    filename, owner, size, checksum = capsys.readouterr().out.strip().split("\t")
+    assert (filename, owner, size) == ("a.bin", "alice", "100") and len(checksum) == 64
+
+    assert main(args + ["-q", "download", "alice", "a.bin", "missing.bin", "-o", str(tmp_path / "out")]) == 1
+    out, err = capsys.readouterr()
+    assert out == "" and err == "Error: ('alice', 'missing.bin'): File not found.\n"
+    assert (tmp_path / "out" / "a.bin").read_bytes() == (tmp_path / "a.bin").read_bytes()
+
+    assert main(args + ["-q", "delete", "a.bin"]) == 0
+    assert main(args + ["list"]) == 0
+    assert capsys.readouterr().out == ""
+
+    server.stop()
+    assert main(args + ["list"]) == 1#nothing listens any more
+    assert capsys.readouterr().err.startswith("Error: ")
@@ -0,0 +1,99 @@
+"""Hot-file cache (hotcache.py): admission on the second request, LRU eviction with a second chance."""
+import os
+
+import pytest
+
+from hotcache import HotFileCache
+
+pytestmark = pytest.mark.skipif(os.name == "nt", reason="the cache is off on Windows")
+
+
+@pytest.fixture
+def files(tmp_path):#name -> path of a 100 byte file
+    paths = {}
+    for name in "abcde":
+        paths[name] = str(tmp_path / name)
+        with open(paths[name], "wb") as f:
+            f.write(name.encode() * 100)
+    return paths
+
+
+def warm(cache, path):#the two requests that admit a file
+    assert cache.get(path, 100) is None
+    view = cache.get(path, 100)
+    assert view is not None
+    return view
+
+
+def test_admitted_on_the_second_request(files):
+    cache = HotFileCache(1000)
+    assert cache.get(files["a"], 100) is None#only remembered
+    assert cache.entries == {} and cache.misses == 1
+    view = cache.get(files["a"], 100)
+    assert bytes(view) == b"a" * 100 and cache.size == 100
+    assert cache.get(files["a"], 100) is view
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_too_large_or_empty_files_are_not_cached(tmp_path, files):
+    cache = HotFileCache(1000, max_file=50)
+    for _ in range(3):
+        assert cache.get(files["a"], 100) is None
+    assert cache.misses == 0#never a candidate, so not a miss either
+
+    empty = str(tmp_path / "empty")
+    open(empty, "wb").close()
+    cache = HotFileCache(1000)
+    assert cache.get(empty, 0) is None and cache.get(empty, 0) is None
+    assert cache.entries == {}
+
+
+def test_least_recently_used_is_evicted(files):
+    cache = HotFileCache(300)
+    for name in "abc":
+        warm(cache, files[name])
+    cache.get(files["a"], 100)#a is used again, b is now the oldest
+    warm(cache, files["d"])
+    assert list(cache.entries) == [files["c"], files["a"], files["d"]]
+    assert (cache.size, cache.evictions) == (300, 1)
+
+
+def test_second_chance_for_files_hit_more_than_once(files):
+    cache = HotFileCache(300)
+    view = warm(cache, files["a"])
+    cache.get(files["a"], 100)
+    cache.get(files["a"], 100)#two hits
+    warm(cache, files["b"])
+    warm(cache, files["c"])
+    warm(cache, files["d"])#a is the oldest, but gets its count halved and goes to the back instead
+    assert files["a"] in cache.entries and files["b"] not in cache.entries
+    assert cache.entries[files["a"]].hits == 1
+    warm(cache, files["e"])#c, the oldest now
+    warm(cache, files["b"])#a has a single hit left: evicted this time
+    assert files["a"] not in cache.entries
+    assert bytes(view) == b"a" * 100#a download still writing from the mapping keeps it
+
+
+def test_invalidate(files):
+    cache = HotFileCache(1000)
+    warm(cache, files["a"])
+    cache.get(files["b"], 100)
+    cache.invalidate(files["a"])
+    cache.invalidate(files["b"])#its first request is forgotten too
+    assert cache.entries == {} and cache.size == 0
+    assert cache.get(files["b"], 100) is None
+
+
+def test_downloads_served_from_the_cache(tmp_path, server, connect):
+    data = os.urandom(64 << 10)
+    (tmp_path / "hot.bin").write_bytes(data)
+    owner = connect(server.port, "alice", compression_codecs=())
+    owner.upload(str(tmp_path / "hot.bin"))
+    reader = connect(server.port, "bob", compression_codecs=())
+    for i in range(3):
+        with open(reader.download("alice", "hot.bin", str(tmp_path / f"downloads{i}")), "rb") as f:
+            assert f.read() == data
+    assert server.hot_files.hits >= 1 and len(server.hot_files.entries) == 1
+
+    assert owner.delete("hot.bin") == "Delete successful."#its chunk is collected, and dropped from the cache
+    assert server.hot_files.entries == {}
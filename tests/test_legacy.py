@@ -0,0 +1,108 @@
+"""The original '|' text protocol over a raw socket, as ServerApp's first clients speak it."""
+import os
+import socket
+import time
+
+import pytest
+
+
+class LegacyClient:
+    """One recv(1024) per reply, like the baseline client; a pause keeps a command apart from its body."""
+
+    def __init__(self, port, name):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.settimeout(10)
+        self.send(name)
+        assert self.receive() == "Connected successfully."
+
+    def send(self, text):
+        self.sock.sendall(text.encode() if isinstance(text, str) else text)
+        time.sleep(0.05)#the server reads a command with one read(1024), it must not take the body along
+
+    def receive(self, count=1024):
+        return self.sock.recv(count).decode()
+
+    def command(self, text):
+        self.send(text)
+        return self.receive()
+
+    def receive_exact(self, count):
+        data = b""
+        while len(data) < count:
+            more = self.sock.recv(count - len(data))
+            assert more
+            data += more
+        return data
+
+    def upload(self, filename, data):
+        self.send(f"UPLOAD|{filename}|{len(data)}")
+        self.send(data)
+        return self.receive()
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def legacy(server):
+    clients = []
+
+    def connect(name):
+        client = LegacyClient(server.port, name)
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        client.close()
+
+
+@pytest.mark.parametrize("header", ["UPLOAD|a.txt", "UPLOAD|a.txt|-5", "UPLOAD|a.txt|5x", "UPLOAD|a.txt|"])
+def test_upload_without_a_valid_size_is_refused(server, legacy, header):
+    alice = legacy("alice")
+    assert alice.upload("a.txt", b"hello") == "Upload successful."
+    assert alice.command(header) == "Error: Invalid file size."
+    assert server.files.content("alice_a.txt")[0] == 5#the stored file is untouched
+
+
+def payload(client, command):#"COMMAND|size", READY, then the body
+    header = client.command(command)
+    name, size = header.split("|")
+    assert name == command.split("|")[0]
+    client.send("READY")
+    return client.receive_exact(int(size))
+
+
+def test_upload_list_download_delete(tmp_path, server, legacy, connect):
+    alice = legacy("alice")
+    data = os.urandom(300000)
+    assert alice.upload("a.bin", data) == "Upload successful."
+    assert alice.upload("notes.txt", b"hello") == "Upload successful."
+    assert payload(alice, "LIST").decode().splitlines() == ["a.bin (Owner: alice)", "notes.txt (Owner: alice)"]
+
+    assert payload(alice, "DOWNLOAD|alice|a.bin") == data
+    #the owner's notice comes after the body on the same connection, never inside it
+    assert alice.receive() == "NOTIFY|alice downloaded your file a.bin."
+
+    framed = connect(server.port, "bob")#both protocols see the same files
+    assert framed.list_files() == [("alice", "a.bin", 300000), ("alice", "notes.txt", 5)]
+
+    assert alice.command("DELETE|a.bin") == "Delete successful."
+    assert alice.command("DELETE|a.bin") == "Error: File not found."
+    assert payload(alice, "LIST") == b"notes.txt (Owner: alice)"
+
+
+def test_download_notifies_the_owner(server, legacy):
+    alice, bob = legacy("alice"), legacy("bob")
+    assert alice.upload("a.txt", b"shared") == "Upload successful."
+    assert payload(bob, "DOWNLOAD|alice|a.txt") == b"shared"
+    assert alice.receive() == "NOTIFY|bob downloaded your file a.txt."
+    assert bob.command("DOWNLOAD|alice|missing.txt") == "Error: File not found."
+    assert bob.command("DELETE|a.txt") == "Error: File not found."#only alice's files are hers to delete
+
+
+def test_empty_listing_and_unknown_command(server, legacy):
+    carol = legacy("carol")
+    assert payload(carol, "LIST") == b""
+    assert carol.command("RENAME|a|b").startswith("Error: ")
+    assert payload(carol, "LIST") == b""#still in step
@@ -0,0 +1,120 @@
+"""LIST: filtered pages with a cursor, and deltas since a catalog version with a full snapshot when needed."""
+import pytest
+
+import protocol
+from catalog import Catalog
+from conftest import random_file
+from reconcile import Reconciler
+
+
+def list_request(client, meta):#one LIST on a pooled connection, returns (reply meta, body lines)
+    def work(sock):
+        request_id = client.send_request(sock, protocol.LIST, meta)
+        reply = client.wait_response(sock, request_id)
+        body = bytes(protocol.recv_exact(sock, reply.body_len)).decode() if reply.type == protocol.OK else ""
+        return reply, body.splitlines()
+    return client.with_connection(work)
+
+
+@pytest.fixture
+def stored(tmp_path, server, connect):#alice and bob each upload a few files, returns alice's client
+    clients = {name: connect(server.port, name) for name in ("alice", "bob")}
+    for owner, filename in [("alice", "a1.txt"), ("bob", "b1.txt"), ("alice", "a2.txt"),
+                            ("alice", "notes.md"), ("bob", "a3.txt")]:
+        random_file(tmp_path / filename, 100)
+        clients[owner].upload(str(tmp_path / filename))
+    return clients["alice"]
+
+
+def test_pages_follow_the_cursor(stored):
+    lines, cursor, pages = [], None, 0
+    while True:
+        reply, body = list_request(stored, {"limit": 2, "cursor": cursor})
+        assert reply.type == protocol.OK and reply.meta["count"] == len(body)
+        lines += body
+        pages += 1
+        cursor = reply.meta["next_cursor"]
+        if cursor is None:
+            break
+    assert lines == ["a1.txt (Owner: alice)", "b1.txt (Owner: bob)", "a2.txt (Owner: alice)",
+                     "notes.md (Owner: alice)", "a3.txt (Owner: bob)"]
+    assert pages == 3
+
+
+def test_full_last_page_ends_with_an_empty_one(stored):
+    reply, body = list_request(stored, {"limit": 5})
+    assert len(body) == 5 and reply.meta["next_cursor"] is not None
+    reply, body = list_request(stored, {"limit": 5, "cursor": reply.meta["next_cursor"]})
+    assert reply.type == protocol.OK
+    assert body == [] and reply.meta["count"] == 0 and reply.meta["next_cursor"] is None
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_limit_below_one_is_refused(server, stored, limit):
+    reply, _ = list_request(stored, {"limit": limit})
+    assert reply.type == protocol.ERROR
+    assert reply.meta["message"] == "Page limit must be at least 1."
+    assert list_request(stored, {"limit": 1})[0].type == protocol.OK#the connection is still usable
+
+
+def test_owner_and_prefix_filters(stored):
+    assert list_request(stored, {"owner": "bob"})[1] == ["b1.txt (Owner: bob)", "a3.txt (Owner: bob)"]
+    assert list_request(stored, {"prefix": "a"})[1] == ["a1.txt (Owner: alice)", "a2.txt (Owner: alice)",
+                                                         "a3.txt (Owner: bob)"]
+    assert list_request(stored, {"owner": "alice", "prefix": "a"})[1] == ["a1.txt (Owner: alice)",
+                                                                           "a2.txt (Owner: alice)"]
+    assert list_request(stored, {"owner": "carol"})[1] == []
+
+
+def test_delta_since_a_version(stored):
+    reply, body = list_request(stored, {"since": 0})
+    assert reply.meta["reset"] and len(body) == 5
+    version = reply.meta["version"]
+
+    reply, body = list_request(stored, {"since": version})#nothing changed
+    assert (reply.meta["reset"], reply.meta["version"], body) == (False, version, [])
+
+    assert stored.delete("a1.txt") == "Delete successful."
+    reply, body = list_request(stored, {"since": version})
+    assert (reply.meta["reset"], reply.meta["version"]) == (False, version + 1)
+    assert body == ["-\talice\ta1.txt\t0"]
+
+    reply, body = list_request(stored, {"since": version + 100})#a version this catalog never had
+    assert reply.meta["reset"] and len(body) == 4 and all(line.startswith("+\t") for line in body)
+
+
+def test_records_older_than_the_change_log_get_a_snapshot(tmp_path, storage, start_server, connect):
+    catalog = Catalog(str(tmp_path / "files.db"))#a record without a change log entry, as after a migration
+    catalog.db.execute("INSERT INTO files (unique_name, owner, filename, size) VALUES ('old_a.bin', 'old', 'a.bin', 7)")
+    catalog.close()
+    (storage / "old_a.bin").write_bytes(b"content")
+
+    server = start_server()
+    client = connect(server.port, "alice")
+    reply, body = list_request(client, {"since": 0})
+    assert (reply.meta["reset"], reply.meta["version"]) == (True, 0)
+    assert body == ["+\told\ta.bin\t7"]
+    assert client.list_files() == [("old", "a.bin", 7)]
+
+
+def test_new_sizes_and_checksums_reach_listing_clients(tmp_path, storage, start_server, connect):
+    """A file stored whole that changed behind the server's back gets its new size from the reconciler,
+    and its checksum from the first download; both reach a client that only asks for deltas."""
+    catalog = Catalog(str(tmp_path / "files.db"))
+    catalog.add("old_a.bin", "old", "a.bin", 7)
+    catalog.close()
+    (storage / "old_a.bin").write_bytes(b"content")
+    server = start_server()
+    server.reconciler.thread.join()
+    client = connect(server.port, "alice")
+    assert client.list_files(checksums=True) == [("old", "a.bin", 7, None)]
+
+    (storage / "old_a.bin").write_bytes(b"changed content")
+    Reconciler(str(storage), server.files, server.chunk_store, log=lambda message: None).run()
+    assert client.list_files(checksums=True) == [("old", "a.bin", 15, None)]
+
+    client.download("old", "a.bin", str(tmp_path / "downloads"))
+    checksum = server.files.content("old_a.bin")[3]
+    assert checksum is not None
+    assert client.list_files(checksums=True) == [("old", "a.bin", 15, checksum)]
+    assert list_request(client, {})[1] == ["a.bin (Owner: old)"]#the cached full listing follows too
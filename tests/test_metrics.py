@@ -0,0 +1,96 @@
+"""Instrumentation (metrics.py): histogram quantiles, the Prometheus text, and the HTTP endpoint of a server."""
+import urllib.error
+import urllib.request
+
+import pytest
+
+from conftest import free_port
+from metrics import LATENCY_BUCKETS, Histogram, Metrics, escape_label
+
+
+def test_quantile_interpolates_inside_a_bucket():
+    histogram = Histogram()
+    assert histogram.quantile(0.5) is None
+    for _ in range(90):
+        histogram.observe(0.0004)#first bucket, from 0 to 0.5 ms
+    for _ in range(10):
+        histogram.observe(0.2)#(0.1, 0.25]
+    assert histogram.count == 100 and histogram.sum == pytest.approx(90 * 0.0004 + 10 * 0.2)
+    assert histogram.quantile(0.5) == pytest.approx(0.0005 * 50 / 90)
+    assert histogram.quantile(0.99) == pytest.approx(0.1 + 0.15 * 9 / 10)
+    assert histogram.quantile(1.0) == pytest.approx(0.25)
+
+
+def test_quantile_past_the_last_bucket():
+    histogram = Histogram()
+    histogram.observe(LATENCY_BUCKETS[-1] * 2)
+    assert histogram.counts[-1] == 1
+    assert histogram.quantile(0.5) == LATENCY_BUCKETS[-1]#the +Inf bucket has no upper bound to interpolate to
+
+
+def test_copy_is_independent():
+    histogram = Histogram()
+    histogram.observe(0.01)
+    copy = histogram.copy()
+    histogram.observe(0.01)
+    assert (copy.count, sum(copy.counts)) == (1, 1)
+
+
+def test_render():
+    metrics = Metrics()
+    metrics.observe("UPLOAD", True, 0.001)#on a bucket bound: counted in that bucket, as le says
+    metrics.observe("UPLOAD", False, 0.3)
+    metrics.observe("LIST", True, 0.002)
+    metrics.bytes_in = 1234
+    with metrics.transfer("download"):
+        metrics.add_gauge("clients", "Connected clients.", lambda: 3)
+        metrics.add_gauge("evictions_total", "Evicted.", lambda: 7, "counter")
+        lines = metrics.render().splitlines()
+    assert metrics.transfers["download"] == 0
+
+    assert 'fileserver_requests_total{command="UPLOAD",outcome="ok"} 1' in lines
+    assert 'fileserver_requests_total{command="UPLOAD",outcome="error"} 1' in lines
+    assert 'fileserver_request_duration_seconds_bucket{command="UPLOAD",le="0.0005"} 0' in lines
+    assert 'fileserver_request_duration_seconds_bucket{command="UPLOAD",le="0.001"} 1' in lines
+    assert 'fileserver_request_duration_seconds_bucket{command="UPLOAD",le="0.25"} 1' in lines
+    assert 'fileserver_request_duration_seconds_bucket{command="UPLOAD",le="+Inf"} 2' in lines
+    assert 'fileserver_request_duration_seconds_count{command="LIST"} 1' in lines
+    assert "fileserver_received_bytes_total 1234" in lines
+    assert 'fileserver_transfers_in_flight{direction="download"} 1' in lines
+    assert "# TYPE fileserver_clients gauge" in lines and "fileserver_clients 3" in lines
+    assert "# TYPE fileserver_evictions_total counter" in lines
+    types = {line.split()[2] for line in lines if line.startswith("# TYPE ")}
+    for line in lines:#every sample belongs to a declared metric, histogram series to their histogram
+        if not line.startswith("#"):
+            name = line.split("{")[0].split()[0]
+            assert name in types or name.rsplit("_", 1)[0] in types
+
+
+def test_escape_label():
+    assert escape_label('a "b"\\c\nd') == 'a \\"b\\"\\\\c\\nd'
+
+
+def get(port, path):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=5) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+def test_endpoint(start_server, connect):
+    metrics_port = free_port()
+    server = start_server(metrics_port=metrics_port)
+    client = connect(server.port, "alice")
+    client.list_files()
+
+    status, body = get(metrics_port, "/metrics")
+    assert status == 200
+    assert 'fileserver_requests_total{command="LIST",outcome="ok"} 1' in body.splitlines()
+    assert "fileserver_clients 1" in body.splitlines()
+
+    assert get(metrics_port, "/profile/start") == (200, "Profiler started.\n")
+    client.list_files()
+    status, report = get(metrics_port, "/profile/stop")
+    assert status == 200 and "samples over" in report and "Own time:" in report
+    assert get(metrics_port, "/nothing")[0] == 404
@@ -0,0 +1,49 @@
+"""Framed protocol negotiation: the preface, HELLO and requests may all arrive in one write."""
+import socket
+
+import protocol
+
+
+def test_preface_hello_and_request_in_one_write(server):
+    sock = socket.create_connection(("127.0.0.1", server.port))
+    try:
+        sock.sendall(protocol.PREFACE
+                     + protocol.encode_header(protocol.HELLO, 1, {"name": "alice"})
+                     + protocol.encode_header(protocol.LIST, 2, {}))
+        assert protocol.parse_preface(protocol.recv_exact(sock, len(protocol.PREFACE))) == protocol.VERSION
+        hello = protocol.recv_frame(sock)
+        assert (hello.type, hello.request_id) == (protocol.OK, 1)
+        assert hello.meta["message"] == "Connected successfully."
+        listing = protocol.recv_frame(sock)
+        assert (listing.type, listing.request_id, listing.body_len) == (protocol.OK, 2, 0)
+    finally:
+        sock.close()
+    assert not any("Bad protocol preface" in line for line in server.log)
+
+
+def test_preface_in_pieces(server):
+    sock = socket.create_connection(("127.0.0.1", server.port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        sock.sendall(protocol.PREFACE[:2])
+        sock.sendall(protocol.PREFACE[2:] + protocol.encode_header(protocol.HELLO, 7, {"name": "bob"}))
+        protocol.recv_exact(sock, len(protocol.PREFACE))
+        assert protocol.recv_frame(sock)[:3] == (protocol.OK, 0, 7)
+    finally:
+        sock.close()
+
+
+def test_older_version_is_refused(server):
+    sock = socket.create_connection(("127.0.0.1", server.port))
+    try:
+        sock.sendall(protocol.MAGIC + bytes([1]) + protocol.encode_header(protocol.HELLO, 1, {"name": "carol"}))
+        assert protocol.recv_exact(sock, len(protocol.PREFACE)) == protocol.PREFACE
+        assert sock.recv(1) == b""#disconnected without a reply to the HELLO
+    finally:
+        sock.close()
+
+
+def test_client_handshake(server, connect):
+    client = connect(server.port, "dave")
+    assert client.session_token
+    assert client.list_files() == []
@@ -0,0 +1,152 @@
+"""Storage reconciliation (reconcile.py) against a catalog, run in the test thread."""
+import os
+import time
+import zlib
+
+import pytest
+
+import transfer
+from catalog import Catalog
+from chunkstore import ChunkStore
+from conftest import old_catalog
+from reconcile import DAMAGED_CHUNK, MISSING_CHUNK, ORPHAN_CHUNK, ORPHAN_FILE, Reconciler
+
+
+def age(path, seconds=60):#move the mtime back, out of the racy window
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_catalog_from_before_reconciliation(tmp_path, storage):
+    db = old_catalog(tmp_path / "files.db", 4)
+    db.execute("INSERT INTO files (unique_name, owner, filename, size) VALUES ('alice_a.txt', 'alice', 'a.txt', 3)")
+    db.execute("INSERT INTO files (unique_name, owner, filename, size) VALUES ('alice_gone.txt', 'alice', 'gone.txt', 3)")
+    db.commit()
+    db.close()
+    (storage / "alice_a.txt").write_bytes(b"abc")
+    age(storage / "alice_a.txt")
+
+    catalog = Catalog(str(tmp_path / "files.db"))
+    assert catalog.whole_file_fingerprints() == {"alice_a.txt": (3, None), "alice_gone.txt": (3, None)}
+    Reconciler(str(storage), catalog, ChunkStore(str(storage)), log=lambda message: None).run()
+
+    mtime_ns = os.stat(storage / "alice_a.txt").st_mtime_ns
+    assert catalog.whole_file_fingerprints() == {"alice_a.txt": (3, mtime_ns)}#saved for the next start
+    assert catalog.findings() == []
+    catalog.close()
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / "files.db"))
+    yield catalog
+    catalog.close()
+
+
+def store_file(catalog, store, unique_name, data):#one-chunk file in the chunk store, returns its chunk path
+    digest = transfer.chunk_hasher(data).hexdigest()
+    path = store.path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    owner, filename = unique_name.split("_", 1)
+    catalog.ref_chunks([(digest, len(data), zlib.crc32(data))])
+    catalog.add(unique_name, owner, filename, len(data), len(data), [zlib.crc32(data)], [digest])
+    return path
+
+
+def reconcile(storage, catalog):#one complete run, returns its stats
+    reconciler = Reconciler(str(storage), catalog, ChunkStore(str(storage)), log=lambda message: None)
+    reconciler.run()
+    return reconciler.stats
+
+
+def test_unchanged_directories_are_skipped(storage, catalog):
+    store = ChunkStore(str(storage))
+    chunk = store_file(catalog, store, "alice_a.bin", b"a" * 100)
+    fanout = os.path.dirname(chunk)
+    age(fanout)
+
+    stats = reconcile(storage, catalog)
+    assert (stats["scanned"], stats["unchanged"]) == (2, 0)#the storage directory and the one fan-out directory
+    relative = f".chunks/{os.path.basename(fanout)}"
+    assert catalog.scan_checkpoint(relative) == os.stat(fanout).st_mtime_ns
+    assert catalog.findings() == []
+
+    stats = reconcile(storage, catalog)#the next start reads only the storage directory
+    assert (stats["scanned"], stats["unchanged"]) == (1, 1)
+
+    #a file added behind the server's back changes the directory, it is listed again
+    with open(os.path.join(fanout, "f" * 64), "wb") as f:
+        f.write(b"orphan")
+    age(fanout, 30)
+    stats = reconcile(storage, catalog)
+    assert (stats["scanned"], stats["unchanged"]) == (2, 0)
+    assert catalog.findings() == [(f"{relative}/{'f' * 64}", ORPHAN_CHUNK, 6)]
+
+
+def test_recently_changed_directory_gets_no_checkpoint(storage, catalog):
+    chunk = store_file(catalog, ChunkStore(str(storage)), "alice_a.bin", b"a" * 100)
+    reconcile(storage, catalog)#written just now: it could change again within the same mtime
+    assert catalog.scan_checkpoint(f".chunks/{os.path.basename(os.path.dirname(chunk))}") is None
+    assert reconcile(storage, catalog)["unchanged"] == 0
+
+
+def test_missing_and_damaged_chunks(storage, catalog):
+    store = ChunkStore(str(storage))
+    missing = store_file(catalog, store, "alice_a.bin", b"a" * 100)
+    damaged = store_file(catalog, store, "bob_b.bin", b"b" * 100)
+    os.remove(missing)
+    with open(damaged, "ab") as f:
+        f.write(b"more")
+    (storage / "stray.txt").write_bytes(b"nobody's")
+
+    reconcile(storage, catalog)
+    findings = {kind: (os.path.basename(path), size) for path, kind, size in catalog.findings()}
+    assert findings == {MISSING_CHUNK: (os.path.basename(missing), 100), DAMAGED_CHUNK: (os.path.basename(damaged), 104),
+                        ORPHAN_FILE: ("stray.txt", 8)}
+    assert catalog.finding_counts() == {MISSING_CHUNK: 1, DAMAGED_CHUNK: 1, ORPHAN_FILE: 1}
+
+    os.remove(storage / "stray.txt")#findings last until their directory is scanned again
+    reconcile(storage, catalog)
+    assert ORPHAN_FILE not in catalog.finding_counts()
+
+
+def test_stopped_scan_continues_from_its_checkpoints(storage, catalog):
+    store = ChunkStore(str(storage))
+    fanouts = set()
+    for i in range(20):
+        fanouts.add(os.path.dirname(store_file(catalog, store, f"alice_{i}.bin", b"%d" % i * 50)))
+    for fanout in fanouts:
+        age(fanout)
+
+    reconciler = Reconciler(str(storage), catalog, store, log=lambda message: None)
+    reconciler.stop()#before the chunk store: nothing of it is checkpointed
+    reconciler.run()
+    assert all(catalog.scan_checkpoint(f".chunks/{os.path.basename(fanout)}") is None for fanout in fanouts)
+
+    stats = reconcile(storage, catalog)
+    assert (stats["scanned"], stats["unchanged"]) == (1 + len(fanouts), 0)
+    assert reconcile(storage, catalog)["unchanged"] == len(fanouts)
+
+
+def test_upload_during_the_scan_keeps_its_record(storage, catalog, monkeypatch):
+    """A client deletes a file stored whole and uploads it again, as chunks, while the scan runs."""
+    catalog.add("alice_a.txt", "alice", "a.txt", 3)#its file is already gone
+    listed = catalog.whole_file_fingerprints
+
+    def racing():
+        fingerprints = listed()
+        store_file(catalog, ChunkStore(str(storage)), "alice_a.txt", b"new data")
+        return fingerprints
+    monkeypatch.setattr(catalog, "whole_file_fingerprints", racing)
+    log = []
+    Reconciler(str(storage), catalog, ChunkStore(str(storage)), log=log.append).run()
+    assert catalog.content("alice_a.txt")[0] == len(b"new data")
+    assert not any("alice_a.txt not found" in line for line in log)
+
+    monkeypatch.undo()
+    catalog.add("alice_b.txt", "alice", "b.txt", 3)#no upload races this one, its record goes
+    version = catalog.version()
+    reconcile(storage, catalog)
+    assert "alice_b.txt" not in catalog and catalog.changes_since(version)[1] == [("-", "alice", "b.txt", 0, None)]
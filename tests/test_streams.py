@@ -0,0 +1,51 @@
+"""Large files over several connections at once, each carrying one run of chunks (transfer.split_chunks)."""
+import os
+
+import pytest
+
+import transfer
+from conftest import random_file
+
+CHUNK = transfer.TRANSFER_CHUNK_SIZE
+
+
+@pytest.mark.parametrize("size, download_streams", [(3 * CHUNK + 1000, 3), (2 * CHUNK, 2)])
+def test_parallel_upload_and_download(tmp_path, storage, server, connect, monkeypatch, size, download_streams):
+    monkeypatch.setattr(transfer, "STREAM_MIN_SIZE", CHUNK)#one connection per chunk, files this small get several
+    client = connect(server.port, "alice", compression_codecs=())
+    data = random_file(tmp_path / "big.bin", size)
+    chunks = -(-size // CHUNK)
+
+    assert client.upload(str(tmp_path / "big.bin")) == "Upload successful."
+    assert f"Uploading 'big.bin' over {chunks} connections." in client.log
+    manifest = server.files.content("alice_big.bin")[2]
+    assert manifest == transfer.file_chunk_hashes(str(tmp_path / "big.bin"), CHUNK)
+    assert sum(len(names) for _, _, names in os.walk(storage / ".chunks")) == chunks
+
+    client.list_files()#the size from the listing decides how many connections the download opens
+    with open(client.download("alice", "big.bin", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == data
+    assert f"Downloading 'big.bin' over {download_streams} connections." in client.log#every whole STREAM_MIN_SIZE
+    assert len(client.pool.idle) == chunks#the extra connections went back to the pool
+
+
+def test_parallel_download_resumes(tmp_path, server, connect, monkeypatch):
+    monkeypatch.setattr(transfer, "STREAM_MIN_SIZE", CHUNK)
+    client = connect(server.port, "alice", compression_codecs=())
+    data = random_file(tmp_path / "big.bin", 4 * CHUNK + 5)
+    client.upload(str(tmp_path / "big.bin"))
+    directory = tmp_path / "downloads"
+    directory.mkdir()
+    (directory / "big.bin.part").write_bytes(data[:CHUNK + 100])
+
+    client.list_files()
+    with open(client.download("alice", "big.bin", str(directory)), "rb") as f:
+        assert f.read() == data
+    assert f"Resuming download of 'big.bin' at byte {CHUNK}." in client.log
+    assert "Downloading 'big.bin' over 2 connections." in client.log#two runs of two chunks, after the one kept
+
+
+def test_split_chunks_uses_every_stream():
+    assert transfer.split_chunks([1, 2, 3, 4], 3) == [[1, 2], [3], [4]]
+    assert transfer.split_chunks([1, 2], 8) == [[1], [2]]
+    assert transfer.split_chunks([], 4) == []
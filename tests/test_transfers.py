@@ -0,0 +1,199 @@
+"""Resumed transfers and the checksums that guard them: per-chunk crc32 and hash, and the whole-file checksum."""
+import asyncio
+import os
+import sqlite3
+import zlib
+
+import pytest
+
+import protocol
+import transfer
+from chunkstore import ChunkingWriter
+from conftest import old_catalog, random_file
+from fileclient import FileClientError
+
+SIZE = 2 * transfer.TRANSFER_CHUNK_SIZE + 4321#three chunks, the last one short
+
+
+def request(client, frame_type, meta, body=b""):#one framed request on a pooled connection, returns the reply
+    def work(sock):
+        request_id = client.send_request(sock, frame_type, meta, len(body))
+        sock.sendall(body)
+        return client.wait_response(sock, request_id)
+    return client.with_connection(work)
+
+
+def open_upload(client, path, filename):#UPLOAD_OPEN of path, returns (reply meta, chunk hashes)
+    hashes = transfer.file_chunk_hashes(path)
+    reply = request(client, protocol.UPLOAD_OPEN, {"filename": filename, "size": os.path.getsize(path),
+                                                   "chunk_size": transfer.TRANSFER_CHUNK_SIZE, "hashes": hashes})
+    assert reply.type == protocol.OK
+    return reply.meta, hashes
+
+
+def send_chunks(client, path, meta, hashes, indexes):
+    error = client.with_connection(lambda sock: client.send_chunks(
+        sock, path, meta["upload_id"], os.path.getsize(path), meta["chunk_size"], hashes, indexes))
+    assert error is None
+
+
+def test_resumed_download(tmp_path, server, connect):
+    client = connect(server.port, "alice")
+    data = random_file(tmp_path / "big.bin", SIZE)
+    client.upload(str(tmp_path / "big.bin"))
+
+    directory = tmp_path / "downloads"
+    directory.mkdir()
+    (directory / "big.bin.part").write_bytes(data[:transfer.TRANSFER_CHUNK_SIZE + 1000])
+    path = client.download("alice", "big.bin", str(directory))
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert f"Resuming download of 'big.bin' at byte {transfer.TRANSFER_CHUNK_SIZE}." in client.log
+    assert not os.path.exists(directory / "big.bin.part")
+
+
+@pytest.mark.parametrize("bad_range", [{"length": -1}, {"offset": -5}, {"offset": SIZE + 1}, {"offset": "10"},
+                                       {"length": 1.5}, {"offset": True}, {"checksums": True, "length": -7}])
+def test_bad_download_range_is_refused(tmp_path, server, connect, bad_range):
+    client = connect(server.port, "alice")
+    random_file(tmp_path / "f.bin", SIZE)
+    client.upload(str(tmp_path / "f.bin"))
+    reply = request(client, protocol.DOWNLOAD, dict(bad_range, owner="alice", filename="f.bin"))
+    assert reply.type == protocol.ERROR and reply.body_len == 0
+    assert reply.meta["message"] == "Requested range not satisfiable."
+
+
+def test_resumed_upload(tmp_path, server, connect):
+    client = connect(server.port, "alice")
+    path = str(tmp_path / "big.bin")
+    data = random_file(path, SIZE)
+    meta, hashes = open_upload(client, path, "big.bin")
+    send_chunks(client, path, meta, hashes, [0])#the connection "broke" after the first chunk
+
+    assert client.upload(path) == "Upload successful."
+    assert f"Resuming upload of 'big.bin' at byte {transfer.TRANSFER_CHUNK_SIZE}." in client.log
+    with open(client.download("alice", "big.bin", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == data
+
+
+def test_corrupted_chunk_is_refused(tmp_path, server, connect):
+    client = connect(server.port, "alice")
+    path = str(tmp_path / "big.bin")
+    data = random_file(path, SIZE)
+    meta, hashes = open_upload(client, path, "big.bin")
+    body = data[:transfer.TRANSFER_CHUNK_SIZE]
+    reply = request(client, protocol.UPLOAD_CHUNK, {"upload_id": meta["upload_id"], "offset": 0,
+                                                    "crc32": zlib.crc32(body) ^ 1, "hash": hashes[0]}, body)
+    assert reply.type == protocol.ERROR
+    assert reply.meta["message"] == "Checksum mismatch." and reply.meta["offset"] == 0
+    reply = request(client, protocol.UPLOAD_CHUNK, {"upload_id": meta["upload_id"], "offset": 0,
+                                                    "crc32": zlib.crc32(body), "hash": "0" * 64}, body)
+    assert reply.meta["message"] == "Chunk hash mismatch."
+    assert client.upload(path) == "Upload successful."#nothing of the bad chunks was kept
+
+
+def test_commit_with_wrong_checksum_is_refused(tmp_path, server, connect):
+    client = connect(server.port, "alice")
+    path = str(tmp_path / "big.bin")
+    random_file(path, SIZE)
+    meta, hashes = open_upload(client, path, "big.bin")
+    send_chunks(client, path, meta, hashes, [0, 1, 2])
+    reply = request(client, protocol.UPLOAD_COMMIT, {"upload_id": meta["upload_id"], "checksum": "0" * 64})
+    assert reply.type == protocol.ERROR and reply.meta["message"] == "Checksum mismatch."
+    assert client.list_files() == []
+
+    #the chunks stay staged, the next attempt only commits
+    assert client.upload(path) == "Upload successful."
+    assert f"Resuming upload of 'big.bin' at byte {SIZE}." in client.log
+    assert client.list_files(checksums=True) == [("alice", "big.bin", SIZE, transfer.file_checksum(hashes))]
+
+
+def test_upload_with_wrong_checksum_stores_nothing(server, connect):
+    client = connect(server.port, "alice")
+    data = b"changed on the way" * 100
+    reply = request(client, protocol.UPLOAD, {"filename": "a.txt", "size": len(data), "checksum": "0" * 64}, data)
+    assert reply.type == protocol.ERROR and reply.meta["message"] == "Checksum mismatch."
+    assert client.list_files() == []
+
+    reply = request(client, protocol.UPLOAD, {"filename": "a.txt", "size": len(data)}, data)
+    assert reply.type == protocol.OK
+    assert reply.meta["checksum"] == transfer.file_checksum([transfer.chunk_hasher(data).hexdigest()])
+
+
+@pytest.mark.parametrize("size", [100, SIZE])
+def test_download_with_wrong_checksum_is_discarded(tmp_path, server, connect, size):
+    client = connect(server.port, "alice")
+    random_file(tmp_path / "f.bin", size)
+    client.upload(str(tmp_path / "f.bin"))
+    db = sqlite3.connect(tmp_path / "files.db")
+    db.execute("UPDATE files SET checksum=? WHERE unique_name='alice_f.bin'", ("0" * 64,))
+    db.commit()
+    db.close()
+
+    directory = tmp_path / "downloads"
+    with pytest.raises(FileClientError, match="File checksum mismatch"):
+        client.download("alice", "f.bin", str(directory))
+    assert not os.path.exists(directory / "f.bin")
+    assert os.path.getsize(directory / "f.bin.part") == 0#resuming would keep the bad data
+
+
+def test_download_without_server_checksum(tmp_path, storage, server, connect, monkeypatch):
+    """Servers from before whole-file checksums send only the chunk crc32s; the download still succeeds."""
+    data = random_file(storage / "old_f.bin", SIZE)
+    server.files.add("old_f.bin", "old", "f.bin", SIZE)#stored whole, no checksum
+
+    async def chunk_checksums(unique_filename, filepath):
+        return transfer.TRANSFER_CHUNK_SIZE, transfer.file_checksums(filepath), None
+    monkeypatch.setattr(server, "chunk_checksums", chunk_checksums)
+
+    client = connect(server.port, "alice")
+    with open(client.download("old", "f.bin", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == data
+
+
+def test_chunking_writer_hashes_on_the_pool(tmp_path, monkeypatch):
+    """Pieces of any size end up in the right chunk hash, and drain() holds the body back while the pool is behind."""
+    monkeypatch.setattr(transfer, "HASH_BACKLOG", 64 << 10)
+    data = os.urandom(3 * 100000 + 123)
+    writer = ChunkingWriter(str(tmp_path), 100000)
+
+    async def receive():
+        for start in range(0, len(data), 7777):#pieces cross chunk boundaries
+            writer.write(memoryview(data)[start:start + 7777])
+            await writer.drain()
+            assert writer.hashes.backlog <= transfer.HASH_BACKLOG
+        await writer.hashed()
+    asyncio.run(receive())
+    writer.close()
+
+    chunks = [data[i:i + 100000] for i in range(0, len(data), 100000)]
+    assert [chunk.digest for chunk in writer.chunks] == [transfer.chunk_hasher(c).hexdigest() for c in chunks]
+    assert [chunk.crc for chunk in writer.chunks] == [zlib.crc32(c) for c in chunks]
+    assert writer.checksum == transfer.file_checksum([transfer.chunk_hasher(c).hexdigest() for c in chunks])
+    writer.discard()
+    assert os.listdir(tmp_path) == []
+
+
+def test_whole_file_gets_its_checksum_on_first_download(tmp_path, storage, start_server, connect):
+    """A file stored whole under schema version 5 had crc32s but no checksum; the migration drops the crc32s
+    and the first download computes both, so LIST reports the checksum from then on."""
+    data = os.urandom(SIZE)
+    (storage / "alice_w.bin").write_bytes(data)
+    db = old_catalog(tmp_path / "files.db", 5)
+    db.execute("INSERT INTO files (unique_name, owner, filename, size, chunk_size, checksums)"
+               " VALUES ('alice_w.bin', 'alice', 'w.bin', ?, ?, '[1, 2, 3]')", (SIZE, transfer.TRANSFER_CHUNK_SIZE))
+    db.commit()
+    db.close()
+
+    server = start_server()
+    assert server.files.content("alice_w.bin")[3] is None
+    assert server.files.chunk_checksums("alice_w.bin") is None
+
+    client = connect(server.port, "bob")
+    with open(client.download("alice", "w.bin", str(tmp_path / "downloads")), "rb") as f:
+        assert f.read() == data
+    chunks = [data[i:i + transfer.TRANSFER_CHUNK_SIZE] for i in range(0, SIZE, transfer.TRANSFER_CHUNK_SIZE)]
+    checksum = transfer.file_checksum([transfer.chunk_hasher(chunk).hexdigest() for chunk in chunks])
+    assert server.files.content("alice_w.bin")[3] == checksum
+    assert server.files.chunk_checksums("alice_w.bin")[1] == [zlib.crc32(chunk) for chunk in chunks]
+    assert client.list_files(checksums=True) == [("alice", "w.bin", SIZE, checksum)]
@@ -0,0 +1,365 @@
+"""Bulk data movement shared by the server core and the client.
+
+File bodies go out through the kernel (sendfile) whenever the platform and
+the socket allow it; otherwise they are copied in large blocks with
+sendall, never in 4 KiB pieces. Incoming bodies are recv_into()'d a
+reusable buffer and written to the file from a memoryview. The whole-file
+checksum comes from the chunk hashes (file_checksum) instead of a second
+pass over the file. Both sides hash what they receive on a thread pool
+(HashQueue), so hashing overlaps the transfer.
+"""
+import asyncio
+import hashlib
+import os
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+SEND_CHUNK_SIZE = 1 << 20#block size of the copy loop used when sendfile is not available
+RECV_CHUNK_SIZE = 1 << 20#size of the reusable receive buffer on the client
+TRANSFER_CHUNK_SIZE = 8 << 20#unit of resumable transfers, each one carries its own crc32
+DEDUP_MIN_SIZE = 64 << 10#uploads from this size send their chunk hashes first; below it the round trip costs more than the bytes
+STREAM_MIN_SIZE = 64 << 20#each parallel connection moves at least this much of a file
+MAX_STREAMS = 8
+HASH_THREADS = os.cpu_count() or 2#pool hashing transfer data, hashlib releases the GIL so these run beside the event loop
+HASH_BACKLOG = 16 << 20#bytes a HashQueue holds before update() waits for the pool to catch up
+HASH_BLOCK = 1 << 20#received bytes collected into one hashing job on the server
+
+
+def file_size(f):
+    return os.fstat(f.fileno()).st_size
+
+
+def choose_streams(size, max_streams=MAX_STREAMS):#connections worth opening for one file of size bytes
+    return max(1, min(max_streams, size // STREAM_MIN_SIZE))
+
+
+def split_chunks(indexes, streams):#contiguous runs of chunk indexes, one per stream, lengths differ by one at most
+    streams = max(1, min(streams, len(indexes)))
+    step, longer = divmod(len(indexes), streams)
+    bounds = [i * step + min(i, longer) for i in range(streams + 1)]
+    return [indexes[bounds[i]:bounds[i + 1]] for i in range(streams) if bounds[i] < bounds[i + 1]]
+
+
+async def send_file(writer, f, offset, count, chunk_size=SEND_CHUNK_SIZE):#asyncio side (server)
+    """Send count bytes of f starting at offset over the writer's transport."""
+    if count <= 0:
+        return 0
+    await writer.drain()#headers written before the body must go out first
+    try:
+        sent = await writer.sendfile(f, offset, count)
+    except asyncio.SendfileNotAvailableError:#e.g. Windows proactor or TLS transports
+        sent = await send_file_copy(writer, f, offset, count, chunk_size)
+    if sent != count:#file shrank under us, the frame is now broken
+        raise ConnectionError(f"Sent {sent} of {count} bytes")
+    return sent
+
+
+async def send_file_copy(writer, f, offset, count, chunk_size=SEND_CHUNK_SIZE):#large-buffer fallback
+    sent = 0
+    while sent < count:
+        chunk = pread(f, min(chunk_size, count - sent), offset + sent)
+        if not chunk:
+            break
+        writer.write(chunk)
+        await writer.drain()
+        sent += len(chunk)
+    return sent
+
+
+def send_file_blocking(sock, f, offset=0, count=None, chunk_size=SEND_CHUNK_SIZE):#blocking side (client)
+    """Send count bytes of f from offset; socket.sendfile uses os.sendfile where it exists."""
+    if count is None:
+        count = file_size(f) - offset
+    if count <= 0:
+        return 0
+    if hasattr(os, "sendfile"):
+        sent = sock.sendfile(f, offset, count)
+    else:#no zero-copy on this platform
+        sent = send_file_copy_blocking(sock, f, offset, count, chunk_size)
+    if sent != count:
+        raise ConnectionError(f"Sent {sent} of {count} bytes")
+    return sent
+
+
+def send_file_copy_blocking(sock, f, offset, count, chunk_size=SEND_CHUNK_SIZE):#one reused buffer, sendall per block
+    f.seek(offset)
+    buf = bytearray(min(chunk_size, count))
+    view = memoryview(buf)
+    sent = 0
+    while sent < count:
+        n = f.readinto(view[:min(len(buf), count - sent)])
+        if not n:
+            break
+        sock.sendall(view[:n])
+        sent += n
+    return sent
+
+
+def recv_into_file(sock, f, count, buf):#blocking receive of count bytes into f through buf
+    view = memoryview(buf)
+    received = 0
+    while received < count:
+        n = sock.recv_into(view, min(len(view), count - received))
+        if not n:
+            break
+        f.write(view[:n])
+        received += n
+    return received
+
+
+def pread(f, size, offset):#positional read, parallel ranges of one file never share a file position
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), size, offset)
+    f.seek(offset)
+    return f.read(size)
+
+
+class PositionalWriter:
+    """Writes at an explicit offset of a raw descriptor with os.pwrite (seek + write where missing)."""
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:#pwrite may write less than asked
+            n = self.write_at(view, self.offset)
+            view = view[n:]
+            self.offset += n
+        return len(data)
+
+    def write_at(self, data, offset):
+        if hasattr(os, "pwrite"):
+            return os.pwrite(self.fd, data, offset)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        return os.write(self.fd, data)
+
+
+class ChecksumWriter:
+    """File wrapper that keeps a running crc32 of everything written through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.crc = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        return self.f.write(data)
+
+
+def chunk_hasher(data=b""):#content address of a chunk in the server's chunk store
+    return hashlib.blake2b(data, digest_size=32)
+
+
+def file_checksum(digests):
+    """Whole-file checksum from the hex chunk_hasher() digests of a file's chunks, in order.
+
+    A file of one chunk (or none) checks out as that chunk's hash, the plain
+    BLAKE2b of its bytes. A longer one as a BLAKE2b of its digest list,
+    personalized so it never equals the hash of some data. Uploads and
+    downloads hash chunks anyway, so the checksum costs no second pass."""
+    if len(digests) <= 1:
+        return digests[0] if digests else chunk_hasher().hexdigest()
+    return hashlib.blake2b(b"".join(bytes.fromhex(digest) for digest in digests), digest_size=32,
+                           person=b"chunklist").hexdigest()
+
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+def hash_pool():#shared by every HashQueue of the process, started on first use
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(HASH_THREADS, thread_name_prefix="hash")
+        return _hash_pool
+
+
+def _update(data, hasher):
+    hasher.update(data)
+
+
+class HashQueue:
+    """Hashing work of one stream, run on a pool thread in the order it was queued.
+
+    update() copies the data (receive buffers are reused right away) and returns
+    without hashing it, so the next receive starts while a pool thread hashes the
+    last one. Queues of different streams run on different threads. update()
+    waits when more than HASH_BACKLOG bytes are queued; an event loop submits
+    with wait=False instead and awaits below() to keep up."""
+
+    def __init__(self):
+        self.jobs = deque()#(function, args, bytes)
+        self.lock = threading.Condition()
+        self.backlog = 0#bytes queued and not hashed yet
+        self.running = False#a pool thread is working through jobs
+        self.error = None#first exception a job raised
+        self.waiters = []#(backlog, Future) from below()
+
+    def submit(self, function, *args, size=0, wait=True):
+        with self.lock:
+            while wait and self.backlog > HASH_BACKLOG:
+                self.lock.wait()
+            self.jobs.append((function, args, size))
+            self.backlog += size
+            if not self.running:
+                self.running = True
+                hash_pool().submit(self.run)
+
+    def update(self, data, hasher):
+        data = bytes(data)
+        self.submit(_update, data, hasher, size=len(data))
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.jobs:
+                    self.running = False
+                    return
+                function, args, size = self.jobs.popleft()
+            try:
+                function(*args)
+            except Exception as e:
+                self.error = self.error or e
+            with self.lock:
+                self.backlog -= size
+                self.lock.notify_all()
+                waiting = [future for limit, future in self.waiters if self.backlog <= limit]
+                self.waiters = [waiter for waiter in self.waiters if self.backlog > waiter[0]]
+            for future in waiting:
+                future.set_result(None)
+
+    def below(self, size):#Future done once no more than size bytes are left to hash
+        future = Future()
+        with self.lock:
+            if self.backlog > size:
+                self.waiters.append((size, future))
+                return future
+        future.set_result(None)
+        return future
+
+    def flushed(self):#Future done once everything queued so far has run, failed if a job failed
+        future = Future()
+        self.submit(self.finish, future, wait=False)
+        return future
+
+    def finish(self, future):
+        if self.error is not None:
+            future.set_exception(self.error)
+        else:
+            future.set_result(None)
+
+    def join(self):#blocking flushed()
+        self.flushed().result()
+
+
+class ChunkHashWriter:
+    """Passes writes on to f and hashes them chunk by chunk on the hash pool, as they arrive.
+
+    The data starts on a chunk boundary. When the file already holds start bytes
+    (a resumed download), those are hashed from path meanwhile, on another thread."""
+
+    def __init__(self, f, chunk_size, path=None, start=0):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.hashers = []
+        self.filled = chunk_size#bytes in the last chunk
+        self.hashes = HashQueue()
+        self.before = hash_pool().submit(file_chunk_hashes, path, chunk_size, count=start) if start else None
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.filled == self.chunk_size:
+                self.hashers.append(chunk_hasher())
+                self.filled = 0
+            piece = view[:self.chunk_size - self.filled]
+            self.hashes.update(piece, self.hashers[-1])
+            self.filled += len(piece)
+            view = view[len(piece):]
+        return self.f.write(data)
+
+    def digests(self):#blocking: hex chunk_hasher() of every chunk of the file so far
+        self.hashes.join()
+        before = self.before.result() if self.before is not None else []
+        return before + [hasher.hexdigest() for hasher in self.hashers]
+
+
+def read_chunks(path, chunk_size=TRANSFER_CHUNK_SIZE, buf_size=RECV_CHUNK_SIZE, count=None):
+    """Yields (chunk index, block) over a file (its first count bytes); blocks never span two chunks
+    and the view is reused."""
+    buf = bytearray(min(buf_size, chunk_size))
+    view = memoryview(buf)
+    index = 0
+    with open(path, "rb") as f:
+        while True:
+            left = chunk_size if count is None else min(chunk_size, count - index * chunk_size)
+            while left > 0:
+                n = f.readinto(view[:min(len(buf), left)])
+                if not n:
+                    return
+                yield index, view[:n]
+                left -= n
+            if count is not None and (index + 1) * chunk_size >= count:
+                return
+            index += 1
+
+
+def file_checksums(path, chunk_size=TRANSFER_CHUNK_SIZE, buf_size=RECV_CHUNK_SIZE, hashers=None):
+    """crc32 of every chunk of a file; a hashers list gets a chunk_hasher() of every chunk in the same pass."""
+    checksums = []
+    for index, block in read_chunks(path, chunk_size, buf_size):
+        if index == len(checksums):
+            checksums.append(0)
+            if hashers is not None:
+                hashers.append(chunk_hasher())
+        checksums[index] = zlib.crc32(block, checksums[index])
+        if hashers is not None:
+            hashers[index].update(block)
+    return checksums
+
+
+def file_chunk_hashes(path, chunk_size=TRANSFER_CHUNK_SIZE, buf_size=RECV_CHUNK_SIZE, count=None):
+    """Hex chunk_hasher() of every chunk of a file, or of its first count bytes."""
+    hashers = []
+    for index, block in read_chunks(path, chunk_size, buf_size, count):
+        if index == len(hashers):
+            hashers.append(chunk_hasher())
+        hashers[index].update(block)
+    return [hasher.hexdigest() for hasher in hashers]
+
+
+def recv_chunks_into_file(sock, f, count, buf, chunk_size, checksums, progress=None):
+    """Like recv_into_file, checking every full chunk (and the last short one) against checksums.
+
+    Returns (received, verified): verified is how many leading bytes matched,
+    the caller keeps only those. The whole body is always drained so the
+    stream stays in sync even after a mismatch. progress(n) is called after
+    every recv."""
+    view = memoryview(buf)
+    received = verified = 0
+    crc = 0
+    chunk = 0#index into checksums
+    failed = False
+    while received < count:
+        n = sock.recv_into(view, min(len(view), count - received, chunk_size - (received - chunk * chunk_size)))
+        if not n:
+            break
+        if not failed:
+            f.write(view[:n])
+            crc = zlib.crc32(view[:n], crc)
+        received += n
+        if progress is not None:
+            progress(n)
+        if received - chunk * chunk_size == chunk_size or received == count:#chunk boundary or end of body
+            if not failed and chunk < len(checksums) and checksums[chunk] == crc:
+                verified = received
+            else:
+                failed = True
+            chunk += 1
+            crc = 0
+    return received, verified